@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, join
+sys.path.append(abspath(join(dirname(__file__), "..")))  # Patrick/, for "src"
+
+"""
+Benchmarks the output profiles of src/OutputProfiles.py: write throughput, read throughput and file size.
+
+The data is either synthetic (molecule counts that random walk around a few typical copy numbers, shaped like the
+(replicates, time, columns) datasets of the result selectors) or the result datasets of an existing output file
+(--file). Reads are done the way plot.py reads: one column at a time, all replicates and the whole time axis.
+
+Throughput is given in MB/s of the decoded float64 data, i.e. the same amount for every profile.
+
+Example:
+    python bench_output.py
+    python bench_output.py --replicats 20 --time-points 4000 --columns 30
+    python bench_output.py --file ../saved_objects/testing/test.h5 --json output_bench.json
+"""
+
+
+def synthetic_counts(replicats, time_points, columns, seed=0):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    levels = rng.choice([0, 50, 2_000, 50_000, 2_000_000], size=columns)
+    steps = rng.normal(0, np.sqrt(levels + 1) / 10, size=(replicats, time_points, columns))
+    return np.maximum(np.round(levels + np.cumsum(steps, axis=1)), 0).astype(np.float64)
+
+
+def datasets_of_file(path):
+    """
+    Returns the (runs, time, columns) result datasets of a file as {path in file: array}.
+    """
+    import h5py
+    from src.OutputProfiles import decode, register_plugins
+    register_plugins()
+    found = {}
+    with h5py.File(path, "r") as f:
+        def visit(name, item):
+            if isinstance(item, h5py.Dataset) and name.split("/")[-1] == "data" and item.ndim == 3:
+                found[name] = decode(item)[()]
+        f.visititems(visit)
+    return found
+
+
+def bench_profile(profile, datasets, directory, repeat):
+    import h5py
+    import numpy as np
+    from src.OutputProfiles import write_dataset, decode, register_plugins
+    register_plugins()
+    path = join(directory, f"{profile}.h5")
+    megabytes = sum(data.size * 8 for data in datasets.values()) / 2**20
+
+    write = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        with h5py.File(path, "w") as f:
+            for i, data in enumerate(datasets.values()):
+                write_dataset(f.create_group(f"selector_{i}"), "data", data, profile)
+        write = min(write, time.perf_counter() - start_time)
+
+    read = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        with h5py.File(path, "r") as f:
+            for i, data in enumerate(datasets.values()):
+                dataset = decode(f[f"selector_{i}/data"])
+                for column in range(data.shape[2]):
+                    values = dataset[:, :, column]
+        read = min(read, time.perf_counter() - start_time)
+
+    # lossless check
+    with h5py.File(path, "r") as f:
+        for i, data in enumerate(datasets.values()):
+            assert np.array_equal(decode(f[f"selector_{i}/data"])[()], data), f"{profile} changed the data"
+            dtype = str(f[f"selector_{i}/data"].dtype)
+
+    size = os.path.getsize(path)
+    return {"profile": profile, "dtype": dtype, "size_mb": size / 2**20, "ratio": megabytes * 2**20 / size,
+            "write_mb_s": megabytes / write, "read_mb_s": megabytes / read, "write_seconds": write,
+            "read_seconds": read}
+
+
+def main():
+    from src.OutputProfiles import OUTPUT_PROFILES
+    parser = argparse.ArgumentParser(description="Benchmark the output profiles of src/OutputProfiles.py.")
+    parser.add_argument("--profiles", nargs="*", default=list(OUTPUT_PROFILES), choices=list(OUTPUT_PROFILES))
+    parser.add_argument("--file", default=None, help="Benchmark the result datasets of this .h5 file")
+    parser.add_argument("--replicats", type=int, default=10)
+    parser.add_argument("--time-points", type=int, default=2000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    if args.file:
+        datasets = datasets_of_file(args.file)
+        assert datasets, f"No result datasets in {args.file}"
+    else:
+        datasets = {"synthetic": synthetic_counts(args.replicats, args.time_points, args.columns)}
+    megabytes = sum(data.size * 8 for data in datasets.values()) / 2**20
+    print(f"{len(datasets)} datasets, {megabytes:.1f} MB as float64")
+    print(f"{'profile':<10} {'dtype':<8} {'size MB':>9} {'ratio':>7} {'write MB/s':>11} {'read MB/s':>10}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for profile in args.profiles:
+            result = bench_profile(profile, datasets, directory, args.repeat)
+            results.append(result)
+            print(f"{profile:<10} {result['dtype']:<8} {result['size_mb']:9.2f} {result['ratio']:7.1f} "
+                  f"{result['write_mb_s']:11.1f} {result['read_mb_s']:10.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"source": args.file or "synthetic", "float64_mb": megabytes, "results": results}, f,
+                      indent=2)
+
+
+if __name__ == "__main__":
+    main()
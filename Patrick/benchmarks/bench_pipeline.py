@@ -0,0 +1,217 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from os.path import abspath, dirname, join
+sys.path.append(abspath(join(dirname(__file__), "..")))  # Patrick/, for "src" and "parameters"
+sys.path.append(abspath(join(dirname(__file__), "..", "..")))  # repo root, for "Patrick.src"
+
+"""
+Benchmarks the Python side of a simulation, i.e. everything SimManager does before and after the solver:
+
+    config      get_repo_path()
+    dataframe   spreadsheet loading (raw pd.read_excel for reference, then the compiled cache)
+    mesh        mesh loading (raw .inp parse, then the binary mesh cache and the TetMesh construction)
+    model       SimManager + load_model (model construction and partitioning)
+    output      XDMFHandler + toDB
+    init        newRun() + set_inital_values
+    write       a short run with a few save points, i.e. mostly result writing
+
+Every stage is timed (best of --repeat) and its peak memory is recorded (Python allocations via tracemalloc, in a
+separate untimed call, and the growth of the peak RSS). Results are appended to a JSON history, and every stage that
+got slower than --threshold times the median of the previous --window runs of the same case on the same host is
+reported as a regression.
+
+Example:
+    python bench_pipeline.py --model small --meshes ../meshes_ellipsoidity/ellipsoidity_0.0.inp
+    python bench_pipeline.py --resolutions 0.4e-6 0.25e-6 0.166e-6   # generates the meshes in benchmarks/meshes first
+"""
+
+DEFAULT_HISTORY = join(dirname(abspath(__file__)), "pipeline_history.json")
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on linux
+
+
+def measure(stage, func, repeat, results, trace_memory=True):
+    """
+    Runs func `repeat` times and stores the best time and the peak memory of the stage in `results[stage]`.
+    Returns the value of the last call.
+
+    tracemalloc slows down allocation heavy code a lot, so the timed calls run without it and the Python peak is
+    measured in one more, separate call. Stages that cannot run twice pass `trace_memory=False`.
+    """
+    best, value = float("inf"), None
+    rss_before = peak_rss_mb()
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        value = func()
+        best = min(best, time.perf_counter() - start_time)
+    python_peak = None
+    if trace_memory:
+        tracemalloc.start()
+        value = func()
+        python_peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    results[stage] = {"seconds": best, "python_peak_mb": python_peak, "rss_growth_mb": peak_rss_mb() - rss_before}
+    peak_text = f"{python_peak:9.1f} MB" if python_peak is not None else "      n/a"
+    print(f"  {stage:<22} {best:10.4f} s   python peak {peak_text}")
+    return value
+
+
+def bench_case(p, mesh_path, model_type, repeat, save_dir, mesh_scale=1):
+    import pandas as pd
+    import steps.interface
+    import steps.saving as stsave
+    from src import ModelCache, MeshCache
+    from src.ModelCache import load_model_dataframe
+    from src.MeshCache import parse_abaqus, load_mesh_arrays
+    from src.SimManager import SimManager
+    from src.Utilities import get_repo_path, set_inital_values
+
+    results = {}
+    base_path = measure("config", get_repo_path, repeat, results)
+
+    df_path = f"{base_path}{p['big_model_mini_sph_df_path']}"
+    measure("dataframe_read_excel", lambda: pd.read_excel(df_path), repeat, results)
+
+    def cached_dataframe():
+        ModelCache._memo.clear()  # only drop the in-process memo, the compiled file stays
+        return load_model_dataframe(df_path)
+    measure("dataframe_cached", cached_dataframe, repeat, results)
+
+    scale = mesh_scale if model_type == "small" else 10 ** -6  # the large model always loads with 10**-6
+    measure("mesh_parse_inp", lambda: parse_abaqus(mesh_path, scale), 1, results)
+
+    def cached_mesh():
+        MeshCache._memo.clear()
+        return load_mesh_arrays(mesh_path, scale)
+    mesh_arrays = measure("mesh_cached", cached_mesh, repeat, results)
+    measure("mesh_to_tetmesh", mesh_arrays.to_tetmesh, repeat, results)
+    results["mesh_cached"]["n_tets"] = int(len(mesh_arrays.tets))
+
+    def model():
+        sm = SimManager(parameters=p, mesh_path=mesh_path, save_path=join(save_dir, "bench"), runname="bench",
+                        plot_only_run=False, replace=True)
+        sm.load_model(type=model_type, mesh_scale=mesh_scale)
+        return sm
+    sm = measure("model", model, 1, results)
+
+    # same output options as SimManager.run
+    with stsave.XDMFHandler(join(save_dir, "bench"), hdf5DatasetKwArgs=dict(compression="gzip",
+                                                                          compression_opts=5)) as hdf:
+        measure("output_setup", lambda: sm.simulation.toDB(hdf, uid="bench"), 1, results, trace_memory=False)
+
+        def init():
+            sm.simulation.newRun()
+            set_inital_values(sm, factor=1)
+        measure("init", init, repeat, results)
+
+        # a short run with a handful of save points, so writing dominates over the solver
+        measure("write", lambda: sm.simulation.run(sm.simulation.Time + 5 * p["time step"]), 1, results)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=dirname(abspath(__file__)),
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_regressions(history, record, threshold, window, min_seconds=0.01):
+    """
+    Compares every stage of `record` with the median of the last `window` records of the same case on the same host
+    (timings of different machines are not comparable).
+    """
+    regressions = []
+    for case, stages in record["cases"].items():
+        previous = [r["cases"][case] for r in history
+                    if case in r.get("cases", {}) and r.get("host") == record["host"]][-window:]
+        for stage, values in stages.items():
+            times = sorted(r[stage]["seconds"] for r in previous if stage in r)
+            if not times:
+                continue
+            median = times[len(times) // 2]
+            if values["seconds"] > threshold * median and values["seconds"] - median > min_seconds:
+                regressions.append((case, stage, median, values["seconds"]))
+    return regressions
+
+
+def generate_resolution_meshes(ellipsoidities, resolutions, directory):
+    """
+    Generates (or reuses, see `create_mesh_batch`) one mesh per ellipsoidity and resolution in `directory/min_{size}/`.
+    """
+    from src.MeshProcessor import create_mesh_batch
+    paths = []
+    for mesh_size_min in resolutions:
+        output_dir = join(directory, f"min_{mesh_size_min:g}")
+        create_mesh_batch(output_dir, ellipsoidities, mesh_size_min=mesh_size_min,
+                          mesh_size_max=max(mesh_size_min, 0.4e-6))
+        paths += [join(output_dir, f"ellipsoidity_{e}.inp") for e in ellipsoidities]
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the setup/output pipeline of SimManager.")
+    parser.add_argument("--model", default="small", choices=["small", "large"])
+    parser.add_argument("--meshes", nargs="*", default=None,
+                        help="Meshes to benchmark, defaults to Patrick/meshes_ellipsoidity/*.inp")
+    parser.add_argument("--resolutions", nargs="*", type=float, default=None,
+                        help="Generate the ellipsoidity meshes for every mesh_size_min and benchmark those")
+    parser.add_argument("--ellipsoidities", nargs="*", type=float, default=[0.0, 0.5],
+                        help="Ellipsoidities of the meshes generated for --resolutions")
+    parser.add_argument("--mesh-scale", type=float, default=1, help="mesh_scale of the small model")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--history", default=DEFAULT_HISTORY)
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown factor counted as regression")
+    parser.add_argument("--window", type=int, default=5, help="Number of previous runs to compare against")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    from parameters import p
+    from src.Utilities import get_repo_path
+
+    mesh_dir = join(dirname(abspath(__file__)), "meshes")
+    if args.resolutions:
+        meshes = generate_resolution_meshes(args.ellipsoidities, args.resolutions, mesh_dir)
+    else:
+        meshes = args.meshes or sorted(glob.glob(f"{get_repo_path()}Patrick/meshes_ellipsoidity/*.inp"))
+    assert meshes, "No meshes found, pass --meshes or --resolutions."
+
+    record = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(),
+              "host": platform.node(), "python": platform.python_version(), "model": args.model, "cases": {}}
+    with tempfile.TemporaryDirectory() as save_dir:
+        for mesh_path in meshes:
+            case = f"{args.model}:{os.path.relpath(mesh_path, dirname(dirname(abspath(mesh_path))))}"
+            print(case)
+            record["cases"][case] = bench_case(p, mesh_path, args.model, args.repeat, save_dir, args.mesh_scale)
+
+    history = []
+    if os.path.isfile(args.history):
+        with open(args.history, "r") as f:
+            history = json.load(f)
+    regressions = find_regressions(history, record, args.threshold, args.window)
+    history.append(record)
+    with open(args.history, "w") as f:
+        json.dump(history, f, indent=1)
+
+    for case, stage, median, seconds in regressions:
+        print(f"REGRESSION {case} {stage}: {seconds:.4f} s vs. median {median:.4f} s")
+    if not regressions:
+        print("No regressions.")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
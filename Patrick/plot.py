@@ -6,6 +6,8 @@ import h5py
 import numpy as np
 import re
 import math
+from src.Ensemble import load_results
+from src.Statistics import cached_statistics
 
 def traverse_datasets(hdf_file):
 
@@ -33,14 +35,20 @@ hdf_path = "/home/pb/steps_cell_signaling/Patrick/saved_objects/testing/test"
 # traverse_datasets(hdf_path + ".h5")
 # hdf = stsave.HDF5Handler("/home/pb/steps_cell_signaling/Patrick/saved_objects/initial_run/parallel_run_1")
 # hdf = stsave.HDF5Handler("/home/pb/steps_cell_signaling/Patrick/saved_objects/full_run/large_model")
-hdf = stsave.HDF5Handler(hdf_path)
+# hdf = stsave.HDF5Handler(hdf_path)
 # with stsave.HDF5Handler("/home/pb/steps_cell_signaling/Patrick/saved_objects/initial_run/parallel_run_1") as hdf:
 # results = hdf["long_run"].results
-results = hdf["test"].results
+# load_results reads both regular STEPS files and ensemble files written by src/Ensemble.run_ensemble
+results = load_results(hdf_path, "test")
+# mean, std, quantiles and confidence bands over the replicats, computed block by block and cached next to the results
+# (hdf_path.stats/), so replotting does not read the replicats again, see src/Statistics.py
+statistics = cached_statistics(hdf_path, "test", results)
 
-# extract the species names for the result_selector label via regex
-full_labels = [x.labels for x in results]
-species_names = [re.search(r'\.(.*?)\.', s[0]).group(1) for s in full_labels if re.search(r'\.(.*?)\.', s[0])]
+# extract the species names for the result_selector labels via regex, one curve per column so that the
+# aggregated output mode (one selector per compartment with all its species as columns) is plotted the same way
+columns = [(stats, col, re.search(r'\.(.*?)\.', label).group(1))
+           for stats in statistics for col, label in enumerate(stats["labels"]) if re.search(r'\.(.*?)\.', label)]
+species_names = [name for _, _, name in columns]
 
 # Plot all results
 num_species = len(species_names)
@@ -50,15 +58,20 @@ n_rows, n_cols = grid_size, math.ceil(num_species / grid_size)
 fig, axes = plt.subplots(n_rows, n_cols, figsize=(15, 10))
 axes = axes.flatten()  # Flatten in case of 2D array
 
-for idx, (res, species_name) in enumerate(zip(results, species_names)):
-    mean_data = np.mean(res.data[:,:,0], axis=0)
-    std_data = np.std(res.data[:,:,0], axis=0)
+for idx, (stats, col, species_name) in enumerate(columns):
+    # replicats that stopped at steady state before the endtime (SimManager.run(..., steady_state=...)) are ignored
+    # where they have no data
+    mean_data = stats["mean"][:, col]
+    std_data = np.nan_to_num(stats["std"][:, col])
     ax = axes[idx]
-    # ax.scatter(res.time[0], mean_data, label='Mean', s = 0.5)
-    ax.plot(res.time[0], mean_data, label='Mean')
-    ax.fill_between(res.time[0], mean_data - std_data, mean_data + std_data, alpha=0.3, label='std')
+    # ax.scatter(stats["time"], mean_data, label='Mean', s = 0.5)
+    ax.plot(stats["time"], mean_data, label='Mean')
+    ax.fill_between(stats["time"], mean_data - std_data, mean_data + std_data, alpha=0.3, label='std')
+    # 5% - 95% quantile band or 95% confidence band of the mean instead:
+    # ax.fill_between(stats["time"], stats["quantiles"][0][:, col], stats["quantiles"][-1][:, col], alpha=0.3)
+    # ax.fill_between(stats["time"], stats["ci_low"][:, col], stats["ci_high"][:, col], alpha=0.3)
 
-    if idx >= len(results) - n_cols:
+    if idx >= len(columns) - n_cols:
         ax.set_xlabel('Time [s]')
     # else:
     #     ax.set_xticklabels([])
@@ -2,13 +2,15 @@ import numpy as np
 import os
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
-from Patrick.src.MeshProcessor import create_full_mesh
+from Patrick.src.MeshProcessor import create_mesh_batch
 from Patrick.src.Utilities import get_repo_path
 
-base_path = get_repo_path()
+if __name__ == "__main__":
+    base_path = get_repo_path()
 
-ellipsoidity = np.linspace(0,1,11)
-for ellip in ellipsoidity:
-    output_file = base_path + f"Patrick/meshes_ellipsoidity/ellipsoidity_{np.round(ellip,3)}.inp"
-    print(output_file)
-    create_full_mesh(output_file, ellip, mesh_size_min=0.166e-6, mesh_size_max=0.4e-6)
\ No newline at end of file
+    ellipsoidity = np.linspace(0,1,11)
+    # meshes that already exist with the same settings are skipped, see meshes_ellipsoidity/manifest.json
+    create_mesh_batch(base_path + "Patrick/meshes_ellipsoidity/", ellipsoidity,
+                      n_workers=None, # defaults to the number of CPU cores / gmsh_threads
+                      gmsh_threads=1,
+                      mesh_size_min=0.166e-6, mesh_size_max=0.4e-6)
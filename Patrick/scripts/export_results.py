@@ -0,0 +1,27 @@
+import argparse
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from src.Export import export_results, FORMATS
+
+"""
+Exports runs of a result file to a tidy Parquet or Arrow dataset (run, replicate, time, species, compartment, value)
+for pandas/polars/duckdb, needs pyarrow.
+
+    python export_results.py ../saved_objects/test_mesh/test test ../saved_objects/test_mesh/export
+    python export_results.py results run_a run_b out_dir --format arrow --compression none
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export result runs to Parquet/Arrow.")
+    parser.add_argument("hdf_path", help="Result file without the .h5 suffix")
+    parser.add_argument("uids", nargs="+", help="Run names, followed by the output directory")
+    parser.add_argument("--format", default="parquet", choices=FORMATS)
+    parser.add_argument("--compression", default="zstd", help="e.g. zstd, lz4, snappy or none")
+    args = parser.parse_args()
+    assert len(args.uids) >= 2, "Give at least one run name and the output directory."
+
+    compression = None if args.compression == "none" else args.compression
+    files = export_results(args.hdf_path, args.uids[:-1], args.uids[-1], format=args.format, compression=compression)
+    print(f"Wrote {len(files)} files to {args.uids[-1]}")
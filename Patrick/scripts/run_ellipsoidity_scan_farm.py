@@ -0,0 +1,34 @@
+import sys
+from os import listdir
+from os.path import isfile, join, abspath, dirname
+sys.path.append(abspath(join(dirname(__file__), "../")))  # Add project root to path
+
+from src.TaskFarm import build_tasks, run_task_farm
+from parameters import p
+
+
+"""
+Task farm version of run_ellipsoidity_scan.py.
+
+Instead of running one mesh after the other on all ranks, COMM_WORLD is split into groups of `group_size` ranks and
+every group takes (mesh, parameter set, replicate) tasks from a shared queue until all are done, e.g.
+
+    mpirun -n 16 python3 run_ellipsoidity_scan_farm.py
+
+runs 16 tasks at the same time with group_size = 1, each with the serial Tetexact solver (TetOpSplit always runs on
+all ranks of COMM_WORLD and cannot be used by a group, see the notes of `run_task_farm`).
+"""
+
+ellipsoid_meshes_path = "/home/pb/steps_cell_signaling/Patrick/meshes_ellipsoidity/"
+save_root = "/home/pb/steps_cell_signaling/Patrick/saved_objects/ellipsoidity_farm/"
+group_size = 1
+
+mesh_files = sorted(join(ellipsoid_meshes_path, f) for f in listdir(ellipsoid_meshes_path)
+                    if isfile(join(ellipsoid_meshes_path, f)) and f.endswith(".inp"))
+parameter_sets = [p]  # e.g. [p | {"k[0]": value} for value in (1e7, 1e8, 1e9)]
+
+tasks = build_tasks(mesh_files, parameter_sets, replicats=1, save_root=save_root, model_type="small",
+                    runname="ellipsoidity", seed=2903, solver="Tetexact")
+finished = run_task_farm(tasks, group_size=group_size)
+if finished is not None:
+    print(f"Finished {len(finished)} tasks, total task time {sum(t[2] for t in finished):.2f} seconds")
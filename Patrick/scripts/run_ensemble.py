@@ -0,0 +1,23 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from src.Ensemble import run_ensemble
+from src.Utilities import get_repo_path
+from parameters import p
+
+"""
+Runs many independent replicates of one model in a local process pool (one serial solver per CPU core) and merges
+them into a single HDF5 file that plot.py can read. Run it with plain python, not with mpirun.
+"""
+
+if __name__ == "__main__":
+    base_path = get_repo_path()
+    run_ensemble(parameters=p,
+                 mesh_path=f"{base_path}Patrick/meshes_ellipsoidity/ellipsoidity_0.0.inp",
+                 save_path=f"{base_path}Patrick/saved_objects/ensemble/small_model",  # without the .h5 suffix
+                 replicats=64,
+                 model_type="small",
+                 runname="test",
+                 n_workers=None,  # defaults to the number of CPU cores
+                 seed=2903)
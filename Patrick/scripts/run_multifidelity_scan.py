@@ -0,0 +1,29 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from src.MultiFidelity import run_multifidelity_scan, peak
+from src.Utilities import get_repo_path
+from parameters import p
+
+"""
+Scans k[0] x DC with the deterministic TetODE solver and runs spatial TetOpSplit replicates only for the 4 points with the
+highest ERKpp peak. Screening and refined results are listed in saved_objects/multifidelity/index.json.
+
+    mpirun -n 8 python run_multifidelity_scan.py
+"""
+
+if __name__ == "__main__":
+    base_path = get_repo_path()
+    run_multifidelity_scan(base_parameters=p,
+                           grid={"k[0]": [1e6, 1e7, 1e8, 1e9], "DC": [1e-12, 4e-12, 1e-11]},
+                           mesh_path=f"{base_path}Patrick/meshes_ellipsoidity/ellipsoidity_0.0.inp",
+                           save_root=f"{base_path}Patrick/saved_objects/multifidelity",
+                           criterion=peak("ERKpp"),
+                           select="top",  # or "sensitivity" to refine where the response changes the most
+                           n_refine=4,
+                           model_type="small",
+                           screening_solver="TetODE",  # adaptive step, stable for the fast nuclear reactions
+                           refine_solver="TetOpSplit",
+                           refine_replicats=5,
+                           seed=2903)
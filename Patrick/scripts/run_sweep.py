@@ -0,0 +1,45 @@
+import argparse
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from src.Sweep import run_sweep, load_spec, manifest_path, sweep_status
+from src.Utilities import get_repo_path
+from parameters import p
+
+"""
+Runs a parameter sweep from a declarative spec and keeps track of every job in a SQLite manifest
+(saved_objects/sweep/manifest.sqlite). Kill it at any time and start it again with the same spec: finished jobs are
+skipped.
+
+    mpirun -n 16 python run_sweep.py                   # the example spec below
+    mpirun -n 16 python run_sweep.py my_spec.json      # a spec in a JSON file
+    python run_sweep.py my_spec.json --status          # only print how many jobs are pending/done/failed
+"""
+
+
+def example_spec():
+    base_path = get_repo_path()
+    return {"save_root": f"{base_path}Patrick/saved_objects/sweep",
+            "meshes": [f"{base_path}Patrick/meshes_ellipsoidity/*.inp"],
+            "grid": {"DC": [1e-12, 4e-12, 1e-11], "k[0]": [1e7, 1e8], "k[666]": [0.03, 0.3]},
+            "replicats": 3,
+            "seed": 2903,
+            "model_type": "small",
+            "load_model": {"solver": "Tetexact"},  # serial, one job per rank (TetOpSplit only with --group-size = -n)
+            "run": {}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a resumable parameter sweep.")
+    parser.add_argument("spec", nargs="?", default=None, help="JSON spec, see src/Sweep.py -> expand_spec")
+    parser.add_argument("--group-size", type=int, default=1, help="Ranks per job, 1 or the number of ranks")
+    parser.add_argument("--retry-failed", action="store_true", help="Run the jobs that failed before again")
+    parser.add_argument("--status", action="store_true", help="Only print the status of the manifest")
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec) if args.spec else example_spec()
+    if args.status:
+        print(sweep_status(manifest_path(spec)))
+    else:
+        run_sweep(spec, p, group_size=args.group_size, retry_failed=args.retry_failed)
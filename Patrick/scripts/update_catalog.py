@@ -0,0 +1,32 @@
+import argparse
+import json
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from src.Catalog import Catalog
+from src.Utilities import get_repo_path
+
+"""
+Updates the results catalog of saved_objects (saved_objects/catalog.sqlite) and optionally lists matching runs.
+
+    python update_catalog.py                                          # index new and changed files
+    python update_catalog.py --species ERKpp --parameters '{"DC": 4e-12, "k[0]": [1e7, 1e9]}'
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index result files and query the catalog.")
+    parser.add_argument("--root", default=None, help="Directory to index, defaults to Patrick/saved_objects")
+    parser.add_argument("--uid", default=None)
+    parser.add_argument("--species", default=None)
+    parser.add_argument("--solver", default=None)
+    parser.add_argument("--parameters", default=None, help="JSON dict, values or [low, high] ranges")
+    args = parser.parse_args()
+
+    catalog = Catalog(args.root or f"{get_repo_path()}Patrick/saved_objects")
+    catalog.update()
+    if args.uid or args.species or args.solver or args.parameters:
+        parameters = json.loads(args.parameters) if args.parameters else None
+        for run in catalog.query(uid=args.uid, species=args.species, solver=args.solver, parameters=parameters):
+            print(f"{run.path} [{run.uid}] {run.replicats} replicats, t = {run.t_start}..{run.t_end}, "
+                  f"{run.solver}, mesh {run.mesh_fingerprint}")
@@ -0,0 +1,157 @@
+import json
+import os
+import h5py
+import numpy as np
+from src.Statistics import RunningStatistics
+
+AGGREGATE_FORMAT = "steps_cell_signaling.aggregate.v1"
+
+# accumulators stored per selector, see `RunningStatistics`
+_ACCUMULATORS = ("count", "mean", "m2", "min", "max")
+
+
+class ReplicateAggregator:
+    """
+    Running statistics over the replicates of a run, updated after every replicate, so that only the aggregates
+    (and a small random sample of raw replicates) are stored instead of every replicate.
+
+    Per selector, time point and column it keeps count, mean, M2 (sum of squared deviations, Welford), min and max,
+    optionally a histogram with fixed bins, and the replicates of a fixed random sample (`RunningStatistics`). The
+    memory and the file grow with the number of time points, not with the number of replicates.
+    """
+
+    def __init__(self, labels, n_replicats, sample_size=0, histogram_edges=None, seed=0):
+        """
+        Args:
+            labels (dict): Selector name -> list of column labels.
+            n_replicats (int): Number of replicates that will be added.
+            sample_size (int): Raw replicates to keep (a uniform random choice), 0 keeps none.
+            histogram_edges (array or dict, optional): Bin edges of the histograms, for all selectors or per
+                                                       selector name.
+            seed (int): Seed of the choice of the sample.
+        """
+        self.labels = labels
+        self.n_replicats = n_replicats
+        self.sample_size = sample_size
+        self.histogram_edges = histogram_edges
+        self.seed = seed
+        self.times = {}
+        self.stats = {}
+
+    @classmethod
+    def from_spec(cls, spec, labels, n_replicats):
+        """
+        Creates an aggregator from the `aggregate` argument of `SimManager.run`: True or a dict with "sample_size",
+        "histogram_edges" / "histogram_bins" + "histogram_range" and "seed".
+        """
+        spec = {} if spec is True else dict(spec)
+        if "histogram_bins" in spec:
+            low, high = spec.pop("histogram_range")
+            spec["histogram_edges"] = np.linspace(low, high, spec.pop("histogram_bins") + 1)
+        return cls(labels, n_replicats, **spec)
+
+    def _edges(self, name):
+        if isinstance(self.histogram_edges, dict):
+            return self.histogram_edges.get(name)
+        return self.histogram_edges
+
+    def add(self, name, times, rows):
+        """
+        Adds one replicate of a selector.
+
+        Args:
+            name (str): Selector name.
+            times (np.ndarray): (T,) save times, shorter for a replicate that stopped early.
+            rows (np.ndarray): (T, columns) values.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        rows = np.asarray(rows, dtype=np.float64).reshape(len(times), -1)
+        if name not in self.stats:
+            self.stats[name] = RunningStatistics((0, rows.shape[1]), self.n_replicats, self.sample_size, self.seed,
+                                                 self._edges(name))
+            self.times[name] = np.empty(0)
+        if len(times) > len(self.times[name]):
+            self.times[name] = times
+            self.stats[name].extend(len(times))
+        self.stats[name].update(rows[None])
+
+    def write(self, h5_path, uid, attrs=None, output_profile="legacy"):
+        """
+        Writes the aggregates to `h5_path` under `uid` with one group per selector. Other runs of an existing file
+        are kept, an existing group `uid` is replaced.
+
+        Every selector group holds "time", the accumulators "count", "mean", "m2", "min", "max", the derived "var"
+        and "std", optionally "histogram" (time, columns, bins) with "histogram_edges", and the raw sample as a
+        (sample, time, columns) "data" dataset (with the replicate ids in its "replicats" attribute), so that
+        `load_results` returns the sample like the replicates of an ensemble file.
+        """
+        from src.OutputProfiles import get_profile, codec_kwargs
+        options = codec_kwargs(get_profile(output_profile))
+        tmp_path = f"{h5_path}.{os.getpid()}.tmp"
+        with h5py.File(tmp_path, "w") as f:
+            group = f.create_group(uid)
+            group.attrs["format"] = AGGREGATE_FORMAT
+            group.attrs["replicats"] = self.n_replicats
+            for key, value in (attrs or {}).items():
+                group.attrs[key] = value if isinstance(value, str) else json.dumps(value, default=str)
+            for name, labels in self.labels.items():
+                sub = group.create_group(name)
+                sub.attrs["labels"] = json.dumps(list(labels))
+                if name not in self.stats:
+                    continue
+                stats = self.stats[name]
+                sub.create_dataset("time", data=self.times[name])
+                for key in _ACCUMULATORS:
+                    sub.create_dataset(key, data=getattr(stats, key), **options)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    var = np.where(stats.count > 1, stats.m2 / np.maximum(stats.count - 1, 1), np.nan)
+                sub.create_dataset("var", data=var, **options)
+                sub.create_dataset("std", data=np.sqrt(var), **options)
+                if stats.histogram is not None:
+                    sub.create_dataset("histogram", data=stats.histogram, **options)
+                    sub.create_dataset("histogram_edges", data=stats.histogram_edges)
+                data = sub.create_dataset("data", data=stats.sample, **options)
+                data.attrs["replicats"] = stats.sample_ids
+        if not os.path.isfile(h5_path):
+            os.replace(tmp_path, h5_path)
+            return
+        # the group is complete before it is copied in, so an interrupted write never leaves half a run behind
+        with h5py.File(tmp_path, "r") as source, h5py.File(h5_path, "a") as f:
+            if uid in f:
+                del f[uid]
+            source.copy(source[uid], f, name=uid)
+        os.remove(tmp_path)
+
+
+def is_aggregate(hdf_path, uid):
+    """
+    True if the run `uid` of `hdf_path` (without the .h5 suffix) was written by `ReplicateAggregator`.
+    """
+    with h5py.File(hdf_path + ".h5", "r") as f:
+        return uid in f and f[uid].attrs.get("format") == AGGREGATE_FORMAT
+
+
+def load_aggregates(hdf_path, uid, quantiles=(0.05, 0.5, 0.95), confidence=0.95):
+    """
+    Reads the aggregates of a run in the form of `Statistics.cached_statistics`: one dict per selector with "time",
+    "labels", "count", "mean", "var", "std", "sem", "ci_low"/"ci_high", "min", "max" and the quantiles of the raw
+    sample (NaN without a sample), plus "histogram"/"histogram_edges" if they were recorded.
+    """
+    from src.OutputProfiles import register_plugins
+    register_plugins()
+    all_stats = []
+    with h5py.File(hdf_path + ".h5", "r") as f:
+        group = f[uid]
+        for name in group:
+            sub = group[name]
+            if not isinstance(sub, h5py.Group) or "mean" not in sub:
+                continue
+            stats = RunningStatistics(sub["mean"].shape, 0, 0)
+            for key in _ACCUMULATORS:
+                setattr(stats, key, sub[key][()])
+            stats.sample = sub["data"][()]
+            if "histogram" in sub:
+                stats.histogram, stats.histogram_edges = sub["histogram"][()], sub["histogram_edges"][()]
+            all_stats.append(stats.result(quantiles, confidence)
+                             | {"time": sub["time"][()], "labels": json.loads(sub.attrs["labels"])})
+    return all_stats
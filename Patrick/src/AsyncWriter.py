@@ -0,0 +1,171 @@
+import json
+import os
+import queue
+import threading
+import time
+import h5py
+import numpy as np
+from src.Ensemble import ENSEMBLE_FORMAT
+from src.OutputProfiles import get_profile, codec_kwargs, apply_output_profile
+
+# marks the end of the queue
+_CLOSE = object()
+
+
+class AsyncResultWriter:
+    """
+    Writes result selector data on a background thread, so compression and HDF5 writes overlap with the solver.
+
+    The simulation thread hands new rows to a bounded queue (`put`), the writer thread appends them to the file.
+    If the writer falls behind, `put` blocks until there is space again (back-pressure), so memory stays bounded by
+    `max_queue` blocks of rows. Errors of the writer are raised on the simulation thread at the next `put` or at
+    `close`, and the file is always flushed and closed, also when the simulation fails.
+
+    The file has the layout of `run_ensemble` (one group per selector with "time" and a (replicates, time, columns)
+    "data" dataset under `uid`), so `load_results` and `plot.py` read it directly.
+
+    Usage:
+        with AsyncResultWriter(path + ".h5", "run", labels, parameters) as writer:
+            writer.put(name, replicate, start_row, times, rows)
+    """
+
+    def __init__(self, h5_path, uid, labels, attrs=None, output_profile="legacy", max_queue=8, resume=False):
+        """
+        Args:
+            h5_path (str): Output file (with suffix), replaced if it exists.
+            uid (str): Group the results are stored under, like the run name of `toDB`.
+            labels (dict): Selector name -> list of column labels.
+            attrs (dict, optional): Attributes of the run group (values that are not strings are stored as JSON).
+            output_profile (str or dict): Codec of the datasets, non-legacy profiles are applied to the whole file
+                                          once it is complete, see `src/OutputProfiles.py`.
+            max_queue (int): Number of blocks the queue holds before `put` blocks.
+            resume (bool): Continue writing into an existing file (after a restart from a checkpoint) instead of
+                           replacing it.
+        """
+        self.h5_path = h5_path
+        self.uid = uid
+        self.labels = labels
+        self.attrs = attrs or {}
+        self.profile = get_profile(output_profile)
+        self.resume = resume
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.blocked_seconds = 0.0  # time the simulation thread waited for the writer
+        self.written_rows = 0
+        self._thread = None
+        self._file = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+        return False
+
+    def start(self):
+        if self.resume and os.path.isfile(self.h5_path):
+            self._file = h5py.File(self.h5_path, "a")
+            if self.uid in self._file:
+                self._start_thread()
+                return
+        else:
+            self._file = h5py.File(self.h5_path, "w")
+        group = self._file.create_group(self.uid)
+        group.attrs["format"] = ENSEMBLE_FORMAT
+        for key, value in self.attrs.items():
+            group.attrs[key] = value if isinstance(value, str) else json.dumps(value, default=str)
+        for name, labels in self.labels.items():
+            sub = group.create_group(name)
+            sub.attrs["labels"] = json.dumps(list(labels))
+            sub.create_dataset("time", shape=(0,), maxshape=(None,), dtype=np.float64)
+            sub.create_dataset("data", shape=(0, 0, len(labels)), maxshape=(None, None, len(labels)),
+                               dtype=np.float64, chunks=(1, 256, len(labels)), fillvalue=np.nan,
+                               **codec_kwargs(self.profile)) # NaN where a replicate stopped early
+        self._start_thread()
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._write_loop, name="AsyncResultWriter", daemon=True)
+        self._thread.start()
+
+    def put(self, name, replicate, start_row, times, rows):
+        """
+        Queues rows of a selector for writing, blocks while the queue is full.
+
+        Args:
+            name (str): Selector name.
+            replicate (int): Replicate the rows belong to.
+            start_row (int): Time index of the first row.
+            times (np.ndarray): (n,) save times of the rows.
+            rows (np.ndarray): (n, columns) values, copied before they are queued.
+        """
+        self._raise_writer_error()
+        block = (name, replicate, start_row, np.array(times, dtype=np.float64),
+                 np.array(rows, dtype=np.float64).reshape(len(times), -1))
+        start_time = time.perf_counter()
+        while True:
+            try:
+                self.queue.put(block, timeout=1)
+                break
+            except queue.Full:
+                self._raise_writer_error()  # a dead writer would never make space again
+        self.blocked_seconds += time.perf_counter() - start_time
+
+    def flush(self):
+        """
+        Blocks until everything queued so far is written and flushed to disk, e.g. before a checkpoint.
+        """
+        self.queue.join()
+        self._raise_writer_error()
+        self._file.flush()
+
+    def close(self, raise_errors=True):
+        """
+        Waits until everything queued is written, closes the file and applies the output profile.
+        """
+        if self._thread is not None:
+            while self._thread.is_alive():
+                try:
+                    self.queue.put(_CLOSE, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if self.error is None and self.profile != get_profile("legacy"):
+                apply_output_profile(self.h5_path, self.profile)
+        if raise_errors:
+            self._raise_writer_error()
+
+    def _raise_writer_error(self):
+        if self.error is not None:
+            raise RuntimeError(f"The result writer failed: {self.error!r}") from self.error
+
+    def _write_loop(self):
+        group = self._file[self.uid]
+        while True:
+            block = self.queue.get()
+            if block is _CLOSE:
+                self.queue.task_done()
+                break
+            if self.error is None:  # after an error keep draining, so that put never blocks forever
+                try:
+                    self._write(group, *block)
+                except Exception as error:
+                    self.error = error
+            self.queue.task_done()
+        self._file.flush()
+
+    def _write(self, group, name, replicate, start_row, times, rows):
+        data, time_points = group[name]["data"], group[name]["time"]
+        end_row = start_row + len(times)
+        if replicate >= data.shape[0] or end_row > data.shape[1]:
+            data.resize((max(data.shape[0], replicate + 1), max(data.shape[1], end_row), data.shape[2]))
+        if end_row > time_points.shape[0]:  # every replicate is saved at the same time points
+            time_points.resize((end_row,))
+            time_points[start_row:end_row] = times
+        data[replicate, start_row:end_row] = rows
+        self.written_rows += len(times)
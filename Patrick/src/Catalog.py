@@ -0,0 +1,391 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+import h5py
+import numpy as np
+from src.Aggregation import AGGREGATE_FORMAT
+from src.Ensemble import ENSEMBLE_FORMAT
+from src.ModelCache import file_hash
+from src.OutputProfiles import decode, register_plugins
+
+CATALOG_VERSION = 1
+
+# run group formats written by this repo, everything else is the STEPS layout
+_LAYOUTS = {ENSEMBLE_FORMAT: "ensemble", AGGREGATE_FORMAT: "aggregate"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,
+    uid TEXT NOT NULL,
+    layout TEXT NOT NULL,
+    parameters TEXT,
+    mesh_path TEXT,
+    mesh_fingerprint TEXT,
+    model_type TEXT,
+    solver TEXT,
+    replicats INTEGER,
+    n_time INTEGER,
+    t_start REAL,
+    t_end REAL,
+    dt REAL,
+    species TEXT,
+    UNIQUE (path, uid)
+);
+CREATE TABLE IF NOT EXISTS selectors (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    time_dataset TEXT,
+    labels TEXT,
+    shape TEXT,
+    dtype TEXT,
+    file_offset INTEGER
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    number REAL,
+    text TEXT
+);
+CREATE TABLE IF NOT EXISTS meshes (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS parameters_key ON parameters (key, number);
+CREATE INDEX IF NOT EXISTS selectors_run ON selectors (run_id);
+"""
+
+
+def default_catalog_path(root):
+    return os.path.join(root, "catalog.sqlite")
+
+
+def _species_of(label):
+    """
+    "rs.TETS(...).ERKpp.Count" -> "ERKpp", the same rule plot.py uses.
+    """
+    parts = str(label).split(".")
+    return parts[-2] if len(parts) >= 2 else str(label)
+
+
+def _labels(group):
+    labels = group.attrs.get("labels")
+    if labels is not None:
+        return json.loads(labels) if isinstance(labels, str) else [str(label) for label in labels]
+    if "labels" in group and isinstance(group["labels"], h5py.Dataset):
+        return [label.decode() if isinstance(label, bytes) else str(label) for label in group["labels"][()]]
+    return []
+
+
+def _attr(group, key):
+    value = group.attrs.get(key)
+    if isinstance(value, bytes):
+        value = value.decode()
+    return None if value is None else str(value)
+
+
+def _find_selectors(group):
+    """
+    All result selectors below a run group: every group that holds a 3D "data" dataset next to a "time" dataset.
+    """
+    found = []
+
+    def visit(name, item):
+        if isinstance(item, h5py.Group) and isinstance(item.get("data"), h5py.Dataset) \
+                and item["data"].ndim == 3:
+            found.append((name, item))
+    group.visititems(visit)
+    return found
+
+
+def scan_file(path):
+    """
+    Reads the metadata of all runs in a result file (STEPS, ensemble or aggregate layout) without reading the data.
+
+    Returns:
+        list: One dict per run group.
+    """
+    register_plugins()
+    runs = []
+    with h5py.File(path, "r") as f:
+        for uid, group in f.items():
+            if not isinstance(group, h5py.Group):
+                continue
+            selectors = _find_selectors(group)
+            if not selectors:
+                continue
+            entry = {"uid": uid,
+                     "layout": _LAYOUTS.get(_attr(group, "format"), "steps"),
+                     "parameters": _attr(group, "parameters"),
+                     "mesh_path": _attr(group, "mesh_path"),
+                     "mesh_scale": _attr(group, "mesh_scale"),
+                     "model_type": _attr(group, "model_type"),
+                     "solver": _attr(group, "solver"),
+                     "selectors": []}
+            time_points = None
+            for name, sel in selectors:
+                data = sel["data"]
+                labels = _labels(sel)
+                time_dataset = sel.get("time")
+                if time_points is None and isinstance(time_dataset, h5py.Dataset) and time_dataset.size:
+                    time_points = np.asarray(time_dataset[0] if time_dataset.ndim == 2 else time_dataset[()])
+                entry["selectors"].append({
+                    "name": name,
+                    "dataset": data.name,
+                    "time_dataset": time_dataset.name if isinstance(time_dataset, h5py.Dataset) else None,
+                    "labels": labels,
+                    "shape": list(data.shape),
+                    "dtype": str(decode(data).dtype),
+                    "file_offset": data.id.get_offset()})  # None for chunked datasets
+            entry["replicats"] = int(group.attrs["replicats"]) if "replicats" in group.attrs \
+                else max(sel["shape"][0] for sel in entry["selectors"])  # aggregates only store a sample
+            if time_points is not None and len(time_points):
+                steps = np.diff(time_points)
+                entry.update(n_time=len(time_points), t_start=float(time_points[0]), t_end=float(time_points[-1]),
+                             dt=float(steps[0]) if len(steps) and np.allclose(steps, steps[0]) else None)
+            entry["species"] = sorted({_species_of(label) for sel in entry["selectors"] for label in sel["labels"]})
+            runs.append(entry)
+    return runs
+
+
+class Catalog:
+    """
+    Index of all result files below a directory (e.g. Patrick/saved_objects) in a small SQLite database.
+
+    For every run group it records the uid, the parameters (also per key, for queries), the mesh and its
+    fingerprint, model type, solver, number of replicates, the time grid, the species and, for every result
+    selector, the dataset path, labels, shape, dtype and byte offset in the file. Files are only re-read when their
+    modification time or size changed and their content hash differs from the indexed one.
+
+    Usage:
+        catalog = Catalog(f"{base_path}Patrick/saved_objects")
+        catalog.update()
+        for run in catalog.query(species="ERKpp", parameters={"DC": 4e-12, "k[0]": (1e7, 1e9)}):
+            data = run.selector("ERKpp").data  # opens only this file
+    """
+
+    def __init__(self, root, path=None):
+        """
+        Args:
+            root (str): Directory that is indexed.
+            path (str, optional): Database file, defaults to `root/catalog.sqlite`.
+        """
+        self.root = root
+        self.path = path or default_catalog_path(root)
+        with closing(self._connect()) as connection:
+            connection.executescript(_SCHEMA)
+            connection.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.execute("PRAGMA foreign_keys = ON")
+        return connection
+
+    def _mesh_fingerprint(self, connection, mesh_path, mesh_scale):
+        """
+        The `CachedMesh.fingerprint` of the mesh of a run, with the mesh hashes cached by mtime.
+        """
+        if not mesh_path or not os.path.isfile(mesh_path):
+            return None
+        mtime = os.path.getmtime(mesh_path)
+        row = connection.execute("SELECT mtime, sha256 FROM meshes WHERE path = ?", (mesh_path,)).fetchone()
+        if row is not None and row[0] == mtime:
+            digest = row[1]
+        else:
+            digest = file_hash(mesh_path)
+            connection.execute("INSERT OR REPLACE INTO meshes (path, mtime, sha256) VALUES (?, ?, ?)",
+                               (mesh_path, mtime, digest))
+        scale = mesh_scale if mesh_scale is not None else "1"
+        return f"{digest[:16]}_s{scale}"
+
+    def update(self, verbose=True):
+        """
+        Indexes new and changed .h5 files below the root and removes files that no longer exist.
+
+        Returns:
+            dict: Number of "indexed", "unchanged" and "removed" files.
+        """
+        counts = {"indexed": 0, "unchanged": 0, "removed": 0}
+        present = set()
+        with closing(self._connect()) as connection:
+            known = {path: (mtime, size, digest) for path, mtime, size, digest in
+                     connection.execute("SELECT path, mtime, size, sha256 FROM files")}
+            for directory, _, filenames in os.walk(self.root):
+                for filename in sorted(filenames):
+                    if not filename.endswith(".h5"):
+                        continue
+                    path = os.path.abspath(os.path.join(directory, filename))
+                    present.add(path)
+                    stat = os.stat(path)
+                    if path in known and known[path][:2] == (stat.st_mtime, stat.st_size):
+                        counts["unchanged"] += 1
+                        continue
+                    digest = file_hash(path)
+                    if path in known and known[path][2] == digest:  # touched, but the same content
+                        connection.execute("UPDATE files SET mtime = ? WHERE path = ?", (stat.st_mtime, path))
+                        counts["unchanged"] += 1
+                        continue
+                    try:
+                        runs = scan_file(path)
+                    except OSError as error:  # e.g. a file that is still being written
+                        if verbose:
+                            print(f"Skipping {path}: {error}")
+                        continue
+                    self._store(connection, path, stat, digest, runs)
+                    counts["indexed"] += 1
+            for path in set(known) - present:
+                connection.execute("DELETE FROM files WHERE path = ?", (path,))
+                counts["removed"] += 1
+            connection.commit()
+        if verbose:
+            print(f"Catalog {self.path}: {counts}")
+        return counts
+
+    def _store(self, connection, path, stat, digest, runs):
+        connection.execute("DELETE FROM files WHERE path = ?", (path,))  # cascades to runs, selectors, parameters
+        connection.execute("INSERT INTO files (path, mtime, size, sha256, indexed_at) VALUES (?, ?, ?, ?, ?)",
+                           (path, stat.st_mtime, stat.st_size, digest, time.time()))
+        for run in runs:
+            cursor = connection.execute(
+                "INSERT INTO runs (path, uid, layout, parameters, mesh_path, mesh_fingerprint, model_type, solver, "
+                "replicats, n_time, t_start, t_end, dt, species) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, run["uid"], run["layout"], run["parameters"], run["mesh_path"],
+                 self._mesh_fingerprint(connection, run["mesh_path"], run["mesh_scale"]), run["model_type"],
+                 run["solver"], run["replicats"], run.get("n_time"), run.get("t_start"), run.get("t_end"),
+                 run.get("dt"), json.dumps(run["species"])))
+            run_id = cursor.lastrowid
+            connection.executemany(
+                "INSERT INTO selectors (run_id, name, dataset, time_dataset, labels, shape, dtype, file_offset) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, sel["name"], sel["dataset"], sel["time_dataset"], json.dumps(sel["labels"]),
+                  json.dumps(sel["shape"]), sel["dtype"], sel["file_offset"]) for sel in run["selectors"]])
+            parameters = json.loads(run["parameters"]) if run["parameters"] else {}
+            connection.executemany(
+                "INSERT INTO parameters (run_id, key, number, text) VALUES (?, ?, ?, ?)",
+                [(run_id, key, float(value) if isinstance(value, (int, float)) else None, str(value))
+                 for key, value in parameters.items()])
+
+    def query(self, uid=None, species=None, mesh_fingerprint=None, mesh_path=None, solver=None, model_type=None,
+              parameters=None):
+        """
+        Finds runs in the catalog, only the database is read.
+
+        Args:
+            uid, mesh_fingerprint, mesh_path, solver, model_type (str, optional): Exact matches.
+            species (str, optional): Runs that saved this species.
+            parameters (dict, optional): Parameter key -> value (numbers are compared with a relative tolerance of
+                                         1e-9) or (low, high) range, e.g. {"DC": 4e-12, "k[0]": (1e7, 1e9)}.
+
+        Returns:
+            list: `CatalogRun` handles.
+        """
+        conditions, values = [], []
+        for column, value in (("uid", uid), ("mesh_fingerprint", mesh_fingerprint), ("mesh_path", mesh_path),
+                              ("solver", solver), ("model_type", model_type)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                values.append(value)
+        if species is not None:
+            conditions.append("EXISTS (SELECT 1 FROM json_each(runs.species) WHERE json_each.value = ?)")
+            values.append(species)
+        for key, value in (parameters or {}).items():
+            if isinstance(value, (tuple, list)):
+                conditions.append("run_id IN (SELECT run_id FROM parameters WHERE key = ? AND number BETWEEN ? AND ?)")
+                values += [key, value[0], value[1]]
+            elif isinstance(value, (int, float)):
+                conditions.append("run_id IN (SELECT run_id FROM parameters WHERE key = ? "
+                                  "AND ABS(number - ?) <= 1e-9 * ABS(?))")
+                values += [key, value, value]
+            else:
+                conditions.append("run_id IN (SELECT run_id FROM parameters WHERE key = ? AND text = ?)")
+                values += [key, str(value)]
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with closing(self._connect()) as connection:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute(f"SELECT * FROM runs{where} ORDER BY path, uid", values).fetchall()
+            selectors = {}
+            for row in rows:
+                selectors[row["run_id"]] = [dict(sel) for sel in connection.execute(
+                    "SELECT * FROM selectors WHERE run_id = ?", (row["run_id"],))]
+        return [CatalogRun(dict(row), selectors[row["run_id"]]) for row in rows]
+
+
+class CatalogRun:
+    """
+    A run found in the catalog. The metadata comes from the database, the file is only opened when data is
+    accessed.
+    """
+
+    def __init__(self, row, selectors):
+        self.path = row["path"]
+        self.uid = row["uid"]
+        self.layout = row["layout"]
+        self.parameters = json.loads(row["parameters"]) if row["parameters"] else {}
+        self.mesh_path = row["mesh_path"]
+        self.mesh_fingerprint = row["mesh_fingerprint"]
+        self.model_type = row["model_type"]
+        self.solver = row["solver"]
+        self.replicats = row["replicats"]
+        self.n_time = row["n_time"]
+        self.t_start, self.t_end, self.dt = row["t_start"], row["t_end"], row["dt"]
+        self.species = json.loads(row["species"])
+        self.selectors = selectors
+        for sel in self.selectors:
+            sel["labels"] = json.loads(sel["labels"])
+            sel["shape"] = json.loads(sel["shape"])
+        self._file = None
+
+    def __repr__(self):
+        return f"CatalogRun({self.path!r}, uid={self.uid!r}, replicats={self.replicats}, species={self.species})"
+
+    def _open(self):
+        if self._file is None:
+            register_plugins()
+            self._file = h5py.File(self.path, "r")
+        return self._file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def selector(self, species_or_name):
+        """
+        The first result selector whose name is `species_or_name` or that saved this species, as a
+        `CatalogSelector` with `data` (h5py dataset, read lazily), `time` and `labels` like `load_results`.
+        """
+        for sel in self.selectors:
+            if sel["name"] == species_or_name or species_or_name in [_species_of(label) for label in sel["labels"]]:
+                return CatalogSelector(self._open(), sel)
+        raise KeyError(f"No selector with '{species_or_name}' in {self}.")
+
+    def results(self):
+        """
+        All result selectors of the run, like `load_results(path, uid)` but without going through STEPS.
+        """
+        return [CatalogSelector(self._open(), sel) for sel in self.selectors]
+
+
+class CatalogSelector:
+    def __init__(self, file, sel):
+        self.name = sel["name"]
+        self.labels = sel["labels"]
+        self.data = decode(file[sel["dataset"]])
+        self._time = file[sel["time_dataset"]][()] if sel["time_dataset"] else None
+
+    @property
+    def time(self):
+        if self._time is None or self._time.ndim == 2:
+            return self._time
+        return np.broadcast_to(self._time, (self.data.shape[0], len(self._time)))
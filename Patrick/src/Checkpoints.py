@@ -0,0 +1,57 @@
+import json
+import os
+
+# manifest of the last consistent checkpoint, next to the checkpoint files
+MANIFEST = "manifest.json"
+
+
+def checkpoint_dir(save_path):
+    return f"{save_path}_checkpoints"
+
+
+def checkpoint_file(directory, slot):
+    """
+    Solver checkpoints alternate between two slots, so that a job killed while it writes one still has the other.
+    TetOpSplit adds the rank to the name, every rank writes its own part.
+    """
+    return os.path.join(directory, f"solver_{slot}.cp")
+
+
+def read_manifest(directory):
+    """
+    Returns the manifest of the latest consistent checkpoint in `directory`, or None if there is none.
+    """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    """
+    Replaces the manifest atomically. It is only written after the solver checkpoint and the results it refers to
+    are complete on disk, so it always describes a state the run can continue from.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, MANIFEST)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def check_resumable(manifest, runname, solver, n_ranks, replicats):
+    """
+    Raises an AssertionError if a manifest was written by a different run setup.
+    """
+    assert manifest["runname"] == runname, \
+        f"The checkpoint belongs to run '{manifest['runname']}', not '{runname}'."
+    assert manifest["solver"] == solver, \
+        f"The checkpoint was written by {manifest['solver']}, the loaded model uses {solver}."
+    assert manifest["n_ranks"] == n_ranks, \
+        f"The checkpoint was written on {manifest['n_ranks']} ranks, resume it on the same number (not {n_ranks})."
+    assert manifest["replicats"] == replicats, \
+        f"The checkpointed run has {manifest['replicats']} replicats, not {replicats}."
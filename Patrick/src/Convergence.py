@@ -0,0 +1,126 @@
+import json
+import os
+import numpy as np
+
+STATISTICS = ("range", "slope", "cv")
+
+
+class SteadyStateMonitor:
+    """
+    Decides when a replicate has reached its steady state, so that it can stop before the endtime.
+
+    The observables are read from the simulation itself every `check_interval` simulated seconds (so it works with
+    every solver and output path), e.g. "nuc.ERKpp" is `sim.nuc.ERKpp.Count`. A replicate is at steady state once,
+    for every observable, the statistic over the last `window` seconds stays within `tolerance`:
+
+    - "range": (max - min) / scale
+    - "slope": |least squares slope| * window / scale, i.e. the drift over the window, robust against noise
+    - "cv": standard deviation / scale
+
+    where scale is |mean| (or 1 if not `relative`), but at least `floor`, so species with a handful of molecules do
+    not keep the run going.
+    """
+
+    def __init__(self, observables, window, tolerance=0.01, statistic="range", relative=True, floor=1.0,
+                 check_interval=None, min_time=0.0):
+        """
+        Args:
+            observables (list): "location.Species" paths, e.g. ["nuc.ERKpp", "cell_surface.EGF_EGFRp2_GAP"].
+            window (float): Length of the window in simulated seconds.
+            tolerance (float): Largest statistic that counts as steady.
+            statistic (str): One of `STATISTICS`.
+            relative (bool): Relative to the window mean (default) or in molecules.
+            floor (float): Smallest scale of the relative statistic, in molecules.
+            check_interval (float, optional): Simulated time between two checks, defaults to window / 10.
+            min_time (float): Never stop before this time.
+        """
+        assert statistic in STATISTICS, f"Unknown statistic '{statistic}', use one of {STATISTICS}."
+        self.observables = list(observables)
+        self.window = window
+        self.tolerance = tolerance
+        self.statistic = statistic
+        self.relative = relative
+        self.floor = floor
+        self.check_interval = check_interval or window / 10
+        self.min_time = min_time
+        self.reset()
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Creates a monitor from a dict of the constructor arguments (or returns a monitor unchanged).
+        """
+        return spec if isinstance(spec, cls) else cls(**spec)
+
+    def settings(self):
+        return {"observables": self.observables, "window": self.window, "tolerance": self.tolerance,
+                "statistic": self.statistic, "relative": self.relative, "floor": self.floor,
+                "check_interval": self.check_interval, "min_time": self.min_time}
+
+    def reset(self):
+        self.times = []
+        self.values = []
+
+    def read(self, simulation):
+        values = []
+        for path in self.observables:
+            location, species = path.split(".")
+            values.append(getattr(getattr(simulation, location), species).Count)
+        return np.asarray(values, dtype=np.float64)
+
+    def statistic_values(self):
+        """
+        The statistic of every observable over the current window.
+        """
+        times = np.asarray(self.times)
+        values = np.asarray(self.values)
+        scale = np.maximum(np.abs(values.mean(axis=0)) if self.relative else 1.0, self.floor)
+        if self.statistic == "range":
+            spread = values.max(axis=0) - values.min(axis=0)
+        elif self.statistic == "slope":
+            centered = times - times.mean()
+            slope = centered @ (values - values.mean(axis=0)) / max(centered @ centered, np.finfo(float).tiny)
+            spread = np.abs(slope) * self.window
+        else:
+            spread = values.std(axis=0)
+        return spread / scale
+
+    def update(self, simulation, t):
+        """
+        Records the observables at time t and returns True once the replicate is at steady state.
+        """
+        self.times.append(float(t))
+        self.values.append(self.read(simulation))
+        # keep the newest sample at or before t - window, so the window is covered whether or not the check
+        # interval divides it
+        while len(self.times) > 1 and self.times[1] <= t - self.window + 1e-12:
+            self.times.pop(0)
+            self.values.pop(0)
+        if t < self.min_time or len(self.times) < 3 or self.times[-1] - self.times[0] < self.window - 1e-12:
+            return False
+        return bool(np.all(self.statistic_values() <= self.tolerance))
+
+
+def write_stop_times(save_path, runname, monitor, stop_times, endtime):
+    """
+    Records when every replicate stopped, in `save_path + "_steady_state.json"` (one entry per run name) and, if the
+    output file has a group of the run, in its "steady_state" attribute.
+    """
+    record = {"settings": monitor.settings(), "endtime": endtime, "stop_times": stop_times,
+              "converged": [t < endtime for t in stop_times]}
+    sidecar = f"{save_path}_steady_state.json"
+    records = {}
+    if os.path.isfile(sidecar):
+        with open(sidecar) as f:
+            records = json.load(f)
+    records[runname] = record
+    tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(records, f, indent=2)
+    os.replace(tmp_path, sidecar)
+
+    if os.path.isfile(save_path + ".h5"):
+        import h5py
+        with h5py.File(save_path + ".h5", "a") as f:
+            if runname in f:
+                f[runname].attrs["steady_state"] = json.dumps(record)
@@ -0,0 +1,206 @@
+import json
+import os
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import h5py
+import numpy as np
+from src.OutputProfiles import get_profile, codec_kwargs, apply_output_profile, decode, register_plugins
+from src.Aggregation import AGGREGATE_FORMAT
+
+# marks files written by run_ensemble, used by load_results to tell them apart from STEPS' own HDF5 layout
+ENSEMBLE_FORMAT = "steps_cell_signaling.ensemble.v1"
+
+
+def _run_ensemble_worker(task):
+    """
+    Runs a share of the replicates in a fresh process with its own serial solver and returns the in-memory results.
+
+    This is executed in a spawned worker process, so everything (STEPS, the model, the mesh) is set up from scratch.
+    """
+    from src.SimManager import SimManager
+
+    start_time = time.time()
+    sm = SimManager(parameters=task["parameters"],
+                    mesh_path=task["mesh_path"],
+                    save_path=task["save_path"],
+                    runname=task["runname"],
+                    plot_only_run=False,
+                    replace=False)
+    sm.load_model(type=task["model_type"], seed=task["seed"], **task["load_model_kwargs"])
+    setup_time = time.time() - start_time
+
+    # no output handler attached, the result selectors keep their data in memory
+    for i in range(task["n_replicats"]):
+        sm._run_replicate(i)
+
+    selectors = {}
+    for name, sel in sm.saved_selectors.items():
+        selectors[name] = {"labels": list(sel.labels),
+                           "time": np.asarray(sel.time[0]),
+                           "data": np.asarray(sel.data)}
+    return {"worker": task["worker"], "seed": task["seed"], "setup": setup_time,
+            "timings": sm.replicate_timings, "selectors": selectors}
+
+
+def run_ensemble(parameters, mesh_path, save_path, replicats, model_type="small", runname="ensemble",
+                 n_workers=None, seed=None, output_profile="legacy", **load_model_kwargs):
+    """
+    Runs independent replicates of a model in a local process pool, one serial solver per worker.
+
+    The replicates are split evenly over the workers. Every worker gets its own seed, derived from `seed` with
+    `np.random.SeedSequence`, so the ensemble is reproducible but the workers never share a random stream.
+    The results are merged into `save_path + ".h5"` as one dataset per result selector with a leading replicate
+    axis, (replicats, time, columns), which `load_results` (and therefore `plot.py`) reads directly.
+
+    Args:
+        parameters (dict): Simulation parameters, see `parameters.py`.
+        mesh_path (str): Path to the .inp mesh.
+        save_path (str): Output file without the .h5 suffix.
+        replicats (int): Total number of replicates.
+        model_type (str): Passed to `SimManager.load_model`.
+        runname (str): Name of the group the results are stored under.
+        n_workers (int, optional): Number of worker processes, defaults to the number of CPUs.
+        seed (int, optional): Root seed of the ensemble. If None, fresh entropy from the OS is used.
+        output_profile (str or dict): Dtype, chunks and codec of the merged file, see `src/OutputProfiles.py`
+                                      ("delta" stores the counts as differences along time, `load_results` decodes
+                                      them).
+        **load_model_kwargs: Further keyword arguments for `SimManager.load_model`. The solver defaults to
+                             Tetexact, distributed solvers (TetOpSplit) are refused.
+
+    Returns:
+        str: Path of the merged HDF5 file.
+
+    Notes:
+        - Must not be started under mpirun with more than one rank, every worker is a serial simulation.
+        - Workers are started with the "spawn" method so that they do not inherit an initialized MPI/STEPS state.
+    """
+    from mpi4py import MPI
+    assert MPI.COMM_WORLD.Get_size() == 1, "run_ensemble starts its own worker processes, run it without mpirun."
+    assert replicats >= 1, f"run_ensemble needs at least one replicat, got {replicats}."
+    from src.Solvers import SOLVERS, check_solver
+    load_model_kwargs = dict(load_model_kwargs)
+    load_model_kwargs.setdefault("solver", "Tetexact")  # one serial solver per worker, not the default TetOpSplit
+    check_solver(load_model_kwargs["solver"])
+    assert not SOLVERS[load_model_kwargs["solver"]]["parallel"], \
+        f"Every worker of run_ensemble runs a serial simulation, {load_model_kwargs['solver']} is distributed."
+
+    n_workers = min(n_workers or os.cpu_count(), replicats)
+    seed_sequence = np.random.SeedSequence(seed)
+    worker_seeds = [int(s.generate_state(1)[0] % (2**31 - 1)) + 1 for s in seed_sequence.spawn(n_workers)]
+    shares = [len(share) for share in np.array_split(np.arange(replicats), n_workers)]
+
+    tasks = [{"worker": w, "seed": worker_seeds[w], "n_replicats": shares[w], "parameters": parameters,
+              "mesh_path": mesh_path, "save_path": f"{save_path}_worker_{w}", "runname": runname,
+              "model_type": model_type, "load_model_kwargs": load_model_kwargs} for w in range(n_workers)]
+
+    output_file = save_path + ".h5"
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    start_time = time.time()
+    with h5py.File(output_file, "w") as f, \
+            ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context("spawn")) as pool:
+        group = f.create_group(runname)
+        group.attrs["format"] = ENSEMBLE_FORMAT
+        group.attrs["parameters"] = json.dumps(parameters, default=str)
+        group.attrs["mesh_path"] = mesh_path
+        group.attrs["model_type"] = model_type
+        group.attrs["root_seed"] = str(seed_sequence.entropy)
+        replicate_worker = group.create_dataset("replicate_worker", (replicats,), dtype=np.int32)
+        replicate_seed = group.create_dataset("replicate_seed", (replicats,), dtype=np.int64)
+
+        # write every share as soon as its worker is done, so the parent never holds the full ensemble
+        offset = 0
+        futures = [pool.submit(_run_ensemble_worker, task) for task in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            n = shares[result["worker"]]
+            for name, sel in result["selectors"].items():
+                if name not in group:
+                    sub = group.create_group(name)
+                    sub.create_dataset("time", data=sel["time"])
+                    sub.create_dataset("data", shape=(replicats,) + sel["data"].shape[1:], dtype=sel["data"].dtype,
+                                       chunks=(1,) + sel["data"].shape[1:], **codec_kwargs("legacy"))
+                    sub.attrs["labels"] = json.dumps(sel["labels"])
+                group[name]["data"][offset:offset + n] = sel["data"]
+            replicate_worker[offset:offset + n] = result["worker"]
+            replicate_seed[offset:offset + n] = result["seed"]
+            offset += n
+            print(f"Worker {result['worker']} finished {n} replicats (setup {result['setup']:.2f} seconds).")
+    if get_profile(output_profile) != get_profile("legacy"):
+        # the dtype can only be chosen once all replicates are known
+        stats = apply_output_profile(output_file, output_profile)
+        print(f"Output profile: {stats['bytes_before'] / 2**20:.2f} MB -> {stats['bytes_after'] / 2**20:.2f} MB")
+    print(f"Ensemble of {replicats} replicats completed in {time.time() - start_time:.2f} seconds")
+    return output_file
+
+
+class EnsembleResult:
+    """
+    One result selector of an ensemble file, with the same access pattern as the results of `stsave.HDF5Handler`:
+    `data[replicate, time, column]`, `time[replicate]` and `labels`.
+    """
+
+    def __init__(self, name, group):
+        self.name = name
+        self.data = decode(group["data"])  # h5py dataset, only the slices that are accessed are read
+        self._time = group["time"][()]
+        self.labels = json.loads(group.attrs["labels"])
+
+    @property
+    def time(self):
+        return np.broadcast_to(self._time, (self.data.shape[0], len(self._time)))
+
+
+class Results(list):
+    """
+    The result selectors of a run, a list like `HDF5Handler(path)[uid].results`, that keeps the file open until
+    `close()` is called, the `with` block ends or the list is discarded.
+    """
+
+    def __init__(self, results, close):
+        super().__init__(results)
+        self._close = close
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __del__(self):
+        self.close()
+
+
+def load_results(hdf_path, uid):
+    """
+    Returns the list of results stored under `uid`, either from an ensemble file written by `run_ensemble` or from a
+    regular STEPS HDF5 file. For a run written with `SimManager.run(aggregate=...)` these are the sampled raw
+    replicates, the statistics over all replicates are read with `cached_statistics`.
+
+    Args:
+        hdf_path (str): Path of the file without the .h5 suffix, like for `stsave.HDF5Handler`.
+        uid (str): Run name the results were saved under.
+
+    Returns:
+        Results: The list of results, close it (or use `with load_results(...) as results:`) when done.
+    """
+    register_plugins() # files written with the "blosc" output profile need the hdf5plugin filters
+    with h5py.File(hdf_path + ".h5", "r") as f:
+        is_ensemble = uid in f and f[uid].attrs.get("format") in (ENSEMBLE_FORMAT, AGGREGATE_FORMAT)
+
+    if is_ensemble:
+        f = h5py.File(hdf_path + ".h5", "r")  # the datasets are read lazily, the file stays open until close()
+        group = f[uid]
+        return Results([EnsembleResult(name, group[name]) for name in group
+                        if isinstance(group[name], h5py.Group) and "data" in group[name]], f.close)
+
+    import steps.interface
+    import steps.saving as stsave
+    handler = stsave.HDF5Handler(hdf_path)
+    return Results(handler[uid].results, lambda: handler.__exit__(None, None, None))
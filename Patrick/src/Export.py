@@ -0,0 +1,158 @@
+import json
+import os
+import h5py
+import numpy as np
+from src.Ensemble import load_results
+from src.Statistics import BLOCK_BYTES
+
+FORMATS = ("parquet", "arrow")
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError as error:
+        raise ImportError("The Parquet/Arrow export needs pyarrow (pip install pyarrow).") from error
+
+
+def split_label(label):
+    """
+    "rs.TETS(...).ERKpp.Count" -> ("TETS(...)", "ERKpp"), "cyt.ERKpp.Count" -> ("cyt", "ERKpp"): the compartment
+    (or the tets/tris the selector covers) and the species, by the same rule as plot.py.
+    """
+    parts = str(label).split(".")
+    if len(parts) < 2:
+        return "", str(label)
+    location = [part for part in parts[:-2] if part != "rs"]
+    return ".".join(location), parts[-2]
+
+
+def export_schema(metadata=None):
+    """
+    The tidy schema of the export: one row per (run, replicate, time, species, compartment). Run, species and
+    compartment are dictionary encoded, so repeating them costs almost nothing.
+    """
+    pa = _pyarrow()
+    text = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([("run", text), ("replicate", pa.int32()), ("time", pa.float64()), ("species", text),
+                      ("compartment", text), ("value", pa.float64())],
+                     metadata={key: str(value) for key, value in (metadata or {}).items()})
+
+
+def run_metadata(hdf_path, uid):
+    """
+    The attributes of the run group (parameters, mesh, solver, ... see `SimManager.run_metadata`) as strings.
+    """
+    with h5py.File(hdf_path + ".h5", "r") as f:
+        if uid not in f:
+            return {}
+        return {key: value.decode() if isinstance(value, bytes) else
+                value if isinstance(value, str) else json.dumps(np.asarray(value).tolist())
+                for key, value in f[uid].attrs.items()}
+
+
+def _batches(uid, res, block_bytes):
+    """
+    Record batches of one result selector, a block of replicates at a time (aligned to the chunks of the dataset).
+    """
+    pa = _pyarrow()
+    n_replicats, n_time, n_columns = res.data.shape
+    locations, species = zip(*[split_label(label) for label in res.labels]) if n_columns else ((), ())
+    rows = max(block_bytes // max(n_time * n_columns * 8, 1), 1)
+    chunks = getattr(res.data, "chunks", None) or getattr(getattr(res.data, "dataset", None), "chunks", None)
+    if chunks:
+        rows = max(rows // chunks[0], 1) * chunks[0]
+
+    species_dictionary = pa.array(sorted(set(species)), pa.string())
+    location_dictionary = pa.array(sorted(set(locations)), pa.string())
+    species_index = np.searchsorted(species_dictionary.to_numpy(zero_copy_only=False), species).astype(np.int32)
+    location_index = np.searchsorted(location_dictionary.to_numpy(zero_copy_only=False), locations).astype(np.int32)
+    for start in range(0, n_replicats, rows):
+        stop = min(start + rows, n_replicats)
+        values = np.asarray(res.data[start:stop], dtype=np.float64)
+        times = np.asarray(res.time[start:stop], dtype=np.float64)[:, :values.shape[1]]
+        keep = ~np.isnan(values)  # replicates that stopped early have no rows after their stop time
+        replicate = np.broadcast_to(np.arange(start, stop, dtype=np.int32)[:, None, None], values.shape)[keep]
+        n_rows = len(replicate)
+        yield pa.record_batch([
+            pa.DictionaryArray.from_arrays(np.zeros(n_rows, dtype=np.int32), pa.array([uid], pa.string())),
+            pa.array(replicate),
+            pa.array(np.broadcast_to(times[:, :, None], values.shape)[keep]),
+            pa.DictionaryArray.from_arrays(np.broadcast_to(species_index, values.shape)[keep], species_dictionary),
+            pa.DictionaryArray.from_arrays(np.broadcast_to(location_index, values.shape)[keep], location_dictionary),
+            pa.array(values[keep])], schema=export_schema())
+
+
+def export_run(hdf_path, uid, out_dir, format="parquet", compression="zstd", block_bytes=BLOCK_BYTES):
+    """
+    Exports one run to `out_dir/<uid>/<selector>.<format>`, see `export_results`.
+
+    Returns:
+        list: The written files.
+    """
+    pa = _pyarrow()
+    assert format in FORMATS, f"Unknown export format '{format}', use one of {FORMATS}."
+    metadata = run_metadata(hdf_path, uid)
+    directory = os.path.join(out_dir, uid)
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    with load_results(hdf_path, uid) as results:
+        for index, res in enumerate(results):
+            name = getattr(res, "name", None) or f"selector_{index}"
+            schema = export_schema(dict(metadata, labels=json.dumps([str(label) for label in res.labels]),
+                                        source=os.path.abspath(hdf_path + ".h5"), selector=name))
+            path = os.path.join(directory, f"{name.replace('/', '_')}.{format}")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            if format == "parquet":
+                import pyarrow.parquet as pq
+                writer = pq.ParquetWriter(tmp_path, schema, compression=compression)
+            else:
+                writer = pa.ipc.new_file(tmp_path, schema, options=pa.ipc.IpcWriteOptions(
+                    compression=None if compression in (None, "none") else compression))
+            with writer:
+                for batch in _batches(uid, res, block_bytes):  # one row group / record batch per block of replicates
+                    writer.write_batch(batch)
+            os.replace(tmp_path, path)
+            files.append(path)
+    return files
+
+
+def export_results(hdf_path, uids, out_dir, format="parquet", compression="zstd", block_bytes=BLOCK_BYTES):
+    """
+    Converts runs of a result file into a partitioned, columnar dataset with the tidy schema
+    (run, replicate, time, species, compartment, value).
+
+    The dataset is partitioned by run (a directory `<uid>/` per run) and selector (a file each). Every file is
+    written a block of replicates at a time (one Parquet row group or Arrow record batch per block, `block_bytes` of
+    values), so the export never holds a whole run in memory. Labels are split into compartment and species once
+    (`split_label`), NaN rows of replicates that stopped early are left out. The attributes of the run (parameters,
+    mesh, solver, ...), the original labels and the source file are stored in the schema metadata of every file.
+    Runs of STEPS, ensemble and aggregate files can be exported, of aggregate files only the raw sample is stored.
+
+    Args:
+        hdf_path (str): Result file without the .h5 suffix, like for `load_results`.
+        uids (str or list): Run name(s).
+        out_dir (str): Directory of the dataset, files of the same runs and selectors are replaced.
+        format (str): "parquet" (compressed, for storage and polars/duckdb) or "arrow" (Arrow IPC / Feather v2,
+                      memory-mappable without a copy when uncompressed).
+        compression (str): Codec, e.g. "zstd", "lz4", "snappy" (Parquet only) or None.
+        block_bytes (int): Memory of one block of replicates.
+
+    Returns:
+        list: The written files.
+    """
+    uids = [uids] if isinstance(uids, str) else list(uids)
+    return [path for uid in uids for path in export_run(hdf_path, uid, out_dir, format, compression, block_bytes)]
+
+
+def open_export(out_dir, format="parquet"):
+    """
+    Opens an exported dataset lazily as a `pyarrow.dataset.Dataset`, e.g.
+    `open_export(path).to_table(columns=["time", "value"], filter=ds.field("species") == "ERKpp")` or
+    `pl.scan_pyarrow_dataset(open_export(path))`. Only the requested columns are read. A single Arrow file can also be
+    memory-mapped without a copy: `pa.ipc.open_file(pa.memory_map(path)).read_all()` (export with compression=None).
+    """
+    _pyarrow()
+    import pyarrow.dataset as ds
+    return ds.dataset(out_dir, format="ipc" if format == "arrow" else format)
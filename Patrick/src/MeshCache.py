@@ -0,0 +1,256 @@
+import json
+import os
+import re
+import shutil
+import numpy as np
+import steps.interface
+import steps.geom as stgeom
+from steps import stepslib
+from src.ModelCache import file_hash
+
+# bump this whenever the layout of the cache directory changes, old caches are then rebuilt automatically
+CACHE_VERSION = 1
+
+# in-process memo, several builders/partitioners ask for the same mesh during one load_model call
+_memo = {}
+
+# the four faces of a tetrahedron, as local vertex indices
+TET_FACES = np.array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])
+
+
+class CachedMesh:
+    """
+    Array representation of a tetrahedral mesh as it is read by `stgeom.TetMesh.LoadAbaqus`.
+
+    All arrays are memory-mapped from the cache directory, so loading a cached mesh is close to free and several
+    processes on one node share the same pages.
+
+    Attributes:
+        verts (np.ndarray): (n_verts, 3) vertex coordinates, already multiplied by `scale`.
+        tets (np.ndarray): (n_tets, 4) vertex indices of every tetrahedron, in STEPS tet index order.
+        tet_groups (dict): Name of the tet group (e.g. "Volume1") -> array of tet indices.
+        tet_centers (np.ndarray): (n_tets, 3) barycenters of the tetrahedra.
+        tet_volumes (np.ndarray): (n_tets,) volumes of the tetrahedra.
+        group_surfaces (dict): Name of the tet group -> (n, 3) vertex indices of its boundary triangles.
+        scale (float): Scale that was applied to the vertices.
+        source_hash (str): sha256 of the .inp file the cache was built from.
+    """
+
+    def __init__(self, arrays, meta):
+        self.verts = arrays["verts"]
+        self.tets = arrays["tets"]
+        self.tet_centers = arrays["tet_centers"]
+        self.tet_volumes = arrays["tet_volumes"]
+        self.tet_groups = {name: arrays[f"group_{idx}"] for idx, name in enumerate(meta["tet_groups"])}
+        self.group_surfaces = {name: arrays[f"surface_{idx}"] for idx, name in enumerate(meta["tet_groups"])}
+        self.scale = meta["scale"]
+        self.source_hash = meta["source_hash"]
+        self.cache_dir = meta.get("cache_dir")
+
+    @property
+    def fingerprint(self):
+        """Short identifier of this mesh (source content + scale), used to key caches derived from it."""
+        return f"{self.source_hash[:16]}_s{self.scale!r}"
+
+    def tet_compartment_ids(self, group_names):
+        """
+        Returns an int array that maps every tet to the position of its group in `group_names` (-1 if none).
+        """
+        ids = np.full(len(self.tets), -1, dtype=np.int64)
+        for idx, name in enumerate(group_names):
+            ids[self.tet_groups[name]] = idx
+        return ids
+
+    def to_tetmesh(self):
+        """
+        Builds the STEPS TetMesh directly from the arrays, with the same tet groups as LoadAbaqus would create.
+        """
+        steps_mesh = stepslib._py_Tetmesh(self.verts.ravel().tolist(), self.tets.ravel().tolist(), [])
+        tet_groups = {name: idxs.tolist() for name, idxs in self.tet_groups.items()}
+        return stgeom.TetMesh._FromStepsObject(steps_mesh, tet_groups)
+
+
+def parse_abaqus(mesh_path, scale=1):
+    """
+    Reads vertices, tetrahedra (C3D4) and tet groups (element sets) from an ASCII Abaqus .inp file.
+
+    Vertices and tets are numbered in order of appearance, like `stgeom.TetMesh.LoadAbaqus` does it. Tet groups are
+    taken from the ELSET of the *ELEMENT blocks and from separate *ELSET blocks. Surface elements are skipped, STEPS
+    derives the triangles from the tets anyway.
+
+    Returns:
+        tuple: (verts (n, 3) float64, tets (m, 4) int64, dict group name -> tet indices)
+    """
+    with open(mesh_path, "r") as f:
+        text = f.read()
+
+    node_blocks, tet_blocks, elset_blocks = [], [], []
+    # split the file into "*KEYWORD, options" headers and the data lines that follow them
+    for header, body in re.findall(r"^\*([^\n]*)\n((?:[^*][^\n]*\n?)*)", text, flags=re.MULTILINE):
+        keyword = header.split(",")[0].strip().upper()
+        options = {k.strip().upper(): v.strip() for k, _, v in
+                   (opt.partition("=") for opt in header.split(",")[1:])}
+        if keyword == "NODE":
+            node_blocks.append(body)
+        elif keyword == "ELEMENT" and options.get("TYPE", "").upper() == "C3D4":
+            tet_blocks.append((options.get("ELSET"), body))
+        elif keyword == "ELSET" and "ELSET" in options:
+            elset_blocks.append((options["ELSET"], options, body))
+
+    def numbers(body, dtype):
+        return np.fromstring(body.replace(",", " "), sep=" ", dtype=dtype)
+
+    nodes = numbers("".join(node_blocks), np.float64).reshape(-1, 4)
+    node_ids = nodes[:, 0].astype(np.int64)
+    verts = nodes[:, 1:] * scale
+    node_lookup = np.full(node_ids.max() + 1, -1, dtype=np.int64)
+    node_lookup[node_ids] = np.arange(len(node_ids))
+
+    tet_rows, group_lists, element_ids = [], {}, []
+    offset = 0
+    for elset, body in tet_blocks:
+        rows = numbers(body, np.int64).reshape(-1, 5)
+        tet_rows.append(node_lookup[rows[:, 1:]])
+        element_ids.append(rows[:, 0])
+        if elset:
+            group_lists.setdefault(elset, []).append(np.arange(offset, offset + len(rows)))
+        offset += len(rows)
+    tets = np.concatenate(tet_rows) if tet_rows else np.empty((0, 4), dtype=np.int64)
+    element_ids = np.concatenate(element_ids) if element_ids else np.empty(0, dtype=np.int64)
+
+    # *ELSET blocks list element ids (or "first, last, step" with the GENERATE option)
+    if elset_blocks and len(element_ids) > 0:
+        element_lookup = np.full(element_ids.max() + 1, -1, dtype=np.int64)
+        element_lookup[element_ids] = np.arange(len(element_ids))
+        for elset, options, body in elset_blocks:
+            ids = numbers(body, np.int64)
+            if "GENERATE" in options:
+                ids = np.concatenate([np.arange(a, b + 1, c) for a, b, c in ids.reshape(-1, 3)])
+            ids = ids[ids < len(element_lookup)]
+            idxs = element_lookup[ids]
+            idxs = idxs[idxs >= 0]
+            if len(idxs) > 0:
+                group_lists.setdefault(elset, []).append(idxs)
+
+    tet_groups = {name: np.unique(np.concatenate(lists)) for name, lists in group_lists.items()}
+    return verts, tets, tet_groups
+
+
+def tet_geometry(verts, tets):
+    """
+    Returns the barycenters (n, 3) and volumes (n,) of the given tetrahedra.
+    """
+    corners = verts[tets]
+    centers = corners.mean(axis=1)
+    edges = corners[:, 1:] - corners[:, :1]
+    volumes = np.abs(np.linalg.det(edges)) / 6
+    return centers, volumes
+
+
+def boundary_triangles(tets):
+    """
+    Returns the triangles (as sorted vertex index triplets) that belong to exactly one of the given tets, i.e. the
+    surface of the tet set.
+    """
+    if len(tets) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+    faces = np.sort(tets[:, TET_FACES].reshape(-1, 3), axis=1)
+    unique, counts = np.unique(faces, axis=0, return_counts=True)
+    return unique[counts == 1]
+
+
+def encode_triangles(tris, n_verts):
+    """
+    Encodes (sorted) vertex index triplets as one integer per triangle, so that set operations on triangles are
+    plain 1D numpy operations.
+    """
+    tris = np.asarray(tris, dtype=np.int64)
+    return (tris[..., 0] * n_verts + tris[..., 1]) * n_verts + tris[..., 2]
+
+
+def cache_dir_for(mesh_path, digest, scale):
+    directory, filename = os.path.split(os.path.abspath(mesh_path))
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(directory, f".{stem}.v{CACHE_VERSION}.{digest[:16]}_s{scale!r}.meshcache")
+
+
+def build_mesh_cache(mesh_path, scale, cache_dir, digest):
+    """
+    Parses the .inp file once and writes all arrays plus the precomputed geometry to `cache_dir`.
+    """
+    verts, tets, tet_groups = parse_abaqus(mesh_path, scale)
+    centers, volumes = tet_geometry(verts, tets)
+    group_names = sorted(tet_groups)
+
+    arrays = {"verts": verts, "tets": tets, "tet_centers": centers, "tet_volumes": volumes}
+    for idx, name in enumerate(group_names):
+        arrays[f"group_{idx}"] = tet_groups[name]
+        arrays[f"surface_{idx}"] = boundary_triangles(tets[tet_groups[name]])
+    meta = {"version": CACHE_VERSION, "source": os.path.abspath(mesh_path), "source_hash": digest,
+            "scale": scale, "tet_groups": group_names, "n_verts": len(verts), "n_tets": len(tets)}
+
+    # write into a private directory and move it in place at the end, so concurrent ranks never read half a cache
+    tmp_dir = f"{cache_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)  # another process finished first, use its cache
+
+
+def _read_cache(cache_dir):
+    with open(os.path.join(cache_dir, "meta.json"), "r") as f:
+        meta = json.load(f)
+    meta["cache_dir"] = cache_dir
+    arrays = {}
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".npy"):
+            arrays[filename[:-4]] = np.load(os.path.join(cache_dir, filename), mmap_mode="r")
+    return CachedMesh(arrays, meta)
+
+
+def load_mesh_arrays(mesh_path, scale=1):
+    """
+    Returns the `CachedMesh` of an Abaqus .inp file, building the binary cache first if necessary.
+
+    The cache is a directory next to the mesh, keyed by the content hash of the .inp file and the scale. Caches of
+    older versions of the file are removed when a new one is built.
+    """
+    assert os.path.isfile(mesh_path), "mesh_path does not exist. Please check the path and try again."
+    digest = file_hash(mesh_path)
+    key = (os.path.abspath(mesh_path), digest, scale)
+    if key in _memo:
+        return _memo[key]
+
+    cache_dir = cache_dir_for(mesh_path, digest, scale)
+    if not os.path.isfile(os.path.join(cache_dir, "meta.json")):
+        build_mesh_cache(mesh_path, scale, cache_dir, digest)
+        _remove_stale_caches(mesh_path, digest)
+
+    mesh_arrays = _read_cache(cache_dir)
+    _memo[key] = mesh_arrays
+    return mesh_arrays
+
+
+def _remove_stale_caches(mesh_path, digest):
+    directory, filename = os.path.split(os.path.abspath(mesh_path))
+    stem = os.path.splitext(filename)[0]
+    prefix = f".{stem}.v"
+    for entry in os.listdir(directory):
+        if entry.startswith(prefix) and entry.endswith(".meshcache") and f".{digest[:16]}_s" not in entry:
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+
+def load_tetmesh(mesh_path, scale=1):
+    """
+    Drop-in replacement for `stgeom.TetMesh.LoadAbaqus(mesh_path, scale=scale)` that goes through the binary cache.
+
+    Returns:
+        tuple: (stgeom.TetMesh, CachedMesh)
+    """
+    mesh_arrays = load_mesh_arrays(mesh_path, scale)
+    return mesh_arrays.to_tetmesh(), mesh_arrays
@@ -3,6 +3,13 @@ import trimesh
 import pymeshfix
 import gmsh
 import sys
+import os
+import json
+import hashlib
+import inspect
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 def fix_surface_holes(import_file, output_file):
@@ -206,6 +213,7 @@ def create_full_mesh(
         mesh_algorithm=1,
         mesh_size_min=0.166e-6,
         mesh_size_max=0.4e-6,
+        num_threads=1,
 ):
     """
     Creates a 3D mesh of a biological cell, including nucleus, cytosol, and extracellular space,
@@ -220,6 +228,10 @@ def create_full_mesh(
     mesh_algorithm (int, optional): Gmsh meshing algorithm (default: 1).
     mesh_size_min (float, optional): Minimum mesh element size (default: 0.166e-6 m).
     mesh_size_max (float, optional): Maximum mesh element size (default: 0.4e-6 m).
+    num_threads (int, optional): Number of threads gmsh may use for meshing (default: 1).
+
+    Returns:
+    int: Number of tetrahedra in the generated mesh.
     """
 
     gmsh.initialize()
@@ -251,6 +263,7 @@ def create_full_mesh(
 
 
     # Define mesh settings
+    gmsh.option.setNumber("General.NumThreads", num_threads)  # Threads used by gmsh internally
     gmsh.option.setNumber("Mesh.Algorithm", mesh_algorithm)  # Choose meshing algorithm
     gmsh.option.setNumber("Mesh.MeshSizeMin", mesh_size_min)  # Set minimum mesh size, the smaller the finer
     gmsh.option.setNumber("Mesh.MeshSizeMax", mesh_size_max)  # Set maximum mesh size
@@ -265,4 +278,93 @@ def create_full_mesh(
 
     # Uncomment for visualization/debugging
     # gmsh.fltk.run()
-    gmsh.finalize()
\ No newline at end of file
+
+    n_tets = sum(len(tags) for element_type, tags in zip(*gmsh.model.mesh.getElements(3)[:2]) if element_type == 4)
+    gmsh.finalize()
+    return n_tets
+
+
+def mesh_fingerprint(**mesh_kwargs):
+    """
+    Returns a hash of everything that determines the output of `create_full_mesh` (ellipsoidity, volumes, mesh sizes,
+    algorithm), with its defaults filled in, so changing a default also invalidates the meshes made with it. The gmsh
+    version is part of it as well, as a different version produces a different mesh.
+    """
+    arguments = inspect.signature(create_full_mesh).bind(**mesh_kwargs)
+    arguments.apply_defaults()
+    relevant = {key: value for key, value in arguments.arguments.items() if key not in ("output_file", "num_threads")}
+    relevant["gmsh_version"] = gmsh.__version__
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=float).encode()).hexdigest()
+
+
+def _create_full_mesh_worker(mesh_kwargs):
+    start_time = time.time()
+    n_tets = create_full_mesh(**mesh_kwargs)
+    return mesh_kwargs["output_file"], n_tets, time.time() - start_time
+
+
+def create_mesh_batch(output_dir, ellipsoidities, n_workers=None, gmsh_threads=1, manifest_name="manifest.json",
+                      **mesh_kwargs):
+    """
+    Generates the meshes of an ellipsoidity sweep in a process pool, skipping meshes that are already up to date.
+
+    Every mesh is written to `output_dir/ellipsoidity_{ellipsoidity}.inp`. The manifest in `output_dir` records the
+    fingerprint (see `mesh_fingerprint`), tet count, generation time and file size of every mesh. A mesh is only
+    generated again if its file is missing, its size changed or its fingerprint does not match anymore, so changing
+    e.g. `mesh_size_min` regenerates everything while re-running the same sweep is free.
+
+    Args:
+        output_dir (str): Directory the .inp files and the manifest are written to.
+        ellipsoidities (iterable): Ellipsoidity of every mesh, see `generate_ellipsoid_radii`.
+        n_workers (int, optional): Number of meshes generated at the same time, defaults to
+                                   os.cpu_count() // gmsh_threads.
+        gmsh_threads (int, optional): Threads every gmsh instance may use (default: 1).
+        manifest_name (str, optional): File name of the manifest (default: "manifest.json").
+        **mesh_kwargs: Further keyword arguments for `create_full_mesh` (volumes, mesh sizes, algorithm).
+
+    Returns:
+        dict: The manifest, output file name -> entry.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, manifest_name)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    jobs = []
+    for ellipsoidity in ellipsoidities:
+        ellipsoidity = float(np.round(ellipsoidity, 3))
+        output_file = os.path.join(output_dir, f"ellipsoidity_{ellipsoidity}.inp")
+        kwargs = dict(mesh_kwargs, output_file=output_file, ellipsoidity=ellipsoidity, num_threads=gmsh_threads)
+        fingerprint = mesh_fingerprint(**kwargs)
+        entry = manifest.get(os.path.basename(output_file))
+        if (entry is not None and entry["fingerprint"] == fingerprint and os.path.isfile(output_file)
+                and os.path.getsize(output_file) == entry["file_size"]):
+            print(f"{output_file} is up to date, skipping")
+            continue
+        jobs.append((kwargs, fingerprint))
+
+    n_workers = n_workers or max(1, (os.cpu_count() or 1) // gmsh_threads)
+    jobs_by_file = {kwargs["output_file"]: (kwargs, fingerprint) for kwargs, fingerprint in jobs}
+    if jobs:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(jobs)), mp_context=mp.get_context("spawn")) as pool:
+            futures = [pool.submit(_create_full_mesh_worker, kwargs) for kwargs, fingerprint in jobs]
+            for future in as_completed(futures):
+                output_file, n_tets, elapsed = future.result()
+                kwargs, fingerprint = jobs_by_file[output_file]
+                manifest[os.path.basename(output_file)] = {
+                    "fingerprint": fingerprint,
+                    "ellipsoidity": kwargs["ellipsoidity"],
+                    "n_tets": n_tets,
+                    "seconds": elapsed,
+                    "file_size": os.path.getsize(output_file),
+                    "parameters": {key: value for key, value in mesh_kwargs.items()},
+                }
+                print(f"{output_file}: {n_tets} tets in {elapsed:.1f} seconds")
+                # rewrite the manifest after every mesh, an interrupted sweep keeps what is already done
+                tmp_path = manifest_path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(manifest, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, manifest_path)
+    return manifest
\ No newline at end of file
@@ -0,0 +1,124 @@
+import glob
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from src.Utilities import dataframe_cleanup
+
+# bump this whenever the layout of the compiled file changes, old caches are then rebuilt automatically
+CACHE_VERSION = 1
+
+# in-process memo so repeated calls (e.g. once per replicate) do not even touch the .npz again
+_memo = {}
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    Returns the sha256 hex digest of the content of a file.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_path_for(df_path, digest):
+    """
+    Path of the compiled cache belonging to a spreadsheet with the given content hash. It lives next to the source,
+    e.g. Patrick/src/.data_big_model_mini_sph.v1.<hash>.npz
+    """
+    directory, filename = os.path.split(os.path.abspath(df_path))
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(directory, f".{stem}.v{CACHE_VERSION}.{digest[:16]}.npz")
+
+
+def compile_model_dataframe(df_path, cache_path):
+    """
+    Parses the spreadsheet once, cleans it and writes it as a compact .npz file.
+
+    Every column is stored as its own array, numeric columns (DCs, init counts) as float64 and text columns
+    (species, result-selector kinds, ...) as unicode arrays with a separate missing-value mask.
+    """
+    df = pd.read_excel(df_path)
+    df = dataframe_cleanup(df, ["Species"])
+
+    arrays = {"columns": np.array(df.columns, dtype=str)}
+    kinds = []
+    for idx, col in enumerate(df.columns):
+        if pd.api.types.is_numeric_dtype(df[col]):
+            kinds.append("f")
+            arrays[f"col_{idx}"] = df[col].to_numpy(dtype=np.float64)
+        else:
+            kinds.append("s")
+            missing = df[col].isna().to_numpy()
+            arrays[f"col_{idx}"] = np.where(missing, "", df[col].astype(str)).astype(str)
+            arrays[f"mask_{idx}"] = missing
+    arrays["kinds"] = np.array(kinds, dtype=str)
+
+    # write to a temporary file first so other ranks never see a half written cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, cache_path)
+    return df
+
+
+def _read_compiled(cache_path):
+    with np.load(cache_path, allow_pickle=False) as data:
+        columns = [str(c) for c in data["columns"]]
+        kinds = [str(k) for k in data["kinds"]]
+        frame = {}
+        for idx, (col, kind) in enumerate(zip(columns, kinds)):
+            values = data[f"col_{idx}"]
+            if kind == "s":
+                values = values.astype(object)
+                values[data[f"mask_{idx}"]] = np.nan
+            frame[col] = values
+    return pd.DataFrame(frame, columns=columns)
+
+
+def _remove_stale_caches(df_path, keep):
+    directory, filename = os.path.split(os.path.abspath(df_path))
+    stem = os.path.splitext(filename)[0]
+    for path in glob.glob(os.path.join(directory, f".{stem}.v*.npz")):
+        if path != keep:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another rank was faster
+
+
+def load_model_dataframe(df_path):
+    """
+    Loads the cleaned model dataframe (species, DCs, init counts, result selector kinds) from the compiled cache.
+
+    The cache is keyed by the content hash of the spreadsheet and stored next to it. If the spreadsheet changed, the
+    old cache is discarded and the spreadsheet is compiled again, so there is no need to clear anything by hand.
+
+    Args:
+        df_path (str): Path to the .xls/.xlsx file describing the model.
+
+    Returns:
+        pd.DataFrame: The cleaned dataframe, a fresh copy on every call.
+    """
+    assert os.path.isfile(df_path), f"Model dataframe {df_path} does not exist. Please check the path and try again."
+    digest = file_hash(df_path)
+    key = (os.path.abspath(df_path), digest)
+    if key in _memo:
+        return _memo[key].copy()
+
+    cache_path = cache_path_for(df_path, digest)
+    df = None
+    if os.path.isfile(cache_path):
+        try:
+            df = _read_compiled(cache_path)
+        except (OSError, ValueError, KeyError):
+            df = None  # corrupt or incompatible cache, just rebuild it
+    if df is None:
+        compile_model_dataframe(df_path, cache_path)
+        _remove_stale_caches(df_path, keep=cache_path)
+        df = _read_compiled(cache_path)
+
+    _memo[key] = df
+    return df.copy()
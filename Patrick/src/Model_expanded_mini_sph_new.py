@@ -4,6 +4,12 @@ import steps.geom as stgeom
 import steps.rng as strng
 import steps.sim as stsim
 import steps.saving as stsave
+from src.MeshCache import load_tetmesh, load_mesh_arrays
+from src.Partitioning import make_partition
+from src.ParameterBindings import ParameterBindings
+from src.SaveSchedules import save_kwargs
+from src.Observables import OUTPUT_MODES, aggregated_selectors, profile_selectors
+from src.Solvers import check_solver, is_well_mixed, well_mixed_geometry, create_simulation
 from src.Utilities import molar_to_molecules
 import os
 import time
@@ -16,7 +22,8 @@ def initialize_mesh(mesh_path, scale, nucleus_volume, volume_system, extracellul
     # Load mesh and compartments
     # Sphere with diameter 12 und max.size 0.4
     assert os.path.isfile(mesh_path), "mesh_path does not exist. Please check the path and try again."
-    mesh = stgeom.TetMesh.LoadAbaqus(mesh_path, scale=scale)
+    # binary, hash-keyed cache of the .inp file instead of parsing the ASCII file every time
+    mesh, mesh_arrays = load_tetmesh(mesh_path, scale)
 
     with mesh:
         #for Sphere
@@ -45,7 +52,29 @@ def initialize_mesh(mesh_path, scale, nucleus_volume, volume_system, extracellul
     return mesh, exo_tets, cytosol_tets, nuc_tets
 
 
-def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
+def initialize_well_mixed_geometry(mesh_path, scale, volume_system, extracellular_volume, cell_surface):
+    # same compartments as initialize_mesh, with the volumes and the membrane area of the mesh
+    assert os.path.isfile(mesh_path), "mesh_path does not exist. Please check the path and try again."
+    geom, interfaces = well_mixed_geometry(load_mesh_arrays(mesh_path, scale),
+                                           compartments={"cyt": ("Volume2", volume_system),
+                                                         "exo": ("Volume1", extracellular_volume)},
+                                           patches={"cell_surface": ("cyt", "exo", cell_surface)})
+    return geom
+
+
+def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run, seed=None, n_hosts=None,
+                 partitioner="linear", partition_options=None, comm=None, solver="TetOpSplit",
+                 solver_options=None, output_mode="species", profiles=None, save_schedule=None):
+    # solver: "TetOpSplit", "Tetexact", "TetODE" on the tet mesh or "Wmdirect", "Wmrk4" well-mixed, see src/Solvers.py
+    # output_mode: "species" saves one SUM selector per species, "aggregated" one LIST selector per
+    # compartment/patch (a single (time, species) dataset each), see src/Observables.py
+    # profiles: spatial profiles to save in addition (tet mesh solvers only), see Observables.profile_selectors
+    # save_schedule: when results are saved, defaults to every p["time step"], see SaveSchedules.save_kwargs
+    schedule = save_kwargs(save_schedule, p)
+    assert output_mode in OUTPUT_MODES, f"Unknown output_mode '{output_mode}', use one of {OUTPUT_MODES}."
+    n_hosts = stsim.MPI.nhosts if n_hosts is None else n_hosts
+    check_solver(solver, n_hosts)
+    well_mixed = is_well_mixed(solver)
 
     #Factors for Reaction Rates
     c1 = 1
@@ -54,6 +83,8 @@ def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
     r = stmodel.ReactionManager()
     data_big_model_mini_sph_df = model_dataframe
     species_dict = {}
+    # where the constants live in the simulation, so they can be changed without a new model
+    bindings = ParameterBindings(diffusion=not well_mixed)
 
     # Diffusionskonstanten
     #DCR = p["DCR"]#2.5e-14 # m^2/s
@@ -169,7 +200,7 @@ def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
                 species_name = row['Species']
                 cyt_dc = row['cyt DC']
                 if pd.notna(cyt_dc):
-                    stmodel.Diffusion(species_dict[species_name], cyt_dc)
+                    bindings.add_diffusion(species_name, stmodel.Diffusion(species_dict[species_name], cyt_dc), "cyt")
 
             '''stmodel.Diffusion(species_dict["GAP"], p["DC"]/4)
             stmodel.Diffusion(species_dict["Grb2"], p["DC"]/4)
@@ -222,7 +253,7 @@ def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
                 species_name = row['Species']
                 exo_dc = row['exo Volume DC']
                 if pd.notna(exo_dc):
-                    stmodel.Diffusion(species_dict[species_name], exo_dc)
+                    bindings.add_diffusion(species_name, stmodel.Diffusion(species_dict[species_name], exo_dc), "exo")
             #stmodel.Diffusion(species_dict["EGF"], p["DC"]/10)
 
         #with vsys_nuc: # means with nucles_volume:
@@ -300,7 +331,8 @@ def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
                 species_name = row['Species']
                 cell_surface_dc = row['cell_surface DC']
                 if pd.notna(cell_surface_dc):
-                    stmodel.Diffusion(species_dict[species_name], cell_surface_dc)
+                    bindings.add_diffusion(species_name, stmodel.Diffusion(species_dict[species_name], cell_surface_dc),
+                                           "cell_surface")
             '''stmodel.Diffusion(species_dict["EGF"], p["DC"]/10)
             stmodel.Diffusion(species_dict["EGF_EGFR"], p["DC"]/20)
             stmodel.Diffusion(species_dict["EGF_EGFR2"], p["DC"]/40)
@@ -321,6 +353,12 @@ def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
             stmodel.Diffusion(species_dict["EGF_EGFRp2_GAP_Shcp_Grb2_Sos"], p["DC"] / 80)
             stmodel.Diffusion(species_dict["EGF_EGFRp2_GAP_Shcp_Grb2_Sos_Ras_GDP"], p["DC"] / 80)
             stmodel.Diffusion(species_dict["EGF_EGFRp2_GAP_Shcp_Grb2_Sos_Ras_GTP"], p["DC"] / 80)'''
+    # none of the rates come from p, they can still be changed by label, e.g. set_reaction_constant("r[10]", ...)
+    for idx in (10, 11, 12, 14, 15, 28, 29, 33, 35, 36, 38, 40, *range(42, 60), 60, 61, 62):
+        bindings.add_reaction(f"r[{idx}]", r[idx], "cyt")
+    for idx in (*range(1, 10), *range(16, 28), 30, 31, 32, 34, 37, 39, 41):
+        bindings.add_reaction(f"r[{idx}]", r[idx], "cell_surface")
+
     # -------Mesh--------------------------
     # if os.getcwd() != '/home/anna3171/annas-magnificent-steps-project':
 
@@ -366,26 +404,47 @@ def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
         #nuc_mem = DiffBoundary.Create(nuc.surface)
 
    
-    #-----------Load mesh and compartments
-    mesh, exo_tets, cytosol_tets, nuc_tets = initialize_mesh(mesh_path,
-                                                               scale=10 ** -6,
-                                                               nucleus_volume=nucleus_volume,
-                                                               volume_system=volume_system,
-                                                               extracellular_volume=extracellular_volume,
-                                                               cell_surface=cell_surface)
-    system_volume = mesh.Vol
-
-    ratio_v = mesh.exo.Vol / 1286e-18
-    ratio_mini = mesh.cyt.Vol / 1766e-18 #added so all meshes have same volume
-
     # ----------Start Simulation Initilize RNG and Simulation
-    seed = random.randint(1,6000)
+    if seed is None:
+        seed = random.randint(1,6000)
     rng = strng.RNG("mt19937", 512, seed)
-    partition = stgeom.LinearMeshPartition(mesh, 1, 1, stsim.MPI.nhosts)
-    sim = stsim.Simulation("TetOpSplit", mdl, mesh, rng, False, partition) #simulation
+
+    partition, partition_report = None, None
+    if well_mixed:
+        mesh = initialize_well_mixed_geometry(mesh_path,
+                                              scale=10 ** -6,
+                                              volume_system=volume_system,
+                                              extracellular_volume=extracellular_volume,
+                                              cell_surface=cell_surface)
+    else:
+        #-----------Load mesh and compartments
+        mesh, exo_tets, cytosol_tets, nuc_tets = initialize_mesh(mesh_path,
+                                                                   scale=10 ** -6,
+                                                                   nucleus_volume=nucleus_volume,
+                                                                   volume_system=volume_system,
+                                                                   extracellular_volume=extracellular_volume,
+                                                                   cell_surface=cell_surface)
+        system_volume = mesh.Vol
+
+        ratio_v = mesh.exo.Vol / 1286e-18
+        ratio_mini = mesh.cyt.Vol / 1766e-18 #added so all meshes have same volume
+
+        if solver == "TetOpSplit":
+            partition, partition_report = make_partition(mesh,
+                                                         load_mesh_arrays(mesh_path, 10 ** -6),
+                                                         n_hosts,
+                                                         method=partitioner,
+                                                         group_names={"exo": "Volume1", "cyt": "Volume2",
+                                                                      "nuc": "Volume3"},
+                                                         patches=[(mesh.cell_surface, "Volume2")],
+                                                         comm=comm,
+                                                         **(partition_options or {}))
+    sim = create_simulation(solver, mdl, mesh, rng, partition, solver_options) #simulation
 
     # Define results
     rs = None
+    saved_selectors = {}
+    profile_info = {}
     if plot_only_run == False:
         rs = stsave.ResultSelector(sim)
 
@@ -395,10 +454,12 @@ def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
         for index, row in data_big_model_mini_sph_df.iterrows():
             species_name = row['Species']
             result_selector = row['resultsselector']
+            # on the well-mixed geometry the compartments replace the tris/tets
             if result_selector == 'TRIS':
-                result_selectors.append((species_name, rs.TRIS(cytosol_tets.surface)))
+                result_selectors.append((species_name, rs.cell_surface if well_mixed
+                                         else rs.TRIS(cytosol_tets.surface)))
             elif result_selector == 'TETS':
-                result_selectors.append((species_name, rs.TETS(cytosol_tets)))
+                result_selectors.append((species_name, rs.cyt if well_mixed else rs.TETS(cytosol_tets)))
 
 
         '''species = [
@@ -464,10 +525,32 @@ def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
             ("EGF_EGFRp2_GAPi", rs.TETS(mesh.cyt.tets))
         ]'''
 
-        for s,r in result_selectors:
-            print(f"Setting result selector {s}/{len(result_selectors)}")
-            rs_path = rs.SUM(getattr(r, s).Count)
-            sim.toSave(rs_path, dt = p["time step"]) #keep
+        if output_mode == "aggregated":
+            location_species = {"cell_surface": [], "cyt": []}
+            for index, row in data_big_model_mini_sph_df.iterrows():
+                if row['resultsselector'] == 'TRIS':
+                    location_species["cell_surface"].append(row['Species'])
+                elif row['resultsselector'] == 'TETS':
+                    location_species["cyt"].append(row['Species'])
+            saved_selectors = aggregated_selectors(rs, location_species)
+            for s, rs_path in saved_selectors.items():
+                print(f"Setting result selector {s} ({len(location_species[s])} species)")
+                sim.toSave(rs_path, **schedule)
+        else:
+            for s,r in result_selectors:
+                print(f"Setting result selector {s}/{len(result_selectors)}")
+                rs_path = rs.SUM(getattr(r, s).Count)
+                sim.toSave(rs_path, **schedule) #keep
+                saved_selectors[s] = rs_path
+
+        if profiles:
+            assert not well_mixed, "Spatial profiles need a tet mesh, they do not work with the well-mixed solvers."
+            profile_sels, profile_info = profile_selectors(rs, mesh, load_mesh_arrays(mesh_path, 10 ** -6), profiles,
+                                                           group_names={"exo": "Volume1", "cyt": "Volume2",
+                                                                        "nuc": "Volume3"})
+            for s, rs_path in profile_sels.items():
+                sim.toSave(rs_path, **schedule)
+                saved_selectors[s] = rs_path
         
         # i = ii#sys.argv[1] #get rid of
             #rs_path.toFile(f"saved objects/Einzelne Runs/{s}_mini_sph_{p_name}_{factor}_{i}.dat") #get rid of
@@ -520,7 +603,9 @@ def create_model(model_dataframe, p, species_names, mesh_path, plot_only_run):
             end = time.time()
             print("Durchlaufzeit: " + str((end - start)/60/60) + "h")'''
 
-        return sim, rs, mesh
+    model_info = {"saved_selectors": saved_selectors, "partition_report": partition_report,
+                  "parameter_bindings": bindings, "profiles": profile_info}
+    return sim, rs, mesh, model_info
 
 #standard parameterssqueue
 # p = {"DC" : 4e-12, "time step" : 0.01, "EGF0": 1e4}
@@ -4,6 +4,12 @@ import steps.geom as stgeom
 import steps.rng as strng
 import steps.sim as stsim
 import steps.saving as stsave
+from src.MeshCache import load_tetmesh, load_mesh_arrays
+from src.Partitioning import make_partition
+from src.ParameterBindings import ParameterBindings
+from src.SaveSchedules import save_kwargs
+from src.Observables import OUTPUT_MODES, aggregated_selectors, profile_selectors
+from src.Solvers import check_solver, is_well_mixed, well_mixed_geometry, boundary_transport_rate, create_simulation
 from src.Utilities import molar_to_molecules, nostdout
 import numpy as np
 import os
@@ -12,7 +18,8 @@ import os
 def initialize_ellipsoid_mesh(mesh_path, scale, nucleus_volume, cytosol_volume, extracellular_volume, cell_surface_system):
     # Load mesh and compartments
     assert os.path.isfile(mesh_path), "mesh_path does not exist. Please check the path and try again."
-    mesh = stgeom.TetMesh.LoadAbaqus(mesh_path, scale=scale)
+    # binary, hash-keyed cache of the .inp file instead of parsing the ASCII file every time
+    mesh, mesh_arrays = load_tetmesh(mesh_path, scale)
 
     with mesh:
 
@@ -79,7 +86,26 @@ def initialize_ellipsoid_mesh(mesh_path, scale, nucleus_volume, cytosol_volume,
     return mesh, exo_tets, cytosol_tets, nuc_tets
 
 
-def create_model(p, species_names, mesh_path, mesh_scale, plot_only_run):
+def initialize_well_mixed_geometry(mesh_path, scale, nucleus_volume, cytosol_volume, extracellular_volume,
+                                   cell_surface_system, nuc_mem_system):
+    """
+    Well-mixed counterpart of `initialize_ellipsoid_mesh`: the same compartments and patches, with the volumes and
+    areas of the mesh. The nuclear envelope (a DiffBoundary on the mesh) becomes the patch "nuc_mem".
+    """
+    assert os.path.isfile(mesh_path), "mesh_path does not exist. Please check the path and try again."
+    mesh_arrays = load_mesh_arrays(mesh_path, scale)
+    geom, interfaces = well_mixed_geometry(mesh_arrays,
+                                           compartments={"nuc": ("Volume3", nucleus_volume),
+                                                         "cyt": ("Volume2", cytosol_volume),
+                                                         "exo": ("Volume1", extracellular_volume)},
+                                           patches={"cell_surface": ("cyt", "exo", cell_surface_system),
+                                                    "nuc_mem": ("nuc", "cyt", nuc_mem_system)})
+    return geom, interfaces
+
+
+def create_model(p, species_names, mesh_path, mesh_scale, plot_only_run, seed=None, n_hosts=None,
+                 partitioner="linear", partition_options=None, comm=None, solver="TetOpSplit",
+                 solver_options=None, output_mode="species", profiles=None, save_schedule=None):
     """
     Creates a STEPS simulation model based on parameters, species, and mesh geometry.
 
@@ -95,6 +121,39 @@ def create_model(p, species_names, mesh_path, mesh_scale, plot_only_run):
     mesh_path : str
         Path to the Abaqus mesh file defining system geometry, scaled to micrometers.
 
+    seed : int, optional
+        Seed of the random number generator, defaults to 2903.
+
+    n_hosts : int, optional
+        Number of ranks the mesh is partitioned for, defaults to all MPI ranks (`stsim.MPI.nhosts`).
+
+    partitioner : str, optional
+        "linear" (LinearMeshPartition along z), "morton" or "axis" (weighted, see `src/Partitioning.py`).
+
+    partition_options : dict, optional
+        Keyword arguments for the weights of the weighted partitioners, see `Partitioning.tet_weights`.
+
+    comm : MPI.Comm, optional
+        Ranks of this simulation, the partition is computed on the first one and broadcast.
+
+    solver : str, optional
+        "TetOpSplit" (default), "Tetexact", "TetODE" on the tet mesh, or the well-mixed "Wmdirect" / "Wmrk4" on
+        compartments with the volumes and areas of the mesh, see `src/Solvers.py`.
+
+    solver_options : dict, optional
+        Options of the deterministic solvers, see `Solvers.create_simulation`.
+
+    output_mode : str, optional
+        "species" (default): one SUM selector per species. "aggregated": one LIST selector per compartment/patch with
+        all its species as columns, see `Observables.aggregated_selectors`.
+
+    profiles : list of dict, optional
+        Spatial profiles to save in addition, e.g. [{"species": ["ERKp"], "kind": "membrane_distance", "n_bins": 20}],
+        see `Observables.profile_selectors`. Only with the tet mesh solvers.
+
+    save_schedule : dict or list, optional
+        When the results are saved, defaults to every `p["time step"]`. See `SaveSchedules.save_kwargs`.
+
     Returns:
     --------
     simulation : steps.sim.Simulation
@@ -103,6 +162,15 @@ def create_model(p, species_names, mesh_path, mesh_scale, plot_only_run):
     rs : steps.saving.ResultSelector
         Object for selecting and storing simulation results.
 
+    mesh : steps.geom.TetMesh or steps.geom.Geometry
+        The loaded mesh, or the well-mixed geometry for the well-mixed solvers.
+
+    model_info : dict
+        "saved_selectors": name -> result selector of everything that was scheduled with `toSave` (empty for
+        plot_only_run), "partition_report": load balance and cut faces of the partition, "parameter_bindings":
+        `ParameterBindings` of the reaction and diffusion constants, see `SimManager.update_parameters`,
+        "profiles": name -> bins of every spatial profile, see `Observables.build_profile`.
+
     Raises:
     -------
     AssertionError:
@@ -114,10 +182,20 @@ def create_model(p, species_names, mesh_path, mesh_scale, plot_only_run):
     - Partitions the mesh into compartments: nucleus, cytoplasm, extracellular space,
       and membrane patch.
     - Sets up a stochastic simulation engine with result selectors for species counts.
+    - With the well-mixed solvers, ERKp crosses the nuclear envelope through a transport reaction on the "nuc_mem"
+      patch, with the rate at which it diffuses through the boundary tris of the mesh.
     """
+    n_hosts = stsim.MPI.nhosts if n_hosts is None else n_hosts
+    check_solver(solver, n_hosts)
+    assert output_mode in OUTPUT_MODES, f"Unknown output_mode '{output_mode}', use one of {OUTPUT_MODES}."
+    well_mixed = is_well_mixed(solver)
+
     mdl = stmodel.Model()
     r = stmodel.ReactionManager()
     species_dict = {}
+    # which constants come from which entry of p, so they can be changed without a new model
+    bindings = ParameterBindings(diffusion=not well_mixed)
+    D = bindings.add_diffusion
 
     # Create volume and surface systems
     with mdl:
@@ -125,6 +203,7 @@ def create_model(p, species_names, mesh_path, mesh_scale, plot_only_run):
         nucleus_volume = stmodel.VolumeSystem(name="nucleus_volume")
         extracellular_volume = stmodel.VolumeSystem(name="extracellular_volume")
         cell_surface_system = stmodel.SurfaceSystem(name = "cell_surface")
+        nuc_mem_system = stmodel.SurfaceSystem(name="nuc_mem") if well_mixed else None
 
         # Create a dictionary to hold the created species
         for sp_name in species_names:
@@ -135,21 +214,23 @@ def create_model(p, species_names, mesh_path, mesh_scale, plot_only_run):
             # ERK Deaktivierung
             species_dict["ERKp"] + species_dict["P3"] > r[6] > species_dict["ERK"] + species_dict["P3"]
             r[6].K = p["k[666]"]
+            bindings.add_reaction("r[6]", r[6], "cyt", key="k[666]")
             #Cytoplasm diffusion
-            stmodel.Diffusion(species_dict["ERK"], p["DC"])
-            stmodel.Diffusion(species_dict["ERKp"], p["DC"])
-            stmodel.Diffusion(species_dict["P3"], p["DC"] * 2)
-            stmodel.Diffusion(species_dict["GAP"], p["DC"]/4)
+            D("ERK", stmodel.Diffusion(species_dict["ERK"], p["DC"]), "cyt", key="DC")
+            D("ERKp", stmodel.Diffusion(species_dict["ERKp"], p["DC"]), "cyt", key="DC")
+            D("P3", stmodel.Diffusion(species_dict["P3"], p["DC"] * 2), "cyt", key="DC", transform=lambda dc: dc * 2)
+            D("GAP", stmodel.Diffusion(species_dict["GAP"], p["DC"]/4), "cyt", key="DC", transform=lambda dc: dc/4)
 
         # Extracellular volume
         with extracellular_volume:
-            stmodel.Diffusion(species_dict["EGF"], p["DC"]/10)
+            D("EGF", stmodel.Diffusion(species_dict["EGF"], p["DC"]/10), "exo", key="DC", transform=lambda dc: dc/10)
 
         # Nucleus volume
         with nucleus_volume:
             species_dict["ERKp"] > r[7] > species_dict["ERKpp"]
             r[7].K = 1e8
-            stmodel.Diffusion(species_dict["ERKpp"], p["DC"])
+            bindings.add_reaction("r[7]", r[7], "nuc")
+            D("ERKpp", stmodel.Diffusion(species_dict["ERKpp"], p["DC"]), "nuc", key="DC")
 
         # Surface system (cell membrane)
         with cell_surface_system:
@@ -164,50 +245,113 @@ def create_model(p, species_names, mesh_path, mesh_scale, plot_only_run):
             r[3].K = 1 * 100, 0.01  # 1/s
             r[4].K = 1e6 * 100 , 0.2   # 1/Ms 1e6, 0.2
             r[5].K = p["k[0]"], 0.1 #1e8 * c1, 0.1 * c1
-
-            stmodel.Diffusion(species_dict["EGFR"], p["DC"]/10)
-            stmodel.Diffusion(species_dict["EGF_EGFR"], p["DC"]/20)
-            stmodel.Diffusion(species_dict["EGF_EGFR2"], p["DC"]/40)
-            stmodel.Diffusion(species_dict["EGF_EGFRp2"], p["DC"]/40)
-            stmodel.Diffusion(species_dict["EGF_EGFRp2_GAP"], p["DC"]/50)
-
-    # Load mesh and compartments
-    mesh, exo_tets, cytosol_tets, nuc_tets = initialize_ellipsoid_mesh(mesh_path,
-                                                                    scale=mesh_scale,
-                                                                    nucleus_volume=nucleus_volume,
-                                                                    cytosol_volume=cytosol_volume,
-                                                                    extracellular_volume=extracellular_volume,
-                                                                    cell_surface_system=cell_surface_system)
-    system_volume = mesh.Vol
-
-    # Initialize RNG and Simulation
-    rng = strng.RNG("mt19937", 512, 2903)
-    # with nostdout(): #doesnt work, crashes the freaking sim...
-    partition = stgeom.LinearMeshPartition(mesh, 1, 1, stsim.MPI.nhosts)
-    simulation = stsim.Simulation("TetOpSplit", mdl, mesh, rng, False, partition)
+            for idx in (1, 2, 3, 4):
+                bindings.add_reaction(f"r[{idx}]", r[idx], "cell_surface")
+            bindings.add_reaction("r[5]", r[5], "cell_surface", key="k[0]", direction="fwd")
+
+            D("EGFR", stmodel.Diffusion(species_dict["EGFR"], p["DC"]/10), "cell_surface", key="DC",
+              transform=lambda dc: dc/10)
+            D("EGF_EGFR", stmodel.Diffusion(species_dict["EGF_EGFR"], p["DC"]/20), "cell_surface", key="DC",
+              transform=lambda dc: dc/20)
+            D("EGF_EGFR2", stmodel.Diffusion(species_dict["EGF_EGFR2"], p["DC"]/40), "cell_surface", key="DC",
+              transform=lambda dc: dc/40)
+            D("EGF_EGFRp2", stmodel.Diffusion(species_dict["EGF_EGFRp2"], p["DC"]/40), "cell_surface", key="DC",
+              transform=lambda dc: dc/40)
+            D("EGF_EGFRp2_GAP", stmodel.Diffusion(species_dict["EGF_EGFRp2_GAP"], p["DC"]/50), "cell_surface",
+              key="DC", transform=lambda dc: dc/50)
+
+        # Well-mixed nuclear envelope, replaces the diffusion of ERKp through the DiffBoundary of the mesh. The rate
+        # depends on the geometry and is set once it is loaded.
+        if well_mixed:
+            with nuc_mem_system:
+                species_dict["ERKp"].o > r[8] > species_dict["ERKp"].i
+
+    # Initialize RNG
+    rng = strng.RNG("mt19937", 512, 2903 if seed is None else seed)
+
+    if well_mixed:
+        mesh, interfaces = initialize_well_mixed_geometry(mesh_path,
+                                                          scale=mesh_scale,
+                                                          nucleus_volume=nucleus_volume,
+                                                          cytosol_volume=cytosol_volume,
+                                                          extracellular_volume=extracellular_volume,
+                                                          cell_surface_system=cell_surface_system,
+                                                          nuc_mem_system=nuc_mem_system)
+        r[8].K = boundary_transport_rate(p["DC"], interfaces["nuc_mem"][1], mesh.cyt.Vol)
+        bindings.add_reaction("r[8]", r[8], "nuc_mem", key="DC",
+                              transform=lambda dc: boundary_transport_rate(dc, interfaces["nuc_mem"][1],
+                                                                           mesh.cyt.Vol))
+        partition, partition_report = None, None
+    else:
+        # Load mesh and compartments
+        mesh, exo_tets, cytosol_tets, nuc_tets = initialize_ellipsoid_mesh(mesh_path,
+                                                                        scale=mesh_scale,
+                                                                        nucleus_volume=nucleus_volume,
+                                                                        cytosol_volume=cytosol_volume,
+                                                                        extracellular_volume=extracellular_volume,
+                                                                        cell_surface_system=cell_surface_system)
+        system_volume = mesh.Vol
+        partition, partition_report = None, None
+        if solver == "TetOpSplit":
+            # with nostdout(): #doesnt work, crashes the freaking sim...
+            partition, partition_report = make_partition(mesh,
+                                                         load_mesh_arrays(mesh_path, mesh_scale),
+                                                         n_hosts,
+                                                         method=partitioner,
+                                                         group_names={"exo": "Volume1", "cyt": "Volume2",
+                                                                      "nuc": "Volume3"},
+                                                         patches=[(mesh.cell_surface, "Volume2")],
+                                                         comm=comm,
+                                                         **(partition_options or {}))
+    simulation = create_simulation(solver, mdl, mesh, rng, partition, solver_options)
 
 
     # Define which results to save and how they are processed
     # Not all species are present in all the compartments, be aware of this.
     rs = None
+    result_selectors = {}
+    profile_info = {}
     if plot_only_run == False:
         rs = stsave.ResultSelector(simulation)
-        result_selectors = {
-            "EGF": rs.SUM(rs.TETS(exo_tets).EGF.Count),
-            "EGF_EGFR": rs.SUM(rs.TRIS(cytosol_tets.surface).EGF_EGFR.Count),
-            "EGF_EGFR2": rs.SUM(rs.TRIS(cytosol_tets.surface).EGF_EGFR2.Count),
-            "EGF_EGFRp2": rs.SUM(rs.TRIS(cytosol_tets.surface).EGF_EGFRp2.Count),
-            "EGF_EGFRp2_GAP": rs.SUM(rs.TRIS(cytosol_tets.surface).EGF_EGFRp2_GAP.Count),
-            "ERK_cyto": rs.SUM(rs.TETS(cytosol_tets).ERK.Count),
-            "ERKp_cyto": rs.SUM(rs.TETS(cytosol_tets).ERKp.Count),
-            # "ERKp_nuc": rs.SUM(rs.TETS(nuc_tets).ERKp.Count),
-            "ERKpp": rs.SUM(rs.TETS(nuc_tets).ERKpp.Count),
-            # "Concentrations": rs.TETS().LIST(species_dict["EGF_EGFR"],
-            #                                  species_dict["ERK"],
-            #                                  species_dict["ERKpp"]).Conc,
-        }
+        if output_mode == "aggregated":
+            result_selectors = aggregated_selectors(rs, {"exo": ["EGF"],
+                                                         "cell_surface": ["EGF_EGFR", "EGF_EGFR2", "EGF_EGFRp2",
+                                                                          "EGF_EGFRp2_GAP"],
+                                                         "cyt": ["ERK", "ERKp"],
+                                                         "nuc": ["ERKpp"]})
+        else:
+            # the same selectors for every solver, on the well-mixed geometry the compartments are the locations
+            if well_mixed:
+                exo_sel, surface_sel, cyt_sel, nuc_sel = rs.exo, rs.cell_surface, rs.cyt, rs.nuc
+            else:
+                exo_sel, surface_sel = rs.TETS(exo_tets), rs.TRIS(cytosol_tets.surface)
+                cyt_sel, nuc_sel = rs.TETS(cytosol_tets), rs.TETS(nuc_tets)
+            result_selectors = {
+                "EGF": rs.SUM(exo_sel.EGF.Count),
+                "EGF_EGFR": rs.SUM(surface_sel.EGF_EGFR.Count),
+                "EGF_EGFR2": rs.SUM(surface_sel.EGF_EGFR2.Count),
+                "EGF_EGFRp2": rs.SUM(surface_sel.EGF_EGFRp2.Count),
+                "EGF_EGFRp2_GAP": rs.SUM(surface_sel.EGF_EGFRp2_GAP.Count),
+                "ERK_cyto": rs.SUM(cyt_sel.ERK.Count),
+                "ERKp_cyto": rs.SUM(cyt_sel.ERKp.Count),
+                # "ERKp_nuc": rs.SUM(rs.TETS(nuc_tets).ERKp.Count),
+                "ERKpp": rs.SUM(nuc_sel.ERKpp.Count),
+                # "Concentrations": rs.TETS().LIST(species_dict["EGF_EGFR"],
+                #                                  species_dict["ERK"],
+                #                                  species_dict["ERKpp"]).Conc,
+            }
+        if profiles:
+            assert not well_mixed, "Spatial profiles need a tet mesh, they do not work with the well-mixed solvers."
+            profile_sels, profile_info = profile_selectors(rs, mesh, load_mesh_arrays(mesh_path, mesh_scale), profiles,
+                                                           group_names={"exo": "Volume1", "cyt": "Volume2",
+                                                                        "nuc": "Volume3"})
+            result_selectors.update(profile_sels)
+
         # Schedule saving
+        schedule = save_kwargs(save_schedule, p)
         for key, sel in result_selectors.items():
-            simulation.toSave(sel, dt=p["time step"])
+            simulation.toSave(sel, **schedule)
 
-    return simulation, rs, mesh
\ No newline at end of file
+    model_info = {"saved_selectors": result_selectors, "partition_report": partition_report,
+                  "parameter_bindings": bindings, "profiles": profile_info}
+    return simulation, rs, mesh, model_info
\ No newline at end of file
@@ -0,0 +1,258 @@
+import itertools
+import json
+import os
+import time
+import h5py
+import numpy as np
+from mpi4py import MPI
+from src.Ensemble import ENSEMBLE_FORMAT
+
+
+def expand_grid(grid):
+    """
+    Expands {parameter name: list of values} into the list of all combinations, as {parameter name: value} dicts.
+    The last parameter varies fastest, like `itertools.product`.
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def peak(selector, column=0):
+    """
+    Criterion: the maximum over time of the replicate mean of one column of a saved selector, e.g. peak("ERKpp").
+    """
+    def criterion(results):
+        return float(np.asarray(results[selector]["data"])[:, :, column].mean(axis=0).max())
+    criterion.__name__ = f"peak({selector})"
+    return criterion
+
+
+def final_value(selector, column=0):
+    """
+    Criterion: the replicate mean of one column of a saved selector at the end of the run.
+    """
+    def criterion(results):
+        return float(np.asarray(results[selector]["data"])[:, -1, column].mean())
+    criterion.__name__ = f"final_value({selector})"
+    return criterion
+
+
+def grid_sensitivity(grid, scores):
+    """
+    Local sensitivity of every grid point: the largest relative change of the score towards one of its neighbours
+    along any parameter axis, |s_i - s_j| / (|s_i| + |s_j|). Points where the response changes a lot are the ones
+    where the screening solver is most likely to be wrong and where refinement pays off.
+    """
+    shape = tuple(len(values) for values in grid.values())
+    scores = np.asarray(scores, dtype=np.float64).reshape(shape)
+    sensitivity = np.zeros(shape)
+    for axis in range(len(shape)):
+        if shape[axis] < 2:
+            continue
+        a = np.take(scores, range(shape[axis] - 1), axis=axis)
+        b = np.take(scores, range(1, shape[axis]), axis=axis)
+        change = np.abs(a - b) / np.maximum(np.abs(a) + np.abs(b), np.finfo(float).tiny)
+        lower = [slice(None)] * len(shape)
+        upper = [slice(None)] * len(shape)
+        lower[axis], upper[axis] = slice(0, -1), slice(1, None)
+        sensitivity[tuple(lower)] = np.maximum(sensitivity[tuple(lower)], change)
+        sensitivity[tuple(upper)] = np.maximum(sensitivity[tuple(upper)], change)
+    return sensitivity.ravel()
+
+
+def select_points(grid, scores, select="top", n_refine=None, threshold=None):
+    """
+    Chooses the grid points that get spatial stochastic replicates.
+
+    Args:
+        grid (dict): The parameter grid.
+        scores (list): Screening score of every point (criterion value).
+        select (str or callable): "top" (highest scores), "sensitivity" (largest local change of the score, see
+                                  `grid_sensitivity`) or a callable (scores -> values to rank by).
+        n_refine (int, optional): Number of points to refine.
+        threshold (float, optional): Refine every point whose ranking value is at least this (in addition to the
+                                     n_refine best ones).
+
+    Returns:
+        list: Indices of the selected points, best first.
+    """
+    if callable(select):
+        values = np.asarray(select(scores), dtype=np.float64)
+    elif select == "top":
+        values = np.asarray(scores, dtype=np.float64)
+    elif select == "sensitivity":
+        values = grid_sensitivity(grid, scores)
+    else:
+        raise ValueError(f"Unknown selection '{select}', use 'top', 'sensitivity' or a callable.")
+
+    order = [int(i) for i in np.argsort(-values, kind="stable") if np.isfinite(values[i])]
+    selected = set(order[:n_refine] if n_refine else [])
+    if threshold is not None:
+        selected |= {i for i in order if values[i] >= threshold}
+    return [i for i in order if i in selected]
+
+
+def _screen_point(base_parameters, overrides, mesh_path, save_path, model_type, solver, replicats, seed,
+                  load_model_kwargs):
+    """
+    Runs the screening replicates of one grid point on this rank alone and returns the in-memory results.
+    """
+    from src.SimManager import SimManager
+
+    sm = SimManager(parameters=dict(base_parameters, **overrides),
+                    mesh_path=mesh_path,
+                    save_path=save_path,
+                    runname="screening",
+                    plot_only_run=False,
+                    replace=False,
+                    comm=MPI.COMM_SELF)
+    sm.load_model(type=model_type, seed=seed, solver=solver, **load_model_kwargs)
+    # no output handler attached, the result selectors keep their data in memory
+    for i in range(replicats):
+        sm._run_replicate(i)
+    return {name: {"labels": list(sel.labels), "time": np.asarray(sel.time[0]), "data": np.asarray(sel.data)}
+            for name, sel in sm.saved_selectors.items()}
+
+
+def _write_index(index_path, index):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2, default=str)
+    os.replace(tmp_path, index_path)
+
+
+def run_multifidelity_scan(base_parameters, grid, mesh_path, save_root, criterion, select="top", n_refine=None,
+                           threshold=None, model_type="small", screening_solver="TetODE", screening_replicats=1,
+                           refine_solver="TetOpSplit", refine_replicats=1, seed=None, screening_options=None,
+                           **load_model_kwargs):
+    """
+    Evaluates a parameter grid with a cheap solver first and runs the expensive spatial stochastic replicates only
+    for the points the screening selects.
+
+    1. Screening: every grid point is run with `screening_solver` (well-mixed or deterministic, see
+       `src/Solvers.py`). The points are distributed over the MPI ranks, every rank runs its points serially. The
+       results go to `save_root/screening.h5`, one group per point in the layout of `run_ensemble`, so
+       `load_results(save_root + "/screening", "point_3")` works.
+    2. Selection: `criterion(results)` turns the results of a point into a score, `select_points` picks the points
+       to refine from the scores.
+    3. Refinement: the selected points are run with `refine_solver` on all ranks, `refine_replicats` replicates
+       each, into `save_root/refined/point_{i}.h5` (run name `point_{i}`).
+
+    Both fidelity levels are recorded in one index, `save_root/index.json`, which lists every point with its
+    parameters, its screening score and, if it was refined, where its spatial results are. It is rewritten after
+    every step, so an interrupted scan shows how far it got.
+
+    Args:
+        base_parameters (dict): Parameters shared by all points, see `parameters.py`.
+        grid (dict): Parameter name -> list of values, e.g. {"k[0]": [1e7, 1e8], "DC": [1e-12, 4e-12]}.
+        mesh_path (str): Path to the .inp mesh.
+        save_root (str): Directory of all outputs.
+        criterion (callable): results -> float, where results is {selector name: {"time", "data" (R, T, C),
+                              "labels"}}, e.g. `peak("ERKpp")`.
+        select, n_refine, threshold: How the refined points are chosen, see `select_points`.
+        model_type (str): Passed to `SimManager.load_model`.
+        screening_solver (str): Solver of the screening. The default TetODE adapts its step to the stiff nuclear
+                                reactions (first order rates up to 1e8 1/s), the fixed step of "Wmrk4" has to be
+                                below ~2.8 / fastest rate to stay stable (set "rk4_dt" in screening_options).
+        screening_replicats (int): Replicates per point for a stochastic screening solver.
+        refine_solver (str): Solver of the refinement, usually "TetOpSplit" (or "Tetexact" in serial).
+        refine_replicats (int): Spatial replicates per selected point.
+        seed (int, optional): Seed of all runs. If None, the models draw their own.
+        screening_options (dict, optional): `solver_options` of the screening solver (e.g. {"tolerances": ...}).
+        **load_model_kwargs: Further keyword arguments for `SimManager.load_model` (e.g. partitioner).
+
+    Returns:
+        dict: The index (on every rank).
+    """
+    from src.SimManager import SimManager
+
+    comm = MPI.COMM_WORLD
+    rank, size = comm.Get_rank(), comm.Get_size()
+    points = expand_grid(grid)
+    index_path = os.path.join(save_root, "index.json")
+    screening_file = os.path.join(save_root, "screening")
+    if rank == 0:
+        os.makedirs(os.path.join(save_root, "refined"), exist_ok=True)
+
+    # 1. screening, round robin over the ranks
+    start_time = time.time()
+    local = {}
+    for point_id in range(rank, len(points), size):
+        results = _screen_point(base_parameters, points[point_id], mesh_path, screening_file, model_type,
+                                screening_solver, screening_replicats, seed,
+                                dict(load_model_kwargs, solver_options=screening_options))
+        finite = all(np.all(np.isfinite(sel["data"])) for sel in results.values())
+        local[point_id] = {"score": float(criterion(results)) if finite else np.nan, "results": results,
+                           "finite": finite}
+        print(f"Rank {rank} screened point {point_id + 1}/{len(points)}: {local[point_id]['score']:.6g}")
+    gathered = comm.gather(local, root=0)
+
+    screened, diverged = {}, None
+    if rank == 0:
+        for part in gathered:
+            screened.update(part)
+        diverged = [i for i in range(len(points)) if not screened[i]["finite"]]
+    # a diverged screening would rank the points by garbage, every rank stops
+    diverged = comm.bcast(diverged, root=0)
+    if diverged:
+        raise ValueError(f"The {screening_solver} screening of points {diverged} diverged (inf/NaN), use a stiff "
+                         f"solver (TetODE) or a smaller step.")
+
+    index = None
+    if rank == 0:
+        scores = [screened[i]["score"] for i in range(len(points))]
+        with h5py.File(screening_file + ".h5", "w") as f:
+            for point_id in range(len(points)):
+                group = f.create_group(f"point_{point_id}")
+                group.attrs["format"] = ENSEMBLE_FORMAT
+                group.attrs["parameters"] = json.dumps(dict(base_parameters, **points[point_id]), default=str)
+                group.attrs["mesh_path"] = mesh_path
+                group.attrs["model_type"] = model_type
+                group.attrs["solver"] = screening_solver
+                for name, sel in screened[point_id]["results"].items():
+                    sub = group.create_group(name)
+                    sub.create_dataset("time", data=sel["time"])
+                    sub.create_dataset("data", data=sel["data"], compression="gzip", compression_opts=5)
+                    sub.attrs["labels"] = json.dumps(sel["labels"])
+
+        selected = select_points(grid, scores, select=select, n_refine=n_refine, threshold=threshold)
+        index = {"grid": grid,
+                 "base_parameters": base_parameters,
+                 "mesh_path": mesh_path,
+                 "model_type": model_type,
+                 "criterion": getattr(criterion, "__name__", repr(criterion)),
+                 "selection": select if isinstance(select, str) else getattr(select, "__name__", repr(select)),
+                 "screening": {"solver": screening_solver, "replicats": screening_replicats,
+                               "file": screening_file + ".h5", "seconds": time.time() - start_time},
+                 "refinement": {"solver": refine_solver, "replicats": refine_replicats},
+                 "points": [{"point": i,
+                             "overrides": points[i],
+                             "score": scores[i],
+                             "selected": i in selected,
+                             "screening_group": f"point_{i}",
+                             "refined": None} for i in range(len(points))]}
+        _write_index(index_path, index)
+        print(f"Screened {len(points)} points in {time.time() - start_time:.2f} seconds, refining {selected}")
+    index = comm.bcast(index, root=0)
+
+    # 2. refinement, every selected point on all ranks
+    for entry in index["points"]:
+        if not entry["selected"]:
+            continue
+        point_id = entry["point"]
+        save_path = os.path.join(save_root, "refined", f"point_{point_id}")
+        point_start = time.time()
+        sm = SimManager(parameters=dict(base_parameters, **entry["overrides"]),
+                        mesh_path=mesh_path,
+                        save_path=save_path,
+                        parallel=size > 1,
+                        runname=f"point_{point_id}",
+                        plot_only_run=False,
+                        replace=True)
+        sm.load_model(type=model_type, seed=seed, solver=refine_solver, **load_model_kwargs)
+        sm.run(replicats=refine_replicats)
+        entry["refined"] = {"file": save_path + ".h5", "runname": f"point_{point_id}",
+                            "seconds": time.time() - point_start}
+        if rank == 0:
+            _write_index(index_path, index)
+    return index
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import numpy as np
+import steps.interface
+import steps.geom as stgeom
+from src.MeshCache import encode_triangles
+
+OUTPUT_MODES = ("species", "aggregated")
+
+
+def aggregated_selectors(rs, location_species):
+    """
+    Builds one LIST selector per compartment/patch that returns the counts of all its species at once.
+
+    Instead of one `rs.SUM(rs.TETS(tets).X.Count)` per species, which walks the tets again for every species at every
+    save step and writes one dataset each, every location gets a single `rs.<location>.LIST(...).Count` selector. Its
+    rows are (n_species,) vectors, so a saved location is one (time, n_species) dataset. The species order is stored
+    in the labels and in `metaData["species"]`.
+
+    Compartment/patch counts are the totals over all tets/tris of the location, i.e. the same numbers as the SUM
+    selectors over `TETS(compartment tets)` / `TRIS(patch tris)`, and they work with every solver.
+
+    Args:
+        rs (stsave.ResultSelector): Result selector of the simulation.
+        location_species (dict): Compartment/patch name -> list of species names to save there.
+
+    Returns:
+        dict: Location name -> selector, empty locations are skipped.
+    """
+    selectors = {}
+    for location, species in location_species.items():
+        if not species:
+            continue
+        selector = getattr(rs, location).LIST(*species).Count
+        selector.metaData["species"] = list(species)
+        selector.metaData["location"] = [location] * len(species)  # STEPS metaData holds one value per column
+        selectors[location] = selector
+    return selectors
+
+
+PROFILE_KINDS = ("membrane_distance", "nucleus_distance", "axial")
+
+
+def surface_distance(points, verts, tris):
+    """
+    Distance of every point to the closest point of a triangulated surface, approximated by the closest vertex or
+    triangle center (the error is below half an edge length, i.e. below the resolution of the mesh anyway).
+    """
+    from scipy.spatial import cKDTree
+    tris = np.asarray(tris)
+    verts = np.asarray(verts)
+    references = np.vstack([verts[np.unique(tris)], verts[tris].mean(axis=1)])
+    distances, _ = cKDTree(references).query(points)
+    return distances
+
+
+def long_axis(mesh_arrays, groups):
+    """
+    Returns (center, unit vector) of the longest principal axis of the given tet groups, weighted by tet volume.
+    The sign is chosen so that the largest component of the axis is positive.
+    """
+    idx = np.concatenate([np.asarray(mesh_arrays.tet_groups[group]) for group in groups])
+    centers = np.asarray(mesh_arrays.tet_centers)[idx]
+    volumes = np.asarray(mesh_arrays.tet_volumes)[idx]
+    center = np.average(centers, axis=0, weights=volumes)
+    offsets = centers - center
+    eigenvalues, eigenvectors = np.linalg.eigh((offsets * volumes[:, None]).T @ offsets)
+    axis = eigenvectors[:, np.argmax(eigenvalues)]
+    return center, axis * np.sign(axis[np.argmax(np.abs(axis))])
+
+
+def tet_coordinate(mesh_arrays, kind, tet_idx, group_names):
+    """
+    The coordinate the tets are binned by:
+
+    - "membrane_distance": distance of the tet center to the cell membrane (surface between cyt and exo).
+    - "nucleus_distance": distance of the tet center to the surface of the nucleus.
+    - "axial": position of the tet center along the long axis of the cell (cyt + nuc), relative to its center.
+    """
+    centers = np.asarray(mesh_arrays.tet_centers)[tet_idx]
+    if kind == "membrane_distance":
+        n_verts = len(mesh_arrays.verts)
+        cyt_surface = np.asarray(mesh_arrays.group_surfaces[group_names["cyt"]])
+        shared = np.isin(encode_triangles(cyt_surface, n_verts),
+                         encode_triangles(mesh_arrays.group_surfaces[group_names["exo"]], n_verts))
+        return surface_distance(centers, mesh_arrays.verts, cyt_surface[shared])
+    elif kind == "nucleus_distance":
+        return surface_distance(centers, mesh_arrays.verts, mesh_arrays.group_surfaces[group_names["nuc"]])
+    elif kind == "axial":
+        center, axis = long_axis(mesh_arrays, [group_names[name] for name in ("cyt", "nuc") if name in group_names])
+        return (centers - center) @ axis
+    raise ValueError(f"Unknown profile kind '{kind}', use one of {PROFILE_KINDS}.")
+
+
+def profile_cache_path(mesh_arrays, kind, compartment, group_names, n_bins, edges):
+    if mesh_arrays.cache_dir is None:
+        return None
+    key = json.dumps({"mesh": mesh_arrays.fingerprint, "kind": kind, "compartment": compartment,
+                      "group_names": group_names, "n_bins": n_bins,
+                      "edges": None if edges is None else np.asarray(edges, dtype=float).tolist()}, sort_keys=True)
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(mesh_arrays.cache_dir, "profiles", f"{kind}_{compartment}_{digest}.npz")
+
+
+def build_profile(mesh_arrays, kind, compartment, group_names, n_bins=20, edges=None):
+    """
+    Assigns the tets of a compartment to spatial bins, i.e. precomputes the sparse tet -> bin matrix of a profile.
+
+    The assignment is cached in the cache directory of the mesh (like the partitions), keyed by the mesh and all
+    settings.
+
+    Args:
+        mesh_arrays (CachedMesh): Cached mesh, see `src/MeshCache.py`.
+        kind (str): One of `PROFILE_KINDS`, see `tet_coordinate`.
+        compartment (str): Compartment whose tets are binned, e.g. "cyt".
+        group_names (dict): Compartment name -> tet group name.
+        n_bins (int): Number of equally wide bins between the smallest and the largest coordinate.
+        edges (array, optional): Explicit bin edges, overrides n_bins. Tets outside are not counted.
+
+    Returns:
+        dict: "kind", "compartment", "edges", "tet_bins" (bin of every tet of the mesh, -1 if not in the profile),
+              "bin_volumes" and "matrix" (scipy.sparse (n_bins, n_tets) matrix, profile = matrix @ per-tet counts).
+    """
+    from scipy.sparse import csr_matrix
+
+    cache_path = profile_cache_path(mesh_arrays, kind, compartment, group_names, n_bins, edges)
+    if cache_path is not None and os.path.isfile(cache_path):
+        with np.load(cache_path) as data:
+            tet_bins, edges = data["tet_bins"], data["edges"]
+    else:
+        tet_idx = np.asarray(mesh_arrays.tet_groups[group_names[compartment]])
+        coordinate = tet_coordinate(mesh_arrays, kind, tet_idx, group_names)
+        if edges is None:
+            edges = np.linspace(coordinate.min(), coordinate.max(), n_bins + 1)
+        edges = np.asarray(edges, dtype=np.float64)
+        bins = np.searchsorted(edges, coordinate, side="right") - 1
+        bins[coordinate == edges[-1]] = len(edges) - 2  # the largest value belongs to the last bin
+        bins[(coordinate < edges[0]) | (coordinate > edges[-1])] = -1
+        tet_bins = np.full(len(mesh_arrays.tets), -1, dtype=np.int64)
+        tet_bins[tet_idx] = bins
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, tet_bins=tet_bins, edges=edges)
+            os.replace(tmp_path, cache_path)
+
+    inside = np.flatnonzero(tet_bins >= 0)
+    matrix = csr_matrix((np.ones(len(inside)), (tet_bins[inside], inside)),
+                        shape=(len(edges) - 1, len(tet_bins)))
+    return {"kind": kind, "compartment": compartment, "edges": edges, "tet_bins": tet_bins,
+            "bin_volumes": matrix @ np.asarray(mesh_arrays.tet_volumes), "matrix": matrix}
+
+
+def profile_selector(rs, mesh, profile, species):
+    """
+    Builds the selector of a profile: for every species the counts summed per bin, as one row of
+    n_species * n_bins values per save step.
+
+    STEPS result selectors cannot multiply by a matrix, so the rows of the tet -> bin matrix become one SUM over the
+    tets of every bin, concatenated with `<<`. STEPS evaluates these reductions itself at every save step, only the
+    short profile vector is stored. Empty bins are left out, the bin of every column is in `metaData["bin"]`.
+    """
+    matrix = profile["matrix"]
+    edges = profile["edges"]
+    columns = {"species": [], "bin": [], "bin_lower": [], "bin_upper": [], "bin_volume": []}
+    selector = None
+    with mesh:
+        bin_tets = [stgeom.TetList(matrix.indices[matrix.indptr[b]:matrix.indptr[b + 1]].tolist())
+                    for b in range(matrix.shape[0])]
+    for name in species:
+        for b, tets in enumerate(bin_tets):
+            if len(tets) == 0:
+                continue
+            column = rs.SUM(getattr(rs.TETS(tets), name).Count)
+            selector = column if selector is None else selector << column
+            columns["species"].append(name)
+            columns["bin"].append(b)
+            columns["bin_lower"].append(float(edges[b]))
+            columns["bin_upper"].append(float(edges[b + 1]))
+            columns["bin_volume"].append(float(profile["bin_volumes"][b]))
+    for key, values in columns.items():
+        selector.metaData[key] = values
+    selector.metaData["profile"] = [f"{profile['kind']}:{profile['compartment']}"] * len(columns["bin"])
+    return selector
+
+
+def profile_selectors(rs, mesh, mesh_arrays, specs, group_names):
+    """
+    Builds the selectors of all requested profiles.
+
+    Args:
+        rs (stsave.ResultSelector): Result selector of the simulation.
+        mesh (stgeom.TetMesh): The mesh of the simulation.
+        mesh_arrays (CachedMesh): The cached arrays of the same mesh.
+        specs (list): One dict per profile with "species" (list), "kind" (see `PROFILE_KINDS`), and optionally
+                      "compartment" (default "cyt"), "n_bins" (default 20), "edges" and "name" (default
+                      "profile_{kind}_{compartment}").
+        group_names (dict): Compartment name -> tet group name.
+
+    Returns:
+        tuple: (dict name -> selector, dict name -> profile, see `build_profile`)
+    """
+    selectors, profiles = {}, {}
+    for spec in specs:
+        compartment = spec.get("compartment", "cyt")
+        name = spec.get("name", f"profile_{spec['kind']}_{compartment}")
+        profiles[name] = build_profile(mesh_arrays, spec["kind"], compartment, group_names,
+                                       n_bins=spec.get("n_bins", 20), edges=spec.get("edges"))
+        selectors[name] = profile_selector(rs, mesh, profiles[name], spec["species"])
+    return selectors, profiles
@@ -0,0 +1,254 @@
+import json
+import os
+import warnings
+import h5py
+import numpy as np
+
+# How result datasets are stored on disk:
+#   codec      "gzip" (level 0-9), "lzf" (fast, always available in h5py) or "blosc" (needs hdf5plugin, falls back to lzf)
+#   shuffle    HDF5 byte shuffle, groups the bytes of the values, which helps a lot for small integers
+#   integer    store integer valued data (molecule counts) as the smallest integer type that holds it
+#   delta      store differences along time instead of values (counts change slowly), decoded on read
+#   chunks     "time": one chunk holds the whole time series of a replicate for a group of columns, which is what
+#              plot.py and the criteria read; None keeps the chunking of h5py/STEPS
+OUTPUT_PROFILES = {
+    "legacy": {"codec": "gzip", "level": 5, "shuffle": False, "integer": False, "delta": False, "chunks": None},
+    "compact": {"codec": "gzip", "level": 4, "shuffle": True, "integer": True, "delta": False, "chunks": "time"},
+    "delta": {"codec": "gzip", "level": 4, "shuffle": True, "integer": True, "delta": True, "chunks": "time"},
+    "fast": {"codec": "lzf", "shuffle": True, "integer": True, "delta": False, "chunks": "time"},
+    "blosc": {"codec": "blosc", "cname": "lz4", "level": 5, "shuffle": True, "integer": True, "delta": False,
+              "chunks": "time"},
+}
+
+# target size of an uncompressed chunk, HDF5 recommends 10 KiB - 1 MiB
+CHUNK_BYTES = 2**20
+
+
+def get_profile(profile):
+    """
+    Returns the settings of an output profile, given by name (see `OUTPUT_PROFILES`) or as a dict, which overrides
+    the settings of "compact".
+    """
+    if isinstance(profile, dict):
+        return dict(OUTPUT_PROFILES["compact"], **profile)
+    assert profile in OUTPUT_PROFILES, f"Unknown output profile '{profile}', use one of {list(OUTPUT_PROFILES)}."
+    return dict(OUTPUT_PROFILES[profile])
+
+
+def register_plugins():
+    """
+    Registers the compression filters of hdf5plugin (Blosc, LZ4, ...) with HDF5 if it is installed. Files written with
+    the "blosc" profile can only be read after this.
+    """
+    try:
+        import hdf5plugin
+        return hdf5plugin
+    except ImportError:
+        return None
+
+
+def codec_kwargs(profile):
+    """
+    The compression keyword arguments of `h5py.Group.create_dataset` for a profile (also usable as
+    `hdf5DatasetKwArgs` of the STEPS handlers).
+    """
+    profile = get_profile(profile)
+    if profile["codec"] == "blosc":
+        hdf5plugin = register_plugins()
+        if hdf5plugin is not None:
+            shuffle = hdf5plugin.Blosc.SHUFFLE if profile["shuffle"] else hdf5plugin.Blosc.NOSHUFFLE
+            return dict(hdf5plugin.Blosc(cname=profile.get("cname", "lz4"), clevel=profile.get("level", 5),
+                                         shuffle=shuffle))
+        warnings.warn("hdf5plugin is not installed, the 'blosc' output profile uses lzf instead.", UserWarning)
+        return {"compression": "lzf", "shuffle": profile["shuffle"]}
+    kwargs = {"compression": profile["codec"], "shuffle": profile["shuffle"]}
+    if profile["codec"] == "gzip":
+        kwargs["compression_opts"] = profile.get("level", 4)
+    return kwargs
+
+
+def smallest_integer_dtype(data, signed=False):
+    """
+    Returns the smallest integer dtype that holds all values of `data`, or None if not all values are integers.
+    """
+    data = np.asarray(data)
+    if data.size == 0:
+        return None
+    if not np.issubdtype(data.dtype, np.integer):
+        if not np.all(np.isfinite(data)) or not np.array_equal(data, np.round(data)):
+            return None
+    low, high = data.min(), data.max()
+    candidates = (np.int8, np.int16, np.int32, np.int64) if signed or low < 0 else \
+        (np.uint8, np.uint16, np.uint32, np.uint64)
+    for dtype in candidates:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return None
+
+
+def time_chunks(shape, itemsize, target_bytes=CHUNK_BYTES):
+    """
+    Chunk shape of a (replicates, time, columns) dataset for reads along time: one replicate, the whole time axis
+    (or as much of it as fits into `target_bytes`) and as many columns as fit next to it.
+    """
+    n_time, n_columns = max(shape[1], 1), max(shape[2], 1)
+    per_column = n_time * itemsize
+    if per_column > target_bytes:
+        return (1, max(target_bytes // itemsize, 1), 1)
+    return (1, n_time, int(min(n_columns, max(target_bytes // per_column, 1))))
+
+
+def encode(data, profile, allow_delta=True):
+    """
+    Converts the (replicates, time, columns) values of a result selector into what a profile stores.
+
+    Returns:
+        tuple: (array to store, dict of dataset attributes that describe the encoding)
+    """
+    profile = get_profile(profile)
+    data = np.asarray(data)
+    attrs = {}
+    if not profile["integer"]:
+        return data, attrs
+    dtype = smallest_integer_dtype(data)
+    if dtype is None:  # concentrations etc. are stored as they are
+        return data, attrs
+    if profile["delta"] and allow_delta and data.ndim == 3 and data.shape[1] > 1:
+        deltas = np.diff(data.astype(np.int64), axis=1, prepend=0)
+        attrs = {"encoding": "delta", "decoded_dtype": dtype.str}
+        return deltas.astype(smallest_integer_dtype(deltas, signed=True)), attrs
+    return data.astype(dtype), attrs
+
+
+def write_dataset(group, name, data, profile, allow_delta=True, resizable=True):
+    """
+    Writes result data into `group[name]` with the dtype, encoding, chunks and codec of a profile.
+
+    With `resizable` further runs can be appended along the first axis. Only use that where the appended data is
+    encoded with the same profile: HDF5 silently clips values that do not fit a narrow integer type.
+    """
+    profile = get_profile(profile)
+    values, attrs = encode(data, profile, allow_delta)
+    kwargs = codec_kwargs(profile)
+    if values.ndim == 3 and values.size > 0:
+        kwargs["chunks"] = time_chunks(values.shape, values.dtype.itemsize) if profile["chunks"] == "time" else True
+        if resizable:
+            kwargs["maxshape"] = (None,) + values.shape[1:]
+    dataset = group.create_dataset(name, data=values, **kwargs)
+    dataset.attrs.update(attrs)
+    return dataset
+
+
+class DeltaDataset:
+    """
+    Read-only view of a delta encoded dataset that decodes on access, with the indexing of an h5py dataset:
+    `data[replicates, time, columns]`. Only the requested replicates and columns are read, always over the whole
+    time axis (which is what the time aligned chunks hold).
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self.ndim = dataset.ndim
+        self.dtype = np.dtype(dataset.attrs["decoded_dtype"])
+        self.attrs = dataset.attrs
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[()]
+        return values if dtype is None else values.astype(dtype)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        replicates, times, columns = key
+
+        # integer indices would drop an axis before the cumulative sum, read them as length one slices
+        read, keep = [], []
+        for axis, k in ((0, replicates), (2, columns)):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) % self.shape[axis]
+                read.append(slice(k, k + 1))
+                keep.append(0)
+            else:
+                read.append(k)
+                keep.append(slice(None))
+        values = np.cumsum(self.dataset[read[0], :, read[1]], axis=1, dtype=np.int64)
+        return values[keep[0], times, keep[1]].astype(self.dtype)
+
+
+def decode(dataset):
+    """
+    Returns something that reads like the original data: the dataset itself, or a `DeltaDataset` for delta
+    encoded ones.
+    """
+    if dataset.attrs.get("encoding") == "delta":
+        return DeltaDataset(dataset)
+    return dataset
+
+
+def _repack_group(source, target, profile, allow_delta, resizable, stats):
+    target.attrs.update(source.attrs)
+    for name, item in source.items():
+        if isinstance(item, h5py.Group):
+            _repack_group(item, target.create_group(name), profile, allow_delta, resizable, stats)
+        elif name == "data" and item.ndim == 3:  # the (runs, time, columns) values of a result selector
+            attrs = {key: value for key, value in item.attrs.items() if key not in ("encoding", "decoded_dtype")}
+            dataset = write_dataset(target, name, decode(item)[()], profile, allow_delta, resizable)
+            dataset.attrs.update(attrs)
+            dataset.attrs["output_profile"] = json.dumps(profile)
+            stats["datasets"] += 1
+            stats["integer"] += int(np.issubdtype(dataset.dtype, np.integer))
+        else:
+            source.copy(item, target, name=name)
+
+
+def apply_output_profile(h5_path, profile, allow_delta=True, resizable=True):
+    """
+    Rewrites the result datasets of an HDF5 file (every 3D "data" dataset, i.e. the (runs, time, columns) values of
+    the result selectors, both in the STEPS and in the ensemble layout) with the dtype, chunks and codec of a profile.
+    Everything else (time, labels, metadata, mesh data) is copied unchanged. The file is replaced atomically.
+
+    Args:
+        h5_path (str): Path of the .h5 file.
+        profile (str or dict): Output profile, see `OUTPUT_PROFILES`.
+        allow_delta (bool): False for files that are read by `stsave.HDF5Handler`, which cannot decode deltas.
+                            Delta profiles then store plain integers.
+        resizable (bool): False for files STEPS could append to: the rewritten datasets get a fixed size, so that an
+                          append of float counts fails instead of being clipped to the narrow integer type.
+
+    Returns:
+        dict: Number of rewritten datasets, how many of them became integers, and the file size before and after.
+    """
+    profile = get_profile(profile)
+    if profile["delta"] and not allow_delta:
+        warnings.warn("This file is read by STEPS, which cannot decode deltas, storing plain integers instead.",
+                      UserWarning)
+    register_plugins()
+    stats = {"datasets": 0, "integer": 0, "bytes_before": os.path.getsize(h5_path)}
+    tmp_path = f"{h5_path}.{os.getpid()}.tmp"
+    with h5py.File(h5_path, "r") as source, h5py.File(tmp_path, "w") as target:
+        _repack_group(source, target, profile, allow_delta, resizable, stats)
+    os.replace(tmp_path, h5_path)
+    stats["bytes_after"] = os.path.getsize(h5_path)
+    return stats
+
+
+def is_repacked(h5_path, uid):
+    """
+    True if result datasets of the run `uid` in `h5_path` were rewritten by `apply_output_profile`.
+    """
+    if not os.path.isfile(h5_path):
+        return False
+    found = []
+    with h5py.File(h5_path, "r") as f:
+        if uid in f:
+            f[uid].visititems(lambda name, item: found.append(name) if isinstance(item, h5py.Dataset)
+                              and "output_profile" in item.attrs else None)
+    return bool(found)
@@ -0,0 +1,101 @@
+import warnings
+
+
+class ParameterBindings:
+    """
+    Records where the reaction and diffusion constants of a model live in a built simulation and which of them are
+    computed from an entry of the parameter dict (e.g. `p["k[0]"]` or `p["DC"]`).
+
+    The model files fill this while they define the model, `SimManager` uses it to change constants of an existing
+    simulation instead of building a new one (see `SimManager.update_parameters`).
+
+    Attributes:
+        reactions (dict): Label (e.g. "r[6]") -> (STEPS name of the reaction, list of location names).
+        diffusions (dict): Species name -> list of (STEPS name of the diffusion rule, location name).
+        bindings (list): (parameter key, "reaction"/"diffusion", label or species, location, direction, transform).
+    """
+
+    def __init__(self, diffusion=True):
+        """
+        Args:
+            diffusion (bool): If False, diffusion rules are not registered (well-mixed solvers have no diffusion).
+        """
+        self.diffusion = diffusion
+        self.reactions = {}
+        self.diffusions = {}
+        self.bindings = []
+
+    def add_reaction(self, label, reaction, locations, key=None, direction=None, transform=None):
+        """
+        Registers a reaction (or one direction of it) and optionally the parameter its constant is computed from.
+
+        Args:
+            label (str): Name the reaction is looked up by, e.g. "r[6]".
+            reaction (stmodel.Reaction): The reaction of the model.
+            locations (str or list): Compartments/patches whose system contains the reaction.
+            key (str, optional): Parameter the constant depends on.
+            direction (str, optional): "fwd" or "bkw" for the direction of a reversible reaction that uses `key`.
+            transform (callable, optional): parameter value -> constant, defaults to the value itself.
+        """
+        locations = [locations] if isinstance(locations, str) else list(locations)
+        self.reactions[label] = (reaction.name, locations)
+        if key is not None:
+            for location in locations:
+                self.bindings.append((key, "reaction", label, location, direction, transform))
+
+    def add_diffusion(self, species, diffusion, location, key=None, transform=None):
+        """
+        Registers the diffusion rule of `species` in `location` and optionally the parameter its constant is computed
+        from. Returns the diffusion rule, so it can wrap `stmodel.Diffusion(...)` directly.
+        """
+        if self.diffusion:
+            self.diffusions.setdefault(species, []).append((diffusion.name, location))
+            if key is not None:
+                self.bindings.append((key, "diffusion", species, location, None, transform))
+        return diffusion
+
+    def keys(self):
+        return {binding[0] for binding in self.bindings}
+
+    def set_reaction_constant(self, simulation, label, value, direction=None, locations=None):
+        """
+        Sets the rate constant of a registered reaction in all (or the given) locations of a built simulation.
+        """
+        assert label in self.reactions, f"Unknown reaction '{label}', known are {sorted(self.reactions)}."
+        name, registered = self.reactions[label]
+        for location in (registered if locations is None else locations):
+            path = getattr(getattr(simulation, location), name)
+            if direction is not None:
+                path = path[direction]
+            path.K = value
+
+    def set_diffusion_constant(self, simulation, species, value, locations=None):
+        """
+        Sets the diffusion constant of `species` in all (or the given) locations where it diffuses.
+        """
+        assert species in self.diffusions, f"No diffusion rule for '{species}' in this model/solver."
+        for name, location in self.diffusions[species]:
+            if locations is None or location in locations:
+                getattr(getattr(simulation, location), name).D = value
+
+    def apply(self, simulation, parameters, keys=None):
+        """
+        Recomputes every constant that depends on one of `keys` (default: all bound keys) from `parameters`.
+
+        Returns:
+            set: The keys that are not bound to any constant and therefore need a new model to take effect.
+        """
+        keys = set(self.keys() if keys is None else keys)
+        for key, kind, target, location, direction, transform in self.bindings:
+            if key not in keys:
+                continue
+            value = parameters[key] if transform is None else transform(parameters[key])
+            if kind == "reaction":
+                self.set_reaction_constant(simulation, target, value, direction, [location])
+            else:
+                self.set_diffusion_constant(simulation, target, value, [location])
+        unbound = keys - self.keys()
+        if unbound:
+            warnings.warn(f"Parameters {sorted(unbound)} are not bound to a constant of the simulation, they only "
+                          f"take effect with a new load_model call.", UserWarning)
+        return unbound
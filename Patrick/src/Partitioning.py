@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import numpy as np
+import steps.interface
+import steps.geom as stgeom
+from src.MeshCache import TET_FACES
+
+# relative cost of a tet per compartment. Most of the signaling happens in the cytosol and at the membrane, the
+# extracellular shell mostly just diffuses EGF around.
+DEFAULT_COMPARTMENT_WEIGHTS = {"exo": 0.25, "cyt": 1.0, "nuc": 0.5}
+# extra weight of the cytosol tets that touch the cell membrane (surface reactions of the patch)
+DEFAULT_MEMBRANE_WEIGHT = 1.0
+
+PARTITIONERS = ("linear", "morton", "axis")
+
+
+def face_adjacency(tets):
+    """
+    Returns an (n, 2) array with the pairs of tets that share a face.
+    """
+    faces = np.sort(tets[:, TET_FACES].reshape(-1, 3), axis=1)
+    owner = np.repeat(np.arange(len(tets)), 4)
+    order = np.lexsort(faces.T[::-1])
+    faces, owner = faces[order], owner[order]
+    same = np.all(faces[1:] == faces[:-1], axis=1)
+    return np.column_stack([owner[:-1][same], owner[1:][same]])
+
+
+def membrane_tets(mesh_arrays, inner_group, outer_group):
+    """
+    Returns the indices of the tets of `inner_group` that have a face on the surface shared with `outer_group`.
+    """
+    n_verts = len(mesh_arrays.verts)
+
+    def encode(tris):
+        # one integer per (sorted) triangle, so the set operations below are plain 1D numpy operations
+        tris = np.asarray(tris, dtype=np.int64)
+        return (tris[..., 0] * n_verts + tris[..., 1]) * n_verts + tris[..., 2]
+
+    shared = np.intersect1d(encode(mesh_arrays.group_surfaces[inner_group]),
+                            encode(mesh_arrays.group_surfaces[outer_group]))
+    inner_tets = np.asarray(mesh_arrays.tet_groups[inner_group])
+    faces = np.sort(np.asarray(mesh_arrays.tets)[inner_tets][:, TET_FACES], axis=2)
+    touches = np.isin(encode(faces), shared).any(axis=1)
+    return inner_tets[touches]
+
+
+def tet_weights(mesh_arrays, group_names, compartment_weights=None, membrane_weight=DEFAULT_MEMBRANE_WEIGHT,
+                volume_exponent=0.0, propensity=None):
+    """
+    Computes the expected cost of every tet for load balancing.
+
+    weight = compartment weight * (volume / mean volume) ** volume_exponent (+ membrane_weight for cytosol tets
+    at the cell membrane), or `propensity` if given.
+
+    Args:
+        mesh_arrays (CachedMesh): Cached mesh, see `src/MeshCache.py`.
+        group_names (dict): Compartment name -> tet group name, e.g. {"exo": "Volume1", "cyt": "Volume2", ...}.
+        compartment_weights (dict, optional): Compartment name -> relative cost of one of its tets.
+        membrane_weight (float, optional): Extra cost of cytosol tets that touch the cell membrane.
+        volume_exponent (float, optional): 0 balances tet counts, 1 balances volume (e.g. for molecule counts).
+        propensity (np.ndarray, optional): Expected propensity per tet, e.g. from a previous run. Overrides the rest.
+    """
+    if propensity is not None:
+        return np.asarray(propensity, dtype=np.float64)
+
+    compartment_weights = compartment_weights or DEFAULT_COMPARTMENT_WEIGHTS
+    volumes = np.asarray(mesh_arrays.tet_volumes)
+    weights = (volumes / volumes.mean()) ** volume_exponent
+    factor = np.zeros(len(volumes))
+    for compartment, group in group_names.items():
+        factor[np.asarray(mesh_arrays.tet_groups[group])] = compartment_weights.get(compartment, 1.0)
+    weights = weights * factor
+    if membrane_weight and "cyt" in group_names and "exo" in group_names:
+        weights[membrane_tets(mesh_arrays, group_names["cyt"], group_names["exo"])] += membrane_weight
+    return weights
+
+
+def morton_order(points, bits=21):
+    """
+    Returns the permutation that sorts the points along a Z-order (Morton) space filling curve.
+    """
+    low, high = points.min(axis=0), points.max(axis=0)
+    quantized = ((points - low) / np.where(high > low, high - low, 1) * (2**bits - 1)).astype(np.uint64)
+    code = np.zeros(len(points), dtype=np.uint64)
+    for bit in range(bits):
+        for dim in range(3):
+            code |= ((quantized[:, dim] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3 * bit + dim)
+    return np.argsort(code, kind="stable")
+
+
+def weighted_split(order, weights, n_hosts):
+    """
+    Cuts the tets, taken in the given order, into `n_hosts` consecutive chunks of (close to) equal total weight.
+
+    Returns:
+        np.ndarray: Host of every tet.
+    """
+    cumulative = np.cumsum(weights[order])
+    targets = cumulative[-1] * np.arange(1, n_hosts) / n_hosts
+    bounds = np.concatenate([[0], np.searchsorted(cumulative, targets), [len(order)]])
+    hosts = np.empty(len(order), dtype=np.int64)
+    for host in range(n_hosts):
+        hosts[order[bounds[host]:bounds[host + 1]]] = host
+    return hosts
+
+
+def partition_report(tet_hosts, weights, adjacency, n_hosts):
+    """
+    Returns the load of every host, the imbalance (max load / mean load) and the number of faces between tets of
+    different hosts, which is what the ranks have to communicate over.
+    """
+    loads = np.bincount(tet_hosts, weights=weights, minlength=n_hosts)
+    return {"loads": loads.tolist(),
+            "tets_per_host": np.bincount(tet_hosts, minlength=n_hosts).tolist(),
+            "imbalance": float(loads.max() / loads.mean()) if loads.mean() > 0 else 1.0,
+            "cut_faces": int(np.count_nonzero(tet_hosts[adjacency[:, 0]] != tet_hosts[adjacency[:, 1]]))}
+
+
+def compute_tet_hosts(mesh_arrays, n_hosts, method, group_names, **weight_options):
+    """
+    Assigns every tet to a host with the given method ("morton" or "axis").
+
+    "morton" walks the tets along a Z-order curve of their centers, which keeps the chunks compact in all three
+    directions. "axis" walks them along the longest extent of the mesh and cuts into slabs by weight, where
+    LinearMeshPartition cuts slabs of equal width along z.
+
+    Returns:
+        tuple: (tet hosts, weights)
+    """
+    assert method in ("morton", "axis"), f"Unknown partition method '{method}', use one of {PARTITIONERS}."
+    weights = tet_weights(mesh_arrays, group_names, **weight_options)
+    centers = np.asarray(mesh_arrays.tet_centers)
+    if method == "morton":
+        order = morton_order(centers)
+    else:
+        axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+        order = np.argsort(centers[:, axis], kind="stable")
+    return weighted_split(order, weights, n_hosts), weights
+
+
+def patch_tri_hosts(patch, tet_hosts, inner_tets):
+    """
+    Puts every triangle of a patch on the host of its neighbouring tet in the inner compartment.
+    """
+    inner = set(int(idx) for idx in inner_tets)
+    tri_hosts = {}
+    for tri in patch.tris:
+        neighbours = [tet.idx for tet in tri.tetNeighbs]
+        inner_neighbours = [idx for idx in neighbours if idx in inner] or neighbours
+        tri_hosts[tri.idx] = int(tet_hosts[inner_neighbours[0]])
+    return tri_hosts
+
+
+def partition_cache_path(mesh_arrays, n_hosts, method, group_names, patches, weight_options):
+    """
+    Path of the cached partition for this mesh, rank count and partitioner settings, inside the mesh cache directory.
+    Returns None if the mesh has no cache directory.
+    """
+    if mesh_arrays.cache_dir is None:
+        return None
+    settings = {key: (hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+                      if isinstance(value, np.ndarray) else value)
+                for key, value in weight_options.items()}
+    key = json.dumps({"mesh": mesh_arrays.fingerprint, "n_hosts": n_hosts, "method": method,
+                      "group_names": group_names, "patches": [inner_group for patch, inner_group in patches],
+                      "weights": settings}, sort_keys=True, default=str)
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(mesh_arrays.cache_dir, "partitions", f"{method}_n{n_hosts}_{digest}.npz")
+
+
+def save_partition(path, tet_hosts, tri_hosts, report):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, tet_hosts=tet_hosts,
+                 tri_idx=np.fromiter(tri_hosts.keys(), dtype=np.int64, count=len(tri_hosts)),
+                 tri_host=np.fromiter(tri_hosts.values(), dtype=np.int64, count=len(tri_hosts)),
+                 report=np.array(json.dumps(report)))
+    os.replace(tmp_path, path)
+
+
+def load_partition(path):
+    """
+    Returns (tet hosts, tri hosts, report) of a cached partition, or None if there is no usable cache.
+    """
+    if path is None or not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            tri_hosts = dict(zip(data["tri_idx"].tolist(), data["tri_host"].tolist()))
+            return data["tet_hosts"], tri_hosts, json.loads(str(data["report"]))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def compute_partition(mesh_arrays, n_hosts, method, group_names, patches, **weight_options):
+    """
+    Computes tet hosts, tri hosts and the report of a weighted partition, see `compute_tet_hosts`.
+    """
+    tet_hosts, weights = compute_tet_hosts(mesh_arrays, n_hosts, method, group_names, **weight_options)
+    tri_hosts = {}
+    for patch, inner_group in patches:
+        tri_hosts.update(patch_tri_hosts(patch, tet_hosts, mesh_arrays.tet_groups[inner_group]))
+    report = partition_report(tet_hosts, weights, face_adjacency(np.asarray(mesh_arrays.tets)), n_hosts)
+    return tet_hosts, tri_hosts, report
+
+
+def make_partition(mesh, mesh_arrays, n_hosts, method="linear", group_names=None, patches=(), verbose=True,
+                   comm=None, **weight_options):
+    """
+    Builds the mesh partition for TetOpSplit.
+
+    The weighted partitions are cached (tet -> host and tri -> host arrays plus the report) in the cache directory of
+    the mesh, keyed by the mesh fingerprint, the number of hosts and all partitioner settings. Only rank 0 of `comm`
+    computes or loads them, the other ranks get the result by broadcast.
+
+    Args:
+        mesh (stgeom.TetMesh): The STEPS mesh.
+        mesh_arrays (CachedMesh): The cached arrays of the same mesh.
+        n_hosts (int): Number of ranks.
+        method (str): "linear" (stgeom.LinearMeshPartition, equal slabs along z, the old behaviour), "morton" or "axis"
+                      (weighted, see `compute_tet_hosts`).
+        group_names (dict): Compartment name -> tet group name, used for the compartment weights.
+        patches (iterable): (patch, name of the tet group of its inner compartment) of all patches of the mesh.
+        verbose (bool): Print the imbalance and the number of cut faces.
+        comm (MPI.Comm, optional): Ranks that build this partition together. If None, every rank works on its own.
+        **weight_options: Passed to `tet_weights`.
+
+    Returns:
+        tuple: (partition, report dict with loads, imbalance and cut faces)
+    """
+    group_names = group_names or {}
+    rank = comm.Get_rank() if comm is not None else 0
+    if method == "linear":
+        # (xbins, ybins, zbins): n_hosts slabs of equal width along z
+        partition = stgeom.LinearMeshPartition(mesh, 1, 1, n_hosts)
+        report = None
+        if rank == 0:  # the report only, the same slabs binned by the tet centers along z
+            z = np.asarray(mesh_arrays.tet_centers)[:, 2]
+            z_min, z_max = np.asarray(mesh_arrays.verts)[:, 2].min(), np.asarray(mesh_arrays.verts)[:, 2].max()
+            tet_hosts = np.clip(((z - z_min) / (z_max - z_min) * n_hosts).astype(np.int64), 0, n_hosts - 1)
+            weights = tet_weights(mesh_arrays, group_names, **weight_options)
+            report = partition_report(tet_hosts, weights, face_adjacency(np.asarray(mesh_arrays.tets)), n_hosts)
+        if comm is not None:
+            report = comm.bcast(report, root=0)
+    else:
+        result = None
+        if rank == 0:
+            cache_path = partition_cache_path(mesh_arrays, n_hosts, method, group_names, patches, weight_options)
+            result = load_partition(cache_path)
+            if result is None:
+                result = compute_partition(mesh_arrays, n_hosts, method, group_names, patches, **weight_options)
+                if cache_path is not None:
+                    save_partition(cache_path, *result)
+            elif verbose:
+                print(f"Loaded cached partition {cache_path}")
+        if comm is not None:
+            result = comm.bcast(result, root=0)
+        tet_hosts, tri_hosts, report = result
+        partition = stgeom.MeshPartition(mesh, np.asarray(tet_hosts).tolist(), tri_hosts)
+
+    report["method"] = method
+    if verbose and rank == 0:
+        print(f"Partition '{method}' on {n_hosts} hosts: imbalance {report['imbalance']:.3f}, "
+              f"{report['cut_faces']} cut faces, tets per host {report['tets_per_host']}")
+    return partition, report
@@ -0,0 +1,96 @@
+import numpy as np
+
+SCHEDULE_KINDS = ("uniform", "log", "dense_early", "change")
+
+
+def uniform_time_points(endtime, dt):
+    """
+    0, dt, 2 dt, ... up to and including endtime.
+    """
+    n = int(np.floor(endtime / dt + 1e-9))
+    return np.arange(n + 1) * dt
+
+
+def log_time_points(endtime, n_points=50, t_first=None):
+    """
+    0 followed by `n_points` logarithmically spaced time points from `t_first` (default endtime / 10**4) to endtime.
+    """
+    t_first = endtime / 10**4 if t_first is None else t_first
+    return np.concatenate([[0.0], np.geomspace(t_first, endtime, n_points)])
+
+
+def dense_early_time_points(endtime, dt_early, t_switch, dt_late):
+    """
+    Every `dt_early` until `t_switch`, every `dt_late` after it, for fast transients followed by slow relaxation.
+    """
+    early = uniform_time_points(min(t_switch, endtime), dt_early)
+    late = early[-1] + uniform_time_points(endtime - early[-1], dt_late)[1:]
+    return np.concatenate([early, late])
+
+
+def change_triggered_time_points(time, series, tolerance=0.01, relative=True, floor=1.0, max_gap=None):
+    """
+    Thins out a densely sampled trajectory to the time points at which something changed.
+
+    A time point is kept if any of the series moved by more than `tolerance` since the last kept point (relative to
+    the value at the last kept point if `relative`, but never relative to less than `floor`, so that counts close to
+    zero do not trigger on every molecule), or if `max_gap` passed since the last kept point. The first and last
+    time points are always kept.
+
+    Args:
+        time (np.ndarray): (T,) candidate time points.
+        series (np.ndarray): (T, n) values of the observables at the candidate time points.
+
+    Returns:
+        np.ndarray: The kept time points.
+    """
+    time = np.asarray(time, dtype=np.float64)
+    series = np.asarray(series, dtype=np.float64).reshape(len(time), -1)
+    keep = [0]
+    reference = series[0]
+    for i in range(1, len(time)):
+        change = np.abs(series[i] - reference)
+        if relative:
+            change = change / np.maximum(np.abs(reference), floor)
+        if np.any(change > tolerance) or (max_gap is not None and time[i] - time[keep[-1]] >= max_gap):
+            keep.append(i)
+            reference = series[i]
+    if keep[-1] != len(time) - 1:
+        keep.append(len(time) - 1)
+    return time[keep]
+
+
+def save_kwargs(schedule, p):
+    """
+    Translates a save schedule into the keyword arguments of `sim.toSave`.
+
+    Args:
+        schedule: None (every p["time step"], the old behaviour), a list/array of time points, or a dict with "kind":
+            - {"kind": "uniform", "dt": 0.1}
+            - {"kind": "log", "n_points": 50, "t_first": 1e-3}
+            - {"kind": "dense_early", "dt_early": 0.01, "t_switch": 5, "dt_late": 1}
+            - {"kind": "change", ...} is resolved by `SimManager.load_model` into time points first (it needs a
+              pilot run), see `SimManager._change_triggered_schedule`.
+        p (dict): The parameters, for "time step" and "endtime".
+
+    Returns:
+        dict: {"dt": ...} or {"timePoints": [...]}.
+    """
+    if schedule is None:
+        return {"dt": p["time step"]}
+    if not isinstance(schedule, dict):
+        return {"timePoints": [float(t) for t in schedule]}
+
+    kind = schedule.get("kind", "uniform")
+    endtime = p["endtime"]
+    if kind == "uniform":
+        return {"dt": schedule.get("dt", p["time step"])}
+    elif kind == "log":
+        points = log_time_points(endtime, schedule.get("n_points", 50), schedule.get("t_first"))
+    elif kind == "dense_early":
+        points = dense_early_time_points(endtime, schedule["dt_early"], schedule["t_switch"], schedule["dt_late"])
+    elif kind == "change":
+        raise ValueError("Change triggered schedules need a pilot run, pass them to SimManager.load_model.")
+    else:
+        raise ValueError(f"Unknown save schedule '{kind}', use one of {SCHEDULE_KINDS}.")
+    return {"timePoints": [float(t) for t in points]}
@@ -6,6 +6,9 @@ import steps.sim as stsim
 import steps.saving as stsave
 import warnings
 import numpy as np
+import h5py
+import glob
+import json
 import os
 import sys
 import time
@@ -16,7 +19,8 @@ from Patrick.src.Utilities import set_inital_values,get_repo_path
 
 class SimManager:
     def __init__(self, parameters, mesh_path, save_path=None,
-                 parallel=False, runname: str = "initial_run", plot_only_run: bool = True, replace: bool = False):
+                 parallel=False, runname: str = "initial_run", plot_only_run: bool = True, replace: bool = False,
+                 comm=None):
         """
          Manages the configuration, setup, and execution of biochemical simulations.
 
@@ -36,6 +40,8 @@ class SimManager:
              plot_only_run (bool): If True, sets up the simulation for interactive
                      plotting only, without saving data. Default is False.
              replace (bool): If True, replaces existing simulation results with a new one.
+             comm (MPI.Comm, optional): Communicator of the ranks that work on this simulation. Defaults to
+                     MPI.COMM_WORLD, the task farm (src/TaskFarm.py) passes the communicator of its rank group.
 
          Attributes:
              parameters (dict): Dictionary containing the simulation parameters.
@@ -78,11 +84,23 @@ class SimManager:
         self.replace = replace
         self.simulation = None
         self.result_selector = None
+        self.saved_selectors = {} # name -> result selector of everything the model saves
+        self.partition_report = None # load balance of the mesh partition, see src/Partitioning.py
+        self.solver = "TetOpSplit" # solver of the loaded model, see src/Solvers.py
+        self.model_type = None # "small" or "large", set by load_model
+        self.mesh_scale = 1
+        self.parameter_bindings = None # where the constants of the model live, see src/ParameterBindings.py
+        self.constant_updates = [] # changes of constants since load_model, reapplied after every newRun()
+        self.profiles = {} # bins of the spatial profiles, see src/Observables.py
+        self.save_schedule = None # None (every time step) or the time points results are saved at
         self.mesh = None
         self.cell_tets = None
         self.nuc_tets = None
+        self.initial_count_plan = None # filled by set_inital_values, reused for every replicate
+        self.replicate_timings = [] # setup and solver time per replicate of the last run() call
         self.parallel = parallel
         self.runname = runname
+        self.comm = comm if comm is not None else MPI.COMM_WORLD
 
         self._setup_environment(self.save_path)
         self._load_model_dataframe()
@@ -91,10 +109,9 @@ class SimManager:
         """
         Load and clean the model dataframe dynamically based on the parameters.
         """
-        from src.Utilities import dataframe_cleanup
-        df_path = f"{self.base_path}{self.parameters["big_model_mini_sph_df_path"]}"
-        df = pd.read_excel(df_path)
-        df = dataframe_cleanup(df, ["Species"])
+        from src.ModelCache import load_model_dataframe
+        df_path = f"{self.base_path}{self.parameters['big_model_mini_sph_df_path']}"
+        df = load_model_dataframe(df_path) # compiled, hash-keyed cache instead of parsing the .xls every time
         self.model_dataframe = df
         self.species_names = df.Species.values
 
@@ -102,8 +119,7 @@ class SimManager:
         """
         Set up directories and environment.
         """
-        comm = MPI.COMM_WORLD
-        rank = comm.Get_rank()
+        rank = self.comm.Get_rank()
 
         save_dir = os.path.dirname(path)  # Get the parent directory of the path
 
@@ -118,37 +134,459 @@ class SimManager:
                     pass  # If the file was already removed by another process, ignore it
 
 
-    def load_model(self, type, mesh_scale=1):
+    def load_model(self, type, mesh_scale=1, seed=None, partitioner="linear", partition_options=None,
+                   solver="TetOpSplit", solver_options=None, output_mode="species", profiles=None,
+                   save_schedule=None):
         """
         Load a simulation model based on the specified type.
 
         Args:
             type (str): Type of model to load, currently supports "small" with
                        "large" planned for future implementation.
+            mesh_scale (float): Scale applied to the mesh vertices ("small" model only).
+            seed (int, optional): Seed of the random number generator. If None, the default of the model is used.
+            partitioner (str): How the mesh is distributed over the ranks: "linear" (LinearMeshPartition along z),
+                               or the load balanced "morton" / "axis" partitioners of `src/Partitioning.py`.
+            partition_options (dict, optional): Weights of the load balanced partitioners, see
+                                                `Partitioning.tet_weights` The partitions are cached next to the
+                                                mesh cache and reused for the same mesh and number of ranks.
+            solver (str): "TetOpSplit" (spatial, parallel), "Tetexact", "TetODE" (spatial, serial) or the well-mixed
+                          "Wmdirect" / "Wmrk4" (serial), see `src/Solvers.py`. The well-mixed solvers never build the
+                          tet mesh, they use compartments with the volumes and areas of the cached mesh. The model
+                          and the saved selectors are the same for every solver.
+            solver_options (dict, optional): "rk4_dt" for Wmrk4, "tolerances" for TetODE.
+            output_mode (str): "species" saves one SUM selector per species, "aggregated" one LIST selector per
+                               compartment/patch with all its species as columns (one dataset per location,
+                               species names in the labels and metaData), see `src/Observables.py`.
+            profiles (list, optional): Spatial profiles (counts per distance-to-membrane, distance-to-nucleus or
+                                       long-axis bin) saved at every time step, e.g.
+                                       [{"species": ["ERKp"], "kind": "membrane_distance", "n_bins": 20}], see
+                                       `Observables.profile_selectors`. The bins end up in `self.profiles`.
+            save_schedule (dict or list, optional): When results are saved. Defaults to every p["time step"], see
+                                       `SaveSchedules.save_kwargs` for log-spaced and dense-early schedules or a list
+                                       of time points. {"kind": "change", "tolerance": 0.01, ...} saves only when an
+                                       observable moved by more than the tolerance, see
+                                       `_change_triggered_schedule`. The resolved schedule is in `self.save_schedule`.
 
         Raises:
             UserWarning: If the specified model type is not implemented.
         """
+        from src.Solvers import check_communicator
+        check_communicator(solver, self.comm)
+        if isinstance(save_schedule, dict) and save_schedule.get("kind") == "change":
+            save_schedule = self._change_triggered_schedule(type, mesh_scale, seed, output_mode, save_schedule)
+        model_kwargs = dict(seed=seed, n_hosts=self.comm.Get_size(), partitioner=partitioner,
+                            partition_options=partition_options, comm=self.comm, solver=solver,
+                            solver_options=solver_options, output_mode=output_mode, profiles=profiles,
+                            save_schedule=save_schedule)
         if type == "small":
             from src.Model_small import create_model
-            self.simulation, self.result_selector, self.mesh = create_model(self.parameters,
+            self.simulation, self.result_selector, self.mesh, model_info = create_model(self.parameters,
                                                                             self.species_names,
                                                                             self.mesh_path,
                                                                             mesh_scale,
-                                                                            self.plot_only_run)
+                                                                            self.plot_only_run,
+                                                                            **model_kwargs)
             # self.model_data = pd.read_excel("/home/pb/steps_cell_signaling/Patrick/data_small_model.xlsx")
         elif type == "large":
             from src.Model_expanded_mini_sph_new import create_model
             # warnings.warn("The 'large' model type is not yet implemented", UserWarning)
-            self.simulation, self.result_selector, self.mesh = create_model(self.model_dataframe,
+            self.simulation, self.result_selector, self.mesh, model_info = create_model(self.model_dataframe,
                                                                             self.parameters,
                                                                             self.species_names,
                                                                             self.mesh_path,
-                                                                            self.plot_only_run)
+                                                                            self.plot_only_run,
+                                                                            **model_kwargs)
         else:
             warnings.warn(f"The '{type}' model type is not yet implemented", UserWarning)
+            return
+        self.solver = solver
+        self.model_type = type
+        self.mesh_scale = mesh_scale
+        self.save_schedule = save_schedule
+        self.saved_selectors = model_info["saved_selectors"]
+        self.parameter_bindings = model_info["parameter_bindings"]
+        self.profiles = model_info["profiles"]
+        self.constant_updates = []
+        self.partition_report = model_info["partition_report"]
+
+    def run_metadata(self):
+        """
+        What is stored with the results of a run (as attributes of its group), e.g. for the results catalog
+        (`src/Catalog.py`). Everything is a string, the parameters as JSON.
+        """
+        return {"parameters": json.dumps(self.parameters, default=str),
+                "mesh_path": str(self.mesh_path),
+                "mesh_scale": repr(self.mesh_scale),
+                "model_type": str(self.model_type),
+                "solver": self.solver}
+
+    def _write_run_metadata(self, h5_path):
+        """
+        Stores `run_metadata` as attributes of the group STEPS wrote the run into. A run appended to an existing uid
+        overwrites them, so every parameter set should get its own runname.
+        """
+        with h5py.File(h5_path, "a") as f:
+            f[self.runname].attrs.update(self.run_metadata())
+
+    def _change_triggered_schedule(self, type, mesh_scale, seed, output_mode, schedule):
+        """
+        Turns a change triggered save schedule into fixed time points with a pilot run.
+
+        STEPS can only save at a fixed interval or at time points given in advance, so the time points are taken
+        from a cheap pilot run of the same model (by default the deterministic TetODE solver, whose adaptive step is
+        stable for the fast nuclear reactions, unlike the fixed step of Wmrk4): it is sampled every
+        `candidate_dt` and only the time points where one of the saved observables moved by more than `tolerance`
+        are kept (see `SaveSchedules.change_triggered_time_points`). The pilot runs on rank 0, the time points are
+        broadcast.
+
+        Args:
+            schedule (dict): "tolerance" (default 0.01, relative), "floor" (default 1 molecule), "max_gap"
+                             (optional), "candidate_dt" (default p["time step"] / 10), "pilot_solver" (default
+                             "TetODE") and "pilot_options" (solver_options of the pilot).
+
+        Returns:
+            list: The time points.
+        """
+        from src.SaveSchedules import change_triggered_time_points
+        time_points = None
+        if self.comm.Get_rank() == 0:
+            start_time = time.time()
+            pilot = SimManager(self.parameters, self.mesh_path, self.save_path, runname=f"{self.runname}_pilot",
+                               plot_only_run=False, replace=False, comm=MPI.COMM_SELF)
+            pilot.load_model(type, mesh_scale=mesh_scale, seed=seed, solver=schedule.get("pilot_solver", "TetODE"),
+                             solver_options=schedule.get("pilot_options"), output_mode=output_mode,
+                             save_schedule={"kind": "uniform",
+                                            "dt": schedule.get("candidate_dt", self.parameters["time step"] / 10)})
+            pilot._setup_replicate()
+            pilot.simulation.run(self.endtime)
+            selectors = list(pilot.saved_selectors.values())
+            series = np.concatenate([np.asarray(sel.data)[0] for sel in selectors], axis=1)
+            # after a blow-up no change exceeds the tolerance anymore and the schedule would silently shrink, so a
+            # diverged pilot gives no time points at all
+            if np.all(np.isfinite(series)):
+                time_points = change_triggered_time_points(np.asarray(selectors[0].time[0]), series,
+                                                           tolerance=schedule.get("tolerance", 0.01),
+                                                           floor=schedule.get("floor", 1.0),
+                                                           max_gap=schedule.get("max_gap")).tolist()
+                print(f"Change triggered schedule: {len(time_points)} of {series.shape[0]} time points "
+                      f"(pilot {time.time() - start_time:.2f} seconds)")
+        time_points = self.comm.bcast(time_points, root=0)
+        assert time_points is not None, \
+            f"The {schedule.get('pilot_solver', 'TetODE')} pilot run diverged (inf/NaN), use a stiff pilot_solver " \
+            f"(TetODE) or a smaller step in pilot_options."
+        return time_points
+
+    def _setup_replicate(self):
+        """
+        Starts a new run on the existing simulation and sets its initial state.
+
+        Returns:
+            float: Time in seconds spent on the setup.
+        """
+        start_time = time.time()
+        self.simulation.newRun()
+        self._apply_constant_updates() # newRun resets all constants to the values of the model
+
+        set_inital_values(self, factor = 1) # TODO: MAYBE DONT HARDCODE BRO
+
+        # self.simulation.exo.EGF.Count = self.parameters["EGF_0"]
+        # self.simulation.cell_surface.EGFR.Count = self.parameters["EGFR_0"]
+        # self.simulation.cyt.GAP.Count = self.parameters["GAP_0"]
+        # self.simulation.cyt.ERK.Count = self.parameters["ERK_0"]
+        # self.simulation.cyt.P3.Count = self.parameters["P3_0"]
+
+        from src.Solvers import is_well_mixed
+        if not is_well_mixed(self.solver): # well-mixed models have a transport reaction instead of the DiffBoundary
+            self.simulation.nuc_mem.ERKp.DiffusionActive = True
+        return time.time() - start_time
+
+    def update_parameters(self, overrides):
+        """
+        Changes entries of the parameter dict on the existing simulation, without building a new model.
+
+        Every reaction and diffusion constant the model computed from one of the keys (e.g. "k[0]", "k[666]", "DC")
+        is recomputed and set on the simulation, now and after every following `newRun()`. A one-factor sensitivity
+        sweep can therefore load the model once and call this between runs:
+
+            sm.load_model(type="small")
+            for value in values:
+                sm.update_parameters({"k[0]": value})
+                sm.runname = f"k0_{value}" # one group per parameter set, the parameters are stored with it
+                sm.run(replicats=1)
+
+        Args:
+            overrides (dict): Parameter name -> new value.
+
+        Returns:
+            set: Keys that are not bound to any constant (e.g. "time step"), they need a new `load_model` call.
+                 A warning is raised for them.
+        """
+        assert self.simulation is not None, "Load a model first."
+        self.parameters = dict(self.parameters, **overrides) # never modify the dict of the caller
+        self.endtime = self.parameters["endtime"]
+        update = ("parameters", tuple(overrides))
+        self.constant_updates.append(update)
+        return self._apply_constant_update(update)
+
+    def set_reaction_constant(self, reaction, value, direction=None, locations=None):
+        """
+        Sets the rate constant of a reaction of the existing simulation, now and after every following `newRun()`.
+
+        Args:
+            reaction (str): Label of the reaction in the model file, e.g. "r[6]".
+            value (float): New rate constant, in the units of the model.
+            direction (str, optional): "fwd" or "bkw" for reversible reactions.
+            locations (list, optional): Compartments/patches to change it in, defaults to all that have it.
+        """
+        update = ("reaction", reaction, value, direction, locations)
+        self._apply_constant_update(update)
+        self.constant_updates.append(update)
 
-    def run(self, replicats):
+    def set_diffusion_constant(self, species, value, locations=None):
+        """
+        Sets the diffusion constant of a species of the existing simulation, now and after every following
+        `newRun()`. Not available with the well-mixed solvers.
+
+        Args:
+            species (str): Name of the species.
+            value (float): New diffusion constant in m^2/s.
+            locations (list, optional): Compartments/patches to change it in, defaults to all where it diffuses.
+        """
+        update = ("diffusion", species, value, locations)
+        self._apply_constant_update(update)
+        self.constant_updates.append(update)
+
+    def _apply_constant_update(self, update):
+        if update[0] == "parameters":
+            return self.parameter_bindings.apply(self.simulation, self.parameters, keys=update[1])
+        elif update[0] == "reaction":
+            self.parameter_bindings.set_reaction_constant(self.simulation, *update[1:])
+        else:
+            self.parameter_bindings.set_diffusion_constant(self.simulation, *update[1:])
+
+    def _apply_constant_updates(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # unbound parameters were already reported by update_parameters
+            for update in self.constant_updates:
+                self._apply_constant_update(update)
+
+    def _run_replicate(self, replicat_id, on_segment=None, segment_time=None, restore_from=None, monitor=None):
+        """
+        Sets up and runs a single replicate and records how long setup and solver took.
+
+        Args:
+            replicat_id (int): Index of the replicate.
+            on_segment (callable, optional): Called after every `segment_time` seconds of simulated time (and at the
+                                             end), e.g. to hand the new results to a writer.
+            segment_time (float, optional): Length of the segments, required with `on_segment`.
+            restore_from (str, optional): Solver checkpoint to continue the replicate from instead of starting it.
+            monitor (SteadyStateMonitor, optional): Stops the replicate once it is at steady state, see
+                                                    `src/Convergence.py`.
+        """
+        if restore_from is None:
+            setup_time = self._setup_replicate()
+        else:
+            setup_time = self._restore_replicate(restore_from)
+
+        start_time = time.time()
+        stop_time = self.endtime
+        if on_segment is None and monitor is None:
+            self.simulation.run(self.endtime)
+        else:
+            if monitor is not None:
+                monitor.reset()
+                segment_time = min(segment_time or np.inf, monitor.check_interval)
+            segment_ends = np.append(np.arange(segment_time, self.endtime, segment_time), self.endtime)
+            for t in segment_ends[segment_ends > self.simulation.Time]:
+                self.simulation.run(t)
+                if on_segment is not None:
+                    on_segment()
+                # every rank has to stop at the same time, rank 0 decides
+                if monitor is not None and self.comm.bcast(monitor.update(self.simulation, t), root=0):
+                    stop_time = float(t)
+                    break
+        run_time = time.time() - start_time
+
+        self.replicate_timings.append({"replicat": replicat_id, "setup": setup_time, "run": run_time,
+                                       "stop_time": stop_time})
+        stopped = f", steady state at t = {stop_time:g} s" if stop_time < self.endtime else ""
+        print(f"Replicat {replicat_id} completed in {run_time:.2f} seconds (setup {setup_time:.2f} seconds{stopped}).")
+
+    def _restore_replicate(self, checkpoint_path):
+        """
+        Starts a new run and loads the state of a solver checkpoint into it.
+
+        Returns:
+            float: Time in seconds spent on the restore.
+        """
+        start_time = time.time()
+        self.simulation.newRun()
+        self.simulation.restore(checkpoint_path)
+        self._apply_constant_updates()
+
+        from src.Solvers import is_well_mixed
+        if not is_well_mixed(self.solver):
+            self.simulation.nuc_mem.ERKp.DiffusionActive = True
+        return time.time() - start_time
+
+    def _drop_selector_rows(self):
+        """
+        Drops the rows the in-memory selectors collected so far, after they were handed on, so that memory does not
+        grow with the number of replicats.
+        """
+        for sel in self.saved_selectors.values():
+            sel.clear()
+
+    def _run_async(self, replicats, save_path, profile, flush_interval=None, max_queue=8, checkpoint_every=None,
+                   resume=False, monitor=None):
+        """
+        Runs the replicats with the results written by a background thread (`src/AsyncWriter.py`).
+
+        The selectors are not attached to a STEPS handler, they collect their rows in memory. Every replicate is run
+        in segments of `flush_interval` simulated seconds, after each segment the rows saved since the last one are
+        queued for the writer thread, which compresses and writes them while the solver runs the next segment. The
+        rows of a finished replicate are dropped from the selectors, so memory is bounded by one replicate.
+        Only rank 0 holds the results and writes, all ranks run the same segments.
+
+        Checkpoints (`checkpoint_every` seconds of wall-clock time, checked after every segment): the writer is
+        drained, the solver state is written with `sim.checkpoint` (two alternating files, every rank writes its
+        part) and only then the manifest (`src/Checkpoints.py`) records the replicate, the simulated time and how
+        many rows of every selector are in the output file. With `resume=True` the finished replicates are skipped
+        and the checkpointed one continues from the restored solver state, writing on from the recorded rows. Rows
+        written after the checkpoint by the killed job are overwritten.
+        """
+        from src.AsyncWriter import AsyncResultWriter
+        from src.Checkpoints import (MANIFEST, checkpoint_dir, checkpoint_file, read_manifest, write_manifest,
+                                     check_resumable)
+        flush_interval = flush_interval or self.endtime / 20
+        rank = self.comm.Get_rank()
+        directory = checkpoint_dir(save_path)
+
+        manifest = None
+        if resume:
+            manifest = self.comm.bcast(read_manifest(directory) if rank == 0 else None, root=0)
+            if manifest is None:
+                print(f"No checkpoint in {directory}, starting from the beginning.")
+            else:
+                check_resumable(manifest, self.runname, self.solver, self.comm.Get_size(), replicats)
+                print(f"Resuming replicat {manifest['replicat']} at t = {manifest['time']} s.")
+
+        elif checkpoint_every is not None and rank == 0 and os.path.isfile(os.path.join(directory, MANIFEST)):
+            os.remove(os.path.join(directory, MANIFEST)) # a fresh run must never be resumed from an older one
+
+        writer = None
+        if rank == 0:
+            labels = {name: list(sel.labels) for name, sel in self.saved_selectors.items()}
+            writer = AsyncResultWriter(save_path + ".h5", self.runname, labels,
+                                       attrs=self.run_metadata(),
+                                       output_profile=profile, max_queue=max_queue, resume=manifest is not None)
+        base_manifest = {"runname": self.runname, "solver": self.solver, "n_ranks": self.comm.Get_size(),
+                         "replicats": replicats, "output": save_path + ".h5"}
+        state = {"replicat": 0, "slot": 0, "last_checkpoint": time.time(), "resume_time": -np.inf}
+        file_rows = {}  # next row of the output file per selector
+        consumed = {}  # rows of the current in-memory run already handed to the writer
+
+        def hand_over():
+            if writer is None:
+                return
+            for name, sel in self.saved_selectors.items():
+                run = len(sel.time) - 1
+                times = np.asarray(sel.time[run])
+                start_row = consumed.get(name, 0)
+                if len(times) > start_row:
+                    new_times, rows = times[start_row:], np.asarray(sel.data[run])[start_row:]
+                    keep = new_times > state["resume_time"]  # a restored run may report the rows up to the checkpoint
+                    if np.any(keep):
+                        writer.put(name, state["replicat"], file_rows.get(name, 0), new_times[keep], rows[keep])
+                        file_rows[name] = file_rows.get(name, 0) + int(keep.sum())
+                    consumed[name] = len(times)
+
+        def save_manifest(**entries):
+            if writer is not None:
+                writer.flush()
+                write_manifest(directory, dict(base_manifest, **entries))
+            self.comm.Barrier()
+
+        def checkpoint():
+            if writer is not None:
+                writer.flush()  # the rows up to the checkpoint have to be on disk before the manifest counts them
+                os.makedirs(directory, exist_ok=True)
+            self.comm.Barrier()
+            path = checkpoint_file(directory, state["slot"])
+            self.simulation.checkpoint(path)
+            self.comm.Barrier()
+            save_manifest(replicat=state["replicat"], time=float(self.simulation.Time), checkpoint=path,
+                          rows=dict(file_rows))
+            state["slot"] = 1 - state["slot"]
+            state["last_checkpoint"] = time.time()
+
+        def on_segment():
+            hand_over()
+            if checkpoint_every is None or self.simulation.Time >= self.endtime:
+                return
+            if self.comm.bcast(time.time() - state["last_checkpoint"] >= checkpoint_every, root=0):
+                checkpoint()
+
+        first_replicat, restore_from = 0, None
+        if manifest is not None:
+            first_replicat = manifest["replicat"]
+            if manifest["checkpoint"] is not None:
+                restore_from = manifest["checkpoint"]
+                file_rows.update(manifest["rows"])
+                state["resume_time"] = manifest["time"]
+
+        if writer is not None:
+            writer.start()
+        try:
+            for replicat in range(first_replicat, replicats):
+                state["replicat"] = replicat
+                consumed.clear()
+                self._run_replicate(replicat, on_segment=on_segment, segment_time=flush_interval,
+                                    restore_from=restore_from, monitor=monitor)
+                restore_from, state["resume_time"] = None, -np.inf
+                file_rows.clear()
+                self._drop_selector_rows()  # everything of the replicate is queued for the writer
+                if checkpoint_every is not None: # the replicate is complete, a resume starts with the next one
+                    save_manifest(replicat=replicat + 1, time=0.0, checkpoint=None, rows={})
+        finally:
+            if writer is not None:
+                writer.close(raise_errors=sys.exc_info()[0] is None)
+        if writer is not None:
+            print(f"Background writer: {writer.written_rows} rows, simulation waited "
+                  f"{writer.blocked_seconds:.2f} seconds for it")
+            if checkpoint_every is not None: # the solver checkpoints are not needed anymore, the manifest stays
+                for slot in (0, 1):
+                    for path in glob.glob(checkpoint_file(directory, slot) + "*"):
+                        os.remove(path)
+        self.comm.Barrier()
+
+    def _run_aggregated(self, replicats, save_path, profile, aggregate, monitor=None):
+        """
+        Runs the replicats and stores only running statistics over them (`src/Aggregation.py`).
+
+        The selectors are not attached to a STEPS handler, they collect their rows in memory. After every replicate
+        rank 0 adds its rows to the accumulators and drops them, so neither memory nor the output file grow with the
+        number of replicats. The file is written once at the end.
+        """
+        from src.Aggregation import ReplicateAggregator
+        aggregator = None
+        if self.comm.Get_rank() == 0:
+            labels = {name: list(sel.labels) for name, sel in self.saved_selectors.items()}
+            aggregator = ReplicateAggregator.from_spec(aggregate, labels, replicats)
+        for replicat in range(replicats):
+            self._run_replicate(replicat, monitor=monitor)
+            if aggregator is not None:
+                for name, sel in self.saved_selectors.items():
+                    run = len(sel.time) - 1
+                    aggregator.add(name, sel.time[run], sel.data[run])
+            self._drop_selector_rows()  # the rows are in the accumulators now
+        if aggregator is not None:
+            aggregator.write(save_path + ".h5", self.runname, attrs=self.run_metadata(), output_profile=profile)
+        self.comm.Barrier()
+
+    def run(self, replicats, batched=True, output_profile="legacy", async_output=False, flush_interval=None,
+            max_queue=8, checkpoint_every=None, resume=False, steady_state=None, aggregate=None):
         """
         Run the simulation with the initialized parameters.
 
@@ -157,11 +595,40 @@ class SimManager:
 
         Args:
             replicats (int): How many replicats of this sim to run. Default is 1.
+            batched (bool): If True, the output handler is opened once and all replicats are written through it as
+                            consecutive runs of the same simulation. If False, a new handler is opened and the
+                            simulation is attached to it again for every replicat (old behaviour).
+            output_profile (str or dict): How the results are stored, see `src/OutputProfiles.py`. "legacy" (gzip,
+                            floats, STEPS chunks) is what STEPS writes. The other profiles rewrite the file after the
+                            run: counts as the smallest integer type, time aligned chunks, and gzip+shuffle
+                            ("compact"), lzf ("fast") or Blosc/LZ4 ("blosc", needs hdf5plugin).
+            async_output (bool): If True, the results are written by a background thread instead of by STEPS on
+                            the solver thread, see `_run_async`. The file then has the layout of `run_ensemble`
+                            (read it with `load_results`) and has no XDMF part for ParaView.
+            flush_interval (float, optional): Simulated time between two hand-overs to the writer, defaults to
+                            endtime / 20.
+            max_queue (int): Blocks the writer queue holds before the simulation waits for the writer.
+            checkpoint_every (float, optional): Write a solver checkpoint and the output position every this many
+                            seconds of wall-clock time (uses the background writer), into save_path + "_checkpoints".
+            resume (bool): Continue a killed run from its latest consistent checkpoint instead of starting over.
+                            Load the same model first and use the same number of ranks.
+            steady_state (dict, optional): Stop every replicate once the given observables are at steady state,
+                            e.g. {"observables": ["nuc.ERKpp"], "window": 50, "tolerance": 0.01}, see
+                            `Convergence.SteadyStateMonitor`. The stop times are in `self.replicate_timings`, in
+                            save_path + "_steady_state.json" and in the "steady_state" attribute of the run in the
+                            output file. Stopped replicats have fewer time points (NaN in the background writer
+                            layout).
+            aggregate (bool or dict, optional): Store only statistics over the replicats (count, mean, M2/variance,
+                            min and max per time point, see `src/Aggregation.py`) instead of every replicat, e.g.
+                            {"sample_size": 16, "histogram_bins": 50, "histogram_range": (0, 5000)} to also keep
+                            16 raw replicats and histograms. `cached_statistics` and `plot.py` read the file directly,
+                            `load_results` returns the raw sample. Cannot be combined with the background writer.
 
         Notes:
             - When plot_only_run is False, results are saved to the specified HDF5 file.
             - When plot_only_run is True, an interactive plotting session is launched.
-            - Initial molecular counts are set for EGF, EGFR, and GAP species regardless of mode.
+            - The initial counts are looked up once and reused for every replicat (see `set_inital_values`).
+            - Setup and solver time of every replicat are stored in `self.replicate_timings`.
         """
         # this is a regex way of finding out if a file with a certain fileformat already exists. Right now its hardcoded
         # that we always use .h5. Would be nice to make it dynamic
@@ -180,33 +647,64 @@ class SimManager:
             # else:
             checked_save_path = self.save_path
 
-            sum_of_runtimes = 0
-            for i in range(replicats):
-                options = dict(compression="gzip", compression_opts=5) # compress the output files to save space. Larger opts = more compression
+            self.replicate_timings = []
+            from src.OutputProfiles import get_profile, codec_kwargs, apply_output_profile, is_repacked
+            profile = get_profile(output_profile)
+            options = codec_kwargs(profile) # compress the output files to save space, see src/OutputProfiles.py
+            monitor = None
+            if steady_state is not None:
+                from src.Convergence import SteadyStateMonitor
+                monitor = SteadyStateMonitor.from_spec(steady_state)
+            async_output = async_output or checkpoint_every is not None or resume
+            if not aggregate and not async_output:
+                # STEPS would append float counts to the narrow integer datasets of a rewritten run and clip them
+                repacked = self.comm.bcast(is_repacked(checked_save_path + ".h5", self.runname)
+                                           if self.comm.Get_rank() == 0 else None, root=0)
+                assert not repacked, f"Run '{self.runname}' in {checked_save_path}.h5 was rewritten with an output " \
+                                     f"profile, STEPS cannot append to it. Use another runname or replace=True."
+            if aggregate:
+                assert not async_output, "aggregate cannot be combined with async_output, checkpoints or resume."
+                self._run_aggregated(replicats, checked_save_path, profile, aggregate, monitor)
+            elif async_output:
+                self._run_async(replicats, checked_save_path, profile, flush_interval, max_queue, checkpoint_every,
+                                resume, monitor)
+            elif batched:
                 with stsave.XDMFHandler(checked_save_path, hdf5DatasetKwArgs=options) as hdf:
                     self.simulation.toDB(hdf, uid = self.runname)
-                    self.simulation.newRun()
-
-                    set_inital_values(self, factor = 1) # TODO: MAYBE DONT HARDCODE BRO
-
-                    # self.simulation.exo.EGF.Count = self.parameters["EGF_0"]
-                    # self.simulation.cell_surface.EGFR.Count = self.parameters["EGFR_0"]
-                    # self.simulation.cyt.GAP.Count = self.parameters["GAP_0"]
-                    # self.simulation.cyt.ERK.Count = self.parameters["ERK_0"]
-                    # self.simulation.cyt.P3.Count = self.parameters["P3_0"]
-
-                    self.simulation.nuc_mem.ERKp.DiffusionActive = True
-
-                    start_time = time.time()
-                    self.simulation.run(self.endtime)
-                    end_time = time.time()
-
-                    print(f"Run completed in {end_time - start_time:.2f} seconds.")
-                    sum_of_runtimes += (end_time - start_time)
-            print(f"All runs completed in {sum_of_runtimes:.2f} seconds")
+                    for i in range(replicats):
+                        self._run_replicate(i, monitor=monitor)
+            else:
+                for i in range(replicats):
+                    with stsave.XDMFHandler(checked_save_path, hdf5DatasetKwArgs=options) as hdf:
+                        self.simulation.toDB(hdf, uid = self.runname)
+                        self._run_replicate(i, monitor=monitor)
+
+            if not async_output and not aggregate:
+                # STEPS refuses to reopen a uid with other toDB kwargs, so the metadata is stored after the run
+                if self.comm.Get_rank() == 0:
+                    self._write_run_metadata(checked_save_path + ".h5")
+                self.comm.Barrier()
+
+            if profile != get_profile("legacy") and not async_output and not aggregate:
+                # STEPS decides dtype and chunks of its datasets itself, so the file is rewritten once at the end
+                if self.comm.Get_rank() == 0:
+                    stats = apply_output_profile(checked_save_path + ".h5", profile, allow_delta=False,
+                                                 resizable=False)
+                    print(f"Output profile: {stats['integer']}/{stats['datasets']} datasets stored as integers, "
+                          f"{stats['bytes_before'] / 2**20:.2f} MB -> {stats['bytes_after'] / 2**20:.2f} MB")
+                self.comm.Barrier()
+
+            if monitor is not None and self.comm.Get_rank() == 0:
+                from src.Convergence import write_stop_times
+                write_stop_times(checked_save_path, self.runname, monitor,
+                                 [t["stop_time"] for t in self.replicate_timings], self.endtime)
+            self.comm.Barrier()
+
+            sum_of_runtimes = sum(t["run"] for t in self.replicate_timings)
+            sum_of_setup_times = sum(t["setup"] for t in self.replicate_timings)
+            print(f"All runs completed in {sum_of_runtimes:.2f} seconds (setup {sum_of_setup_times:.2f} seconds)")
         else:
-            comm = MPI.COMM_WORLD
-            assert comm.Get_size() == 1, "A plot_only_run only works in serial due to limitations by STEPS. Rerun either without mpirun or with mpirun -n 1 ..."
+            assert self.comm.Get_size() == 1, "A plot_only_run only works in serial due to limitations by STEPS. Rerun either without mpirun or with mpirun -n 1 ..."
 
             from src.InteractivePlotting import interactive_plots
             self.simulation.newRun()
@@ -0,0 +1,144 @@
+import numpy as np
+import steps.interface
+import steps.geom as stgeom
+import steps.sim as stsim
+from src.MeshCache import TET_FACES, encode_triangles
+
+# geometry every solver needs and whether it runs distributed over several MPI ranks
+SOLVERS = {
+    "TetOpSplit": {"geometry": "tetmesh", "stochastic": True, "parallel": True},
+    "Tetexact": {"geometry": "tetmesh", "stochastic": True, "parallel": False},
+    "TetODE": {"geometry": "tetmesh", "stochastic": False, "parallel": False},
+    "Wmdirect": {"geometry": "wellmixed", "stochastic": True, "parallel": False},
+    "Wmrk4": {"geometry": "wellmixed", "stochastic": False, "parallel": False},
+}
+
+# default step of the fixed step Runge-Kutta solver, stiff models (e.g. fast nuclear reactions) need a smaller one
+DEFAULT_RK4_DT = 1e-6
+# default absolute and relative tolerance of the CVODE solver behind TetODE
+DEFAULT_ODE_TOLERANCES = (1e-3, 1e-3)
+
+
+def check_solver(solver, n_hosts=1):
+    """
+    Raises an AssertionError for unknown solvers and for serial solvers that are started on several ranks.
+    """
+    assert solver in SOLVERS, f"Unknown solver '{solver}', use one of {list(SOLVERS)}."
+    assert SOLVERS[solver]["parallel"] or n_hosts == 1, \
+        f"The {solver} solver is serial, run it without mpirun (or use TetOpSplit)."
+
+
+def check_communicator(solver, comm):
+    """
+    Raises an AssertionError if the distributed TetOpSplit solver is started on a sub-communicator (a group of a
+    task farm or sweep). STEPS runs TetOpSplit on MPI_COMM_WORLD, so every group would build one solver across all
+    ranks while running a different task, the collectives mismatch and the job hangs. Use a serial solver there.
+    """
+    from mpi4py import MPI
+    assert not SOLVERS[solver]["parallel"] or comm.Get_size() == MPI.COMM_WORLD.Get_size(), \
+        f"{solver} always runs on all ranks of MPI_COMM_WORLD, it cannot run on a group of {comm.Get_size()} of " \
+        f"{MPI.COMM_WORLD.Get_size()} ranks. Use a serial solver (e.g. Tetexact) with groups of one rank."
+
+
+def is_well_mixed(solver):
+    return SOLVERS[solver]["geometry"] == "wellmixed"
+
+
+def _faces_on(mesh_arrays, group, codes):
+    """
+    Returns, for every triangle code in `codes` (sorted), the tet of `group` that owns it.
+    """
+    n_verts = len(mesh_arrays.verts)
+    group_tets = np.asarray(mesh_arrays.tet_groups[group])
+    faces = encode_triangles(np.sort(np.asarray(mesh_arrays.tets)[group_tets][:, TET_FACES], axis=2), n_verts)
+    owner = np.repeat(group_tets, 4)
+    faces = faces.ravel()
+    on_boundary = np.isin(faces, codes)
+    faces, owner = faces[on_boundary], owner[on_boundary]
+    return owner[np.argsort(faces)]
+
+
+def interface_geometry(mesh_arrays, inner_group, outer_group):
+    """
+    Returns the area of the surface between two tet groups and its diffusive conductance, sum(area / distance) over
+    the shared triangles, with the distance between the centers of the two tets on either side of a triangle.
+
+    The conductance is what a tet solver effectively uses for diffusion across a boundary: the flux of a species
+    with diffusion constant D and concentration c next to the boundary is D * c * conductance.
+    """
+    n_verts = len(mesh_arrays.verts)
+    shared = np.intersect1d(encode_triangles(mesh_arrays.group_surfaces[inner_group], n_verts),
+                            encode_triangles(mesh_arrays.group_surfaces[outer_group], n_verts))
+    if len(shared) == 0:
+        return 0.0, 0.0
+
+    # decode back to vertex triplets for the areas
+    tris = np.column_stack([shared // (n_verts * n_verts), (shared // n_verts) % n_verts, shared % n_verts])
+    corners = np.asarray(mesh_arrays.verts)[tris]
+    areas = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1) / 2
+
+    centers = np.asarray(mesh_arrays.tet_centers)
+    distances = np.linalg.norm(centers[_faces_on(mesh_arrays, inner_group, shared)]
+                               - centers[_faces_on(mesh_arrays, outer_group, shared)], axis=1)
+    return float(areas.sum()), float((areas / distances).sum())
+
+
+def group_volume(mesh_arrays, group):
+    return float(np.asarray(mesh_arrays.tet_volumes)[np.asarray(mesh_arrays.tet_groups[group])].sum())
+
+
+def well_mixed_geometry(mesh_arrays, compartments, patches):
+    """
+    Builds a well-mixed geometry with the same compartment and patch names, volumes and areas as the tet mesh.
+
+    Args:
+        mesh_arrays (CachedMesh): Cached mesh, see `src/MeshCache.py`. The tet mesh itself is never built.
+        compartments (dict): Compartment name -> (tet group name, volume system).
+        patches (dict): Patch name -> (inner compartment name, outer compartment name, surface system).
+                        The area is taken from the surface shared by the tet groups of the two compartments.
+
+    Returns:
+        tuple: (stgeom.Geometry, dict patch name -> (area, conductance), see `interface_geometry`)
+    """
+    geom = stgeom.Geometry()
+    created, interfaces = {}, {}
+    with geom:
+        for name, (group, volume_system) in compartments.items():
+            created[name] = stgeom.Compartment(volume_system, group_volume(mesh_arrays, group), name=name)
+        for name, (inner, outer, surface_system) in patches.items():
+            interfaces[name] = interface_geometry(mesh_arrays, compartments[inner][0], compartments[outer][0])
+            created[name] = stgeom.Patch(created[inner], created[outer], surface_system, interfaces[name][0],
+                                         name=name)
+    return geom, interfaces
+
+
+def boundary_transport_rate(diffusion_constant, conductance, source_volume):
+    """
+    First order rate (1/s) of a well-mixed transport reaction that moves molecules across a boundary at the same
+    rate as diffusion with `diffusion_constant` through a tet mesh boundary with the given conductance.
+    """
+    return diffusion_constant * conductance / source_volume
+
+
+def create_simulation(solver, mdl, geom, rng, partition=None, solver_options=None):
+    """
+    Creates the `stsim.Simulation` of the given solver, with the arguments every solver expects.
+
+    Args:
+        solver (str): One of `SOLVERS`.
+        mdl (stmodel.Model): The model, the same for every solver.
+        geom: `stgeom.TetMesh` for the tet solvers, `stgeom.Geometry` for the well-mixed ones.
+        rng (strng.RNG): Random number generator (ignored by the deterministic solvers).
+        partition: Mesh partition, only used by TetOpSplit.
+        solver_options (dict, optional): "rk4_dt" for Wmrk4, "tolerances" (absolute, relative) for TetODE.
+    """
+    solver_options = solver_options or {}
+    if solver == "TetOpSplit":
+        return stsim.Simulation("TetOpSplit", mdl, geom, rng, False, partition)
+
+    simulation = stsim.Simulation(solver, mdl, geom, rng)
+    if solver == "Wmrk4":
+        simulation.setRk4DT(solver_options.get("rk4_dt", DEFAULT_RK4_DT))
+    elif solver == "TetODE":
+        simulation.setTolerances(*solver_options.get("tolerances", DEFAULT_ODE_TOLERANCES))
+    return simulation
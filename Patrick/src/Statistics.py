@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# bump when the cached arrays change, old caches are then recomputed
+STATISTICS_VERSION = 1
+
+# memory of one block of replicates that is read at a time
+BLOCK_BYTES = 64 * 2**20
+
+
+class RunningStatistics:
+    """
+    Mean and variance over the replicate axis, updated block by block (Welford / Chan et al. merge), and a uniform
+    random sample of replicates as quantile sketch.
+
+    Only (time, columns) sized arrays are kept, plus the sample of `sample_size` replicates, so the memory does not
+    grow with the number of replicates. NaN (replicates that stopped early) are ignored per element.
+    """
+
+    def __init__(self, shape, n_replicats, sample_size=256, seed=0, histogram_edges=None):
+        """
+        Args:
+            shape (tuple): (time, columns) of one replicate.
+            n_replicats (int): Total number of replicates that will be streamed.
+            sample_size (int): Replicates kept for the quantiles. The quantiles are exact if there are not more
+                               replicates, otherwise their error shrinks like 1 / sqrt(sample_size).
+            seed (int): Seed of the sample, fixed so that cached and recomputed statistics agree.
+            histogram_edges (array, optional): Bin edges of a histogram per (time, column), values outside are not
+                                               counted.
+        """
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        size = min(sample_size, n_replicats)
+        self.sample_ids = np.sort(np.random.default_rng(seed).choice(n_replicats, size, replace=False))
+        self.sample = np.full((size,) + tuple(shape), np.nan, dtype=np.float32)
+        self.seen = 0
+        self.histogram_edges = None if histogram_edges is None else np.asarray(histogram_edges, dtype=np.float64)
+        self.histogram = None if histogram_edges is None else \
+            np.zeros(tuple(shape) + (len(self.histogram_edges) - 1,), dtype=np.int64)
+
+    def extend(self, n_time):
+        """
+        Grows the time axis to `n_time`, for replicates that are longer than the ones before (the earlier ones
+        count as missing there).
+        """
+        missing = n_time - self.mean.shape[0]
+        if missing <= 0:
+            return
+
+        def pad(array, value, axis=0):
+            widths = [(0, 0)] * array.ndim
+            widths[axis] = (0, missing)
+            return np.pad(array, widths, constant_values=value)
+        self.count, self.mean, self.m2 = pad(self.count, 0), pad(self.mean, 0.0), pad(self.m2, 0.0)
+        self.min, self.max = pad(self.min, np.inf), pad(self.max, -np.inf)
+        self.sample = pad(self.sample, np.nan, axis=1)
+        if self.histogram is not None:
+            self.histogram = pad(self.histogram, 0)
+
+    def update(self, block):
+        """
+        Adds a (replicates, time, columns) block, the replicates following the ones added before.
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape[1] < self.mean.shape[0]:  # shorter replicates (stopped early) are missing at the end
+            block = np.pad(block, [(0, 0), (0, self.mean.shape[0] - block.shape[1]), (0, 0)], constant_values=np.nan)
+        valid = ~np.isnan(block)
+        n_block = valid.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_block = np.where(n_block > 0, np.nansum(block, axis=0) / n_block, 0.0)
+            m2_block = np.nansum((block - mean_block) ** 2, axis=0)
+            n_total = self.count + n_block
+            delta = mean_block - self.mean
+            self.mean = np.where(n_total > 0, self.mean + delta * n_block / np.maximum(n_total, 1), 0.0)
+            self.m2 += m2_block + delta ** 2 * self.count * n_block / np.maximum(n_total, 1)
+        self.count = n_total
+        self.min = np.fmin(self.min, np.nanmin(np.where(valid, block, np.inf), axis=0))
+        self.max = np.fmax(self.max, np.nanmax(np.where(valid, block, -np.inf), axis=0))
+
+        if self.histogram is not None:
+            n_bins = self.histogram.shape[-1]
+            bins = np.searchsorted(self.histogram_edges, block, side="right") - 1
+            bins[block == self.histogram_edges[-1]] = n_bins - 1
+            counted = valid & (bins >= 0) & (bins < n_bins)
+            element = np.broadcast_to(np.arange(self.mean.size).reshape(self.mean.shape), block.shape)
+            np.add.at(self.histogram.reshape(-1), element[counted] * n_bins + bins[counted], 1)
+
+        in_block = (self.sample_ids >= self.seen) & (self.sample_ids < self.seen + len(block))
+        self.sample[in_block] = block[self.sample_ids[in_block] - self.seen]
+        self.seen += len(block)
+
+    def result(self, quantiles=(0.05, 0.5, 0.95), confidence=0.95):
+        """
+        Returns:
+            dict: "count", "mean", "var" (sample variance), "std", "sem", "ci_low"/"ci_high" (normal confidence band
+                  of the mean), "min", "max", "quantile_levels" and "quantiles" (n_quantiles, time, columns).
+        """
+        from scipy.stats import norm
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = np.where(self.count > 1, self.m2 / np.maximum(self.count - 1, 1), np.nan)
+            sem = np.sqrt(var / self.count)
+        z = norm.ppf(0.5 + confidence / 2)
+        quantile_values = np.full((len(quantiles),) + self.mean.shape, np.nan)
+        if len(self.sample) and len(quantiles):
+            quantile_values = np.nanquantile(self.sample, quantiles, axis=0) if np.any(~np.isnan(self.sample)) \
+                else quantile_values
+        result = {"count": self.count, "mean": np.where(self.count > 0, self.mean, np.nan), "var": var,
+                  "std": np.sqrt(var), "sem": sem, "ci_low": self.mean - z * sem, "ci_high": self.mean + z * sem,
+                  "min": self.min, "max": self.max, "quantile_levels": np.asarray(quantiles, dtype=np.float64),
+                  "quantiles": quantile_values, "confidence": np.float64(confidence)}
+        if self.histogram is not None:
+            result.update(histogram=self.histogram, histogram_edges=self.histogram_edges)
+        return result
+
+
+def replicate_statistics(data, quantiles=(0.05, 0.5, 0.95), confidence=0.95, sample_size=256,
+                         block_bytes=BLOCK_BYTES, seed=0):
+    """
+    Statistics over the replicate axis of a (replicates, time, columns) dataset, read a block of replicates at a
+    time (aligned to the chunks of the dataset if it has any), see `RunningStatistics`.
+    """
+    n_replicats, n_time, n_columns = data.shape
+    stats = RunningStatistics((n_time, n_columns), n_replicats, sample_size, seed)
+    rows = max(block_bytes // max(n_time * n_columns * 8, 1), 1)
+    chunks = getattr(data, "chunks", None) or getattr(getattr(data, "dataset", None), "chunks", None)
+    if chunks:
+        rows = max(rows // chunks[0], 1) * chunks[0]
+    for start in range(0, n_replicats, rows):
+        stats.update(data[start:min(start + rows, n_replicats)])
+    return stats.result(quantiles, confidence)
+
+
+def statistics_cache_path(hdf_path, uid, index):
+    return os.path.join(f"{hdf_path}.stats", uid, f"selector_{index}.npz")
+
+
+def _cache_key(hdf_path, labels, settings):
+    stat = os.stat(hdf_path + ".h5")
+    text = json.dumps({"version": STATISTICS_VERSION, "mtime": stat.st_mtime, "size": stat.st_size,
+                       "labels": [str(label) for label in labels], "settings": settings}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def cached_statistics(hdf_path, uid, results=None, quantiles=(0.05, 0.5, 0.95), confidence=0.95, sample_size=256,
+                      seed=0):
+    """
+    Replicate statistics of every result selector of a run, cached next to the results.
+
+    The reduced arrays are stored in `hdf_path.stats/uid/selector_{i}.npz`, keyed by the modification time and
+    size of the result file and the settings, so the first call streams over the replicates once and every later
+    call (e.g. replotting) only loads the small arrays.
+
+    Args:
+        hdf_path (str): Result file without the .h5 suffix, like for `load_results`.
+        uid (str): Run name.
+        results (list, optional): The results of `load_results(hdf_path, uid)` if they are already open.
+        quantiles, confidence, sample_size, seed: See `RunningStatistics`.
+
+    Returns:
+        list: One dict per result selector (in the order of `load_results`) with the arrays of
+              `RunningStatistics.result` plus "time" and "labels".
+    """
+    from src.Aggregation import is_aggregate, load_aggregates
+    if is_aggregate(hdf_path, uid): # only the aggregates were stored, nothing to stream over
+        return load_aggregates(hdf_path, uid, quantiles, confidence)
+    if results is None:
+        from src.Ensemble import load_results
+        with load_results(hdf_path, uid) as results:
+            return cached_statistics(hdf_path, uid, results, quantiles, confidence, sample_size, seed)
+    settings = {"quantiles": list(quantiles), "confidence": confidence, "sample_size": sample_size, "seed": seed}
+
+    all_stats = []
+    for index, res in enumerate(results):
+        labels = list(res.labels)
+        path = statistics_cache_path(hdf_path, uid, index)
+        key = _cache_key(hdf_path, labels, settings)
+        if os.path.isfile(path):
+            with np.load(path) as cached:
+                if str(cached["key"]) == key:
+                    all_stats.append({name: cached[name] for name in cached.files if name != "key"}
+                                     | {"labels": labels})
+                    continue
+
+        stats = replicate_statistics(res.data, quantiles, confidence, sample_size, seed=seed)
+        stats["time"] = np.asarray(res.time[0], dtype=np.float64)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, key=np.array(key), **stats)
+        os.replace(tmp_path, path)
+        all_stats.append(stats | {"labels": labels})
+    return all_stats
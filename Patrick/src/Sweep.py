@@ -0,0 +1,256 @@
+import glob
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+# job states in the manifest
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_key TEXT UNIQUE NOT NULL,
+    mesh_path TEXT NOT NULL,
+    overrides TEXT NOT NULL,
+    replicat INTEGER NOT NULL,
+    seed INTEGER,
+    save_path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    seconds REAL,
+    worker INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS sweep (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def load_spec(path):
+    """
+    Reads a sweep spec from a JSON file, see `expand_spec` for the fields.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def _job_key(mesh_path, overrides, replicat):
+    """
+    Identifies a job by what it computes, so the same job keeps its id, seed and output when the spec grows.
+    """
+    text = json.dumps({"mesh": os.path.abspath(mesh_path), "overrides": overrides, "replicat": replicat},
+                      sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:24]
+
+
+def _job_seed(root_seed, key):
+    if root_seed is None:
+        return None
+    return int(hashlib.sha256(f"{root_seed}:{key}".encode()).hexdigest()[:8], 16) % (2**31 - 1) + 1
+
+
+def expand_spec(spec):
+    """
+    Expands a sweep spec into the list of jobs, one replicate of one (mesh, parameter point) each.
+
+    Spec fields:
+        save_root (str): Directory of the manifest and the results.
+        meshes (list): Paths or glob patterns of the .inp meshes.
+        grid (dict): Parameter name -> list of values, e.g. {"DC": [1e-12, 4e-12], "k[0]": [1e7, 1e8]}, expanded
+                     into all combinations (overrides of the `parameters.py` dict).
+        points (list, optional): Explicit parameter points (dicts of overrides) instead of or in addition to grid.
+        replicats (int): Replicates per (mesh, point), default 1.
+        seed (int, optional): Root seed. Every job gets a seed derived from it and from what the job computes.
+        model_type (str), load_model (dict), run (dict): Passed to `SimManager.load_model` and `SimManager.run`.
+        runname (str): Run name in the output files, default "sweep".
+
+    Returns:
+        list: One dict per job (job_key, mesh_path, overrides, replicat, seed, save_path).
+    """
+    meshes = []
+    for pattern in spec["meshes"]:
+        matches = sorted(glob.glob(pattern))
+        meshes.extend(matches if matches else [pattern])
+    grid = spec.get("grid", {})
+    points = [dict(zip(grid, values)) for values in itertools.product(*grid.values())] if grid else []
+    points += [dict(point) for point in spec.get("points", [])]
+    points = points or [{}]
+
+    jobs = []
+    for mesh_path, overrides, replicat in itertools.product(meshes, points, range(spec.get("replicats", 1))):
+        key = _job_key(mesh_path, overrides, replicat)
+        jobs.append({"job_key": key,
+                     "mesh_path": mesh_path,
+                     "overrides": overrides,
+                     "replicat": replicat,
+                     "seed": _job_seed(spec.get("seed"), key),
+                     "save_path": os.path.join(spec["save_root"], "jobs", key, "result")})
+    return jobs
+
+
+def manifest_path(spec):
+    return os.path.join(spec["save_root"], "manifest.sqlite")
+
+
+def connect(path):
+    """
+    Opens the manifest. Several rank groups write to it, so it waits for locks instead of failing; keep it on a file
+    system with working file locks (local disk, Lustre/GPFS, not every NFS setup).
+    """
+    connection = sqlite3.connect(path, timeout=120, isolation_level=None)
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def sync_manifest(spec, jobs):
+    """
+    Adds the jobs that are not in the manifest yet (existing ones keep their status and seed) and resets jobs that
+    were running when the sweep was killed to pending.
+
+    Returns:
+        dict: Number of jobs per status.
+    """
+    os.makedirs(spec["save_root"], exist_ok=True)
+    with closing(connect(manifest_path(spec))) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.executemany(
+            "INSERT OR IGNORE INTO jobs (job_key, mesh_path, overrides, replicat, seed, save_path) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(job["job_key"], job["mesh_path"], json.dumps(job["overrides"], sort_keys=True), job["replicat"],
+              job["seed"], job["save_path"]) for job in jobs])
+        connection.execute("UPDATE jobs SET status = ? WHERE status = ?", (PENDING, RUNNING))
+        connection.execute("INSERT OR REPLACE INTO sweep (key, value) VALUES ('spec', ?)",
+                           (json.dumps(spec, default=str),))
+        connection.execute("COMMIT")
+    return sweep_status(manifest_path(spec))
+
+
+def sweep_status(path):
+    """
+    Number of jobs per status in a manifest.
+    """
+    with closing(connect(path)) as connection:
+        return dict(connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+def open_jobs(spec, jobs, retry_failed=False):
+    """
+    The jobs of the spec that still have to run: everything not done (failed ones only with `retry_failed`).
+    """
+    statuses = (PENDING, FAILED) if retry_failed else (PENDING,)
+    with closing(connect(manifest_path(spec))) as connection:
+        rows = connection.execute(f"SELECT job_id, job_key, seed FROM jobs WHERE status IN "
+                                  f"({', '.join('?' * len(statuses))})", statuses).fetchall()
+    todo = {key: (job_id, seed) for job_id, key, seed in rows}
+    return [dict(job, job_id=todo[job["job_key"]][0], seed=todo[job["job_key"]][1]) for job in jobs
+            if job["job_key"] in todo]
+
+
+def _set_status(path, job_id, status, **columns):
+    assignments = ", ".join(["status = ?"] + [f"{name} = ?" for name in columns])
+    with closing(connect(path)) as connection:
+        connection.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?",
+                           (status, *columns.values(), job_id))
+
+
+def _run_job(job, comm, spec, base_parameters):
+    """
+    Task runner of the sweep: runs one job on the ranks of `comm` and records its status in the manifest.
+    A failing job is marked as failed and the sweep continues with the next one.
+    """
+    from src.SimManager import SimManager
+
+    path = manifest_path(spec)
+    is_leader = comm.Get_rank() == 0
+    if is_leader:
+        with closing(connect(path)) as connection:
+            connection.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, started = ?, worker = ?, "
+                               "error = NULL WHERE job_id = ?",
+                               (RUNNING, time.time(), _world_rank(), job["job_id"]))
+    start_time = time.time()
+    try:
+        load_model_kwargs = dict(spec.get("load_model", {}))
+        if comm.Get_size() < _world_size():
+            load_model_kwargs.setdefault("solver", "Tetexact")
+        sm = SimManager(parameters=dict(base_parameters, **job["overrides"]),
+                        mesh_path=job["mesh_path"],
+                        save_path=job["save_path"],
+                        parallel=comm.Get_size() > 1,
+                        runname=spec.get("runname", "sweep"),
+                        plot_only_run=False,
+                        replace=True,
+                        comm=comm)
+        sm.load_model(type=spec.get("model_type", "small"), seed=job["seed"], **load_model_kwargs)
+        sm.run(replicats=1, **spec.get("run", {}))
+    except Exception as error:
+        if is_leader:
+            _set_status(path, job["job_id"], FAILED, finished=time.time(), seconds=time.time() - start_time,
+                        error=repr(error))
+        print(f"Job {job['job_id']} failed: {error!r}")
+        return
+    if is_leader:
+        _set_status(path, job["job_id"], DONE, finished=time.time(), seconds=time.time() - start_time)
+
+
+def _world_rank():
+    from mpi4py import MPI
+    return MPI.COMM_WORLD.Get_rank()
+
+
+def _world_size():
+    from mpi4py import MPI
+    return MPI.COMM_WORLD.Get_size()
+
+
+def run_sweep(spec, base_parameters, group_size=1, retry_failed=False):
+    """
+    Runs a declarative parameter sweep and records every job in a SQLite manifest, so an interrupted sweep resumes
+    where it stopped.
+
+    The spec (see `expand_spec`) is expanded into jobs of one replicate each. The manifest
+    (`save_root/manifest.sqlite`, table "jobs") keeps the parameters, mesh, seed, output path, status
+    (pending/running/done/failed), attempts, timings and error of every job. On a restart with the same (or an
+    extended) spec, done jobs are skipped, jobs that were running when the sweep died run again, and failed jobs
+    run again only with `retry_failed`. The open jobs are distributed over rank groups with the task farm of
+    `src/TaskFarm.py`.
+
+    Args:
+        spec (dict or str): The spec or the path of a JSON spec.
+        base_parameters (dict): Parameters the grid values override, see `parameters.py`.
+        group_size (int): Ranks per job, 1 or at least the number of ranks, see `run_task_farm`. With one rank per
+                          job the jobs run a serial solver (Tetexact unless the spec sets one), TetOpSplit is refused.
+        retry_failed (bool): Also run the jobs that failed before.
+
+    Returns:
+        dict: On rank 0 the number of jobs per status after the sweep, None on the other ranks.
+    """
+    from mpi4py import MPI
+    from src.TaskFarm import run_task_farm, check_group_size
+
+    spec = load_spec(spec) if isinstance(spec, str) else spec
+    world = MPI.COMM_WORLD
+    # TetOpSplit always runs on all of COMM_WORLD, every job would hang, see Solvers.check_communicator; serial
+    # solvers run on one rank, so any other group size would fail every job
+    check_group_size(group_size, world.Get_size())
+    solver = spec.get("load_model", {}).get("solver")
+    assert solver != "TetOpSplit" or group_size >= world.Get_size(), \
+        f"TetOpSplit cannot run on groups of {group_size} of {world.Get_size()} ranks, use a serial solver " \
+        f"(e.g. Tetexact) or --group-size {world.Get_size()}."
+    todo = None
+    if world.Get_rank() == 0:
+        jobs = expand_spec(spec)
+        status = sync_manifest(spec, jobs)
+        todo = open_jobs(spec, jobs, retry_failed)
+        print(f"Sweep of {len(jobs)} jobs: {status}, running {len(todo)}")
+
+    run_task_farm(todo, group_size, run_task=lambda job, comm: _run_job(job, comm, spec, base_parameters))
+    if world.Get_rank() == 0:
+        status = sweep_status(manifest_path(spec))
+        print(f"Sweep finished: {status}")
+        return status
+    return None
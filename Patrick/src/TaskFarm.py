@@ -0,0 +1,154 @@
+import itertools
+import os
+import time
+import numpy as np
+from mpi4py import MPI
+
+
+def build_tasks(mesh_paths, parameter_sets, replicats, save_root, model_type="small", runname="task_farm", seed=None,
+                **load_model_kwargs):
+    """
+    Expands meshes x parameter sets x replicates into a flat list of independent tasks.
+
+    Every task gets its own output file `save_root/mesh_{i}/params_{j}/replicat_{k}` and its own seed, derived from
+    `seed` with `np.random.SeedSequence`, so the results do not depend on which rank group ends up running a task.
+
+    Args:
+        mesh_paths (list): Paths to the .inp meshes.
+        parameter_sets (list): Full parameter dicts (see `parameters.py`), one per parameter set.
+        replicats (int): Number of replicates per (mesh, parameter set).
+        save_root (str): Directory the results are written to.
+        model_type (str): Passed to `SimManager.load_model`.
+        runname (str): Run name of all tasks.
+        seed (int, optional): Root seed, if None fresh entropy from the OS is used.
+        **load_model_kwargs: Further keyword arguments for `SimManager.load_model`.
+
+    Returns:
+        list: One dict per task.
+    """
+    combinations = list(itertools.product(enumerate(mesh_paths), enumerate(parameter_sets), range(replicats)))
+    seeds = [int(s.generate_state(1)[0] % (2**31 - 1)) + 1
+             for s in np.random.SeedSequence(seed).spawn(len(combinations))]
+
+    tasks = []
+    for task_id, (((mesh_idx, mesh_path), (param_idx, parameters), replicat), task_seed) in \
+            enumerate(zip(combinations, seeds)):
+        tasks.append({"task_id": task_id,
+                      "mesh_path": mesh_path,
+                      "parameters": parameters,
+                      "replicat": replicat,
+                      "seed": task_seed,
+                      "save_path": os.path.join(save_root, f"mesh_{mesh_idx}", f"params_{param_idx}",
+                                                f"replicat_{replicat}"),
+                      "runname": runname,
+                      "model_type": model_type,
+                      "load_model_kwargs": load_model_kwargs})
+    return tasks
+
+
+def run_simulation_task(task, comm):
+    """
+    Default task runner of the farm: builds a SimManager on the communicator of the rank group and runs one replicate.
+
+    On a group smaller than COMM_WORLD the solver defaults to the serial Tetexact, TetOpSplit is refused there (see
+    `Solvers.check_communicator`).
+    """
+    from src.SimManager import SimManager
+
+    load_model_kwargs = dict(task["load_model_kwargs"])
+    if comm.Get_size() < MPI.COMM_WORLD.Get_size():
+        load_model_kwargs.setdefault("solver", "Tetexact")
+
+    sm = SimManager(parameters=task["parameters"],
+                    mesh_path=task["mesh_path"],
+                    save_path=task["save_path"],
+                    parallel=comm.Get_size() > 1,
+                    runname=task["runname"],
+                    plot_only_run=False,
+                    replace=True,
+                    comm=comm)
+    sm.load_model(type=task["model_type"], seed=task["seed"], **load_model_kwargs)
+    sm.run(replicats=1)
+
+
+def check_group_size(group_size, world_size):
+    """
+    Raises an AssertionError for groups that no solver can run on: TetOpSplit only runs on all of COMM_WORLD and the
+    serial solvers on a single rank, so a group has either one rank or all of them.
+    """
+    assert group_size == 1 or group_size >= world_size, \
+        f"Groups of {group_size} of {world_size} ranks cannot run a simulation: TetOpSplit always runs on all ranks " \
+        f"of COMM_WORLD and the serial solvers on one rank. Use group_size=1 (serial solver per rank) or " \
+        f"group_size={world_size} (TetOpSplit on all ranks)."
+
+
+def run_task_farm(tasks, group_size, run_task=run_simulation_task):
+    """
+    Runs independent tasks on groups of MPI ranks that take their next task from a shared queue.
+
+    COMM_WORLD is split into groups of `group_size` consecutive ranks (the last group may be smaller). The queue is a
+    single counter in an MPI window on rank 0: the leader of a group atomically fetches and increments it, then
+    broadcasts the task index to the rest of its group, and the whole group calls `run_task(task, group_comm)`.
+    Fast groups therefore simply take more tasks, there is no static assignment and no dedicated master rank.
+
+    E.g. `mpirun -n 128 python script.py` with `group_size=1` runs 128 tasks at a time with a serial solver each,
+    `group_size=128` runs one TetOpSplit task after the other on all ranks.
+
+    Args:
+        tasks (list): Task dicts, e.g. from `build_tasks`. The list of world rank 0 is used on all ranks.
+        group_size (int): Number of ranks per group, 1 or at least the number of ranks (see the notes).
+        run_task (callable): Called as `run_task(task, comm)` by all ranks of a group.
+
+    Returns:
+        list: On world rank 0 the (task_id, group, seconds) of every finished task, None on the other ranks.
+
+    Notes:
+        The distributed TetOpSplit solver of STEPS always runs on MPI_COMM_WORLD, it cannot run on the communicator
+        of a group, and the serial solvers run on one rank only. So groups of several ranks that are not all of
+        COMM_WORLD cannot run any solver and are refused (`check_group_size`). With group_size=1 the default task
+        runner uses Tetexact and `SimManager.load_model` refuses TetOpSplit, a single group spanning all ranks
+        (group_size >= world size) runs TetOpSplit.
+    """
+    world = MPI.COMM_WORLD
+    rank = world.Get_rank()
+    check_group_size(group_size, world.Get_size())
+    # every rank must see the same task list (seeds drawn from OS entropy differ between ranks otherwise)
+    tasks = world.bcast(tasks if rank == 0 else None, root=0)
+    group_id = rank // group_size
+    group_comm = world.Split(color=group_id, key=rank)
+    is_leader = group_comm.Get_rank() == 0
+
+    # shared task counter, lives on world rank 0
+    counter = np.zeros(1, dtype=np.int64) if rank == 0 else None
+    window = MPI.Win.Create(counter, comm=world)
+    world.Barrier()
+
+    one = np.ones(1, dtype=np.int64)
+    fetched = np.zeros(1, dtype=np.int64)
+    finished = []
+    while True:
+        if is_leader:
+            window.Lock(0)
+            window.Fetch_and_op(one, fetched, 0, op=MPI.SUM)
+            window.Unlock(0)
+            task_idx = int(fetched[0])
+        else:
+            task_idx = None
+        task_idx = group_comm.bcast(task_idx, root=0)
+        if task_idx >= len(tasks):
+            break
+
+        start_time = time.time()
+        run_task(tasks[task_idx], group_comm)
+        elapsed = time.time() - start_time
+        if is_leader:
+            finished.append((tasks[task_idx].get("task_id", task_idx), group_id, elapsed))
+            print(f"Group {group_id} finished task {task_idx + 1}/{len(tasks)} in {elapsed:.2f} seconds.")
+
+    world.Barrier()
+    window.Free()
+    all_finished = world.gather(finished, root=0)
+    group_comm.Free()
+    if rank == 0:
+        return sorted(itertools.chain.from_iterable(all_finished))
+    return None
@@ -11,6 +11,7 @@ import steps.interface
 from os.path import abspath, dirname, join
 import socket
 import getpass
+from mpi4py import MPI
 
 def molar_to_molecules(M, Volume):
     """
@@ -43,12 +44,63 @@ def dataframe_cleanup(df, columns=["Species"]):
 
 
 
+def build_initial_count_matrix(df, species_names):
+    """
+    Builds the species x compartment matrix of initial counts from the model dataframe.
+
+    Args:
+        df (pd.DataFrame): Cleaned model dataframe with one "<compartment> init count" column per compartment.
+        species_names (list): Species in the order of the rows of the returned matrix.
+
+    Returns:
+        tuple: (list of compartment names, np.ndarray of shape (len(species_names), len(compartments))).
+               NaN entries are returned as 0.
+    """
+    init_count_columns = list(df.filter(like='init count').columns)
+    compartments = [col.split('init count')[0].strip() for col in init_count_columns]
+    counts = df.drop_duplicates("Species").set_index("Species").reindex(list(species_names))[init_count_columns]
+    return compartments, np.nan_to_num(counts.to_numpy(dtype=np.float64))
+
+
+def build_presence_index(simulation, compartments, species_names):
+    """
+    Finds out which species exist in which compartment/patch of a built simulation.
+
+    STEPS only knows a species in a compartment if a volume/surface system of that compartment uses it, accessing
+    any other combination raises a `SolverCallError`. This probes every combination exactly once, so the per-replicate
+    initialization never has to go through exceptions again.
+
+    Returns:
+        np.ndarray: Boolean matrix of shape (len(species_names), len(compartments)).
+    """
+    # get the available compartments and patches from the simulation instance
+    available = set()
+    for key, value in simulation._children.items():
+        # well-mixed geometries (src/Solvers.py) have plain compartments and patches
+        if isinstance(value, (stgeom._TetCompartment, stgeom._TetPatch, stgeom.Compartment, stgeom.Patch)):
+            available.add(value.name)
+
+    presence = np.zeros((len(species_names), len(compartments)), dtype=bool)
+    for c_idx, compartment in enumerate(compartments):
+        if compartment not in available:
+            continue
+        location = getattr(simulation, compartment)
+        for s_idx, species in enumerate(species_names):
+            try:
+                getattr(location, species).Count
+                presence[s_idx, c_idx] = True
+            except steps.API_2.sim.SolverCallError:
+                pass
+    return presence
+
+
 def set_inital_values(sim_manager, factor):
     '''
-    Initializes species counts in compartments based on an Excel configuration file.
+    Initializes species counts in compartments based on the model dataframe.
 
-    This function reads initial species count data from an Excel file, cleans it,
-    and maps the values to the appropriate compartments in the simulation.
+    The species x compartment count matrix and the presence index of the simulation are built once and kept on
+    the sim_manager (`sim_manager.initial_count_plan`). Every later call, e.g. one per replicate, only writes the
+    counts of the species that exist in a compartment, one bulk assignment per compartment.
     The initial values are scaled by a given factor before being assigned.
 
     Parameters
@@ -58,40 +110,38 @@ def set_inital_values(sim_manager, factor):
 
     Notes
     -----
-    - Reads the data from an Excel file specified in `sim_manager.parameters["big_model_mini_sph_df_path"]`.
-    - Cleans the dataframe and extracts species names.
-    - Identifies compartments in the simulation where species should be initialized.
-    - Assigns initial values from the dataframe to species in respective compartments.
+    - Reads the data specified in `sim_manager.parameters["big_model_mini_sph_df_path"]` through the compiled
+      cache in `src/ModelCache.py`, so the .xls is only parsed again when its content changes.
     - If a value is NaN, it defaults to 0.
-    - Any `SolverCallError` from STEPS API is caught and ignored.
+    - The plan is rebuilt whenever `sim_manager.simulation` is replaced, e.g. by another `load_model` call.
+    - The assigned values are printed once per plan, on rank 0 only.
     '''
-    df_path = f"{sim_manager.base_path}{sim_manager.parameters["big_model_mini_sph_df_path"]}"
-    df = pd.read_excel(df_path)
-    df = dataframe_cleanup(df, ["Species"])
-
-    # get the compartments and map it to the corresponding column in the df
-    init_count_columns = df.filter(like='init count').columns
-    compartments_to_init_map = {col.split('init count')[0].strip(): col for col in init_count_columns}
-
-    # get the available compartments from the simulation instance
-    compartments = []
-    for key, value in sim_manager.simulation._children.items():  # extract the compartment types from the geometry
-        if isinstance(value, stgeom._TetCompartment) or isinstance(value, stgeom._TetPatch):
-            compartments.append(value)
-
-    # set the initial values for each species in each compartment
-    for compartment in compartments_to_init_map.keys():
-        for s_idx, species in enumerate(sim_manager.species_names):
-            # get the desired initial_value from the df
-            initial_value = df.loc[df.Species == species][compartments_to_init_map[compartment]].values
-            initial_value = 0 if np.isnan(initial_value) else initial_value
-            try:
-                # set the initial value. If this species does not exist in the compartment, ignore the error and continue
-                getattr(getattr(sim_manager.simulation, compartment), species).Count = initial_value * factor
-                value = getattr(getattr(sim_manager.simulation, compartment), species).Count
-                print(compartment, species, value)
-            except steps.API_2.sim.SolverCallError:
-                pass
+    plan = getattr(sim_manager, "initial_count_plan", None)
+    if plan is None or plan["simulation"] is not sim_manager.simulation:
+        from src.ModelCache import load_model_dataframe
+        df_path = f"{sim_manager.base_path}{sim_manager.parameters['big_model_mini_sph_df_path']}"
+        df = load_model_dataframe(df_path)
+
+        species_names = list(sim_manager.species_names)
+        compartments, counts = build_initial_count_matrix(df, species_names)
+        presence = build_presence_index(sim_manager.simulation, compartments, species_names)
+
+        # per compartment only keep the species that exist there, in the order they are written
+        plan = {"simulation": sim_manager.simulation, "assignments": []}
+        for c_idx, compartment in enumerate(compartments):
+            rows = np.flatnonzero(presence[:, c_idx])
+            if len(rows) > 0:
+                plan["assignments"].append((compartment, [species_names[i] for i in rows], counts[rows, c_idx]))
+        sim_manager.initial_count_plan = plan
+
+        if getattr(sim_manager, "comm", MPI.COMM_WORLD).Get_rank() == 0:
+            summary = ", ".join(f"{compartment}.{s}={c * factor:g}"
+                                for compartment, species, counts in plan["assignments"]
+                                for s, c in zip(species, counts) if c != 0)
+            print(f"Initial counts (factor {factor}): {summary}")
+
+    for compartment, species, counts in plan["assignments"]:
+        getattr(sim_manager.simulation, compartment).LIST(*species).Count = list(counts * factor)
 
     
 # Helperfunction to set project root and add it to path